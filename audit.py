@@ -0,0 +1,522 @@
+# This module audits a romset against scan results in bulk: which ROMs of
+# every set are there (right dump, right name, right set), found elsewhere or
+# under another name, bad (a file with the right name but another content) or
+# missing, and how complete every set is. Instead of checking games one by one
+# the scan results are joined once against the whole RomTable: with numpy the
+# size+CRC columns are read in place and joined by sorting the scanned keys and
+# binary searching every ROM key at once, without it the join goes through the
+# RomIndex hash tables. Statuses and per set counts are then computed over flat
+# arrays, the only per file work left being the lookup of where files sit: a
+# ROM is there only when its file sits in the romset folder, in the archive or
+# folder named after its set, or loose in the romset folder for one file sets.
+
+import csv
+import json
+import os
+import time
+from array import array
+from logging import Logger
+from typing import IO, Any, Iterable, Iterator, Literal, Optional
+
+from metrics import LOG_LEVELS, metrics
+from model import HAS_CRC, HAS_MD5, HAS_SHA1, HAS_SIZE, Game, RomIndex
+from rebuilder import safeName
+from relations import RomGraph, SetType
+from scanner import FileHashes
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+thisLogger: Logger | None = None
+
+# Status of every ROM entry of a set, the values of AuditReport.statuses
+HAVE = 0 # the right dump, under its name, in its set
+WRONG_NAME = 1 # the dump was found, but under another name or elsewhere
+BAD = 2 # a file sits where the ROM belongs, with another content
+MISSING = 3
+NODUMP = 4 # no known good dump, not needed for a set to be complete
+STATUSES: tuple[str, ...] = ('have', 'wrongName', 'bad', 'missing', 'nodump')
+
+HASHES = HAS_CRC | HAS_MD5 | HAS_SHA1
+
+def _stem_(name: str) -> str:
+    """
+    Return a file name without extension, the name of the set it holds.
+    """
+    return name.rpartition('.')[0] or name
+
+class AuditReport():
+    """
+    Status of every ROM entry of every set, sets in descriptor order and
+    their entries packed in flat arrays: the entries of the i-th set go from
+    starts[i] to starts[i + 1].
+    """
+    __slots__ = ('setType', 'games', 'starts', 'entries', 'rows', 'statuses',
+                 'sources', 'results', 'started', 'finished', '__counts__')
+
+    def __init__(self, setType: SetType, results: list[FileHashes]) -> None:
+        self.setType = setType
+        self.games: list[Game] = []
+        self.starts: array = array('I', [0])
+        self.entries: list[str] = []
+        self.rows: array = array('I') # entry -> RomTable row
+        self.statuses: array = array('B')
+        self.sources: array = array('i') # entry -> results position, or -1
+        self.results = results
+        self.started: float = time.perf_counter()
+        self.finished: float | None = None
+        self.__counts__: list[list[int]] | None = None
+
+    @property
+    def elapsed(self) -> float:
+        end = self.finished if self.finished is not None else time.perf_counter()
+        return max(end - self.started, 1e-9)
+
+    def counts(self) -> list[list[int]]:
+        """
+        Return, for every set, how many of its entries have each status.
+        """
+        if self.__counts__ is None:
+            sets = len(self.games)
+            if numpy is not None and sets:
+                owners = numpy.repeat(numpy.arange(sets), numpy.diff(
+                    numpy.frombuffer(self.starts, dtype=numpy.uint32)))
+                statuses = numpy.frombuffer(self.statuses, dtype=numpy.uint8)
+                self.__counts__ = numpy.bincount(
+                    owners * len(STATUSES) + statuses,
+                    minlength=sets * len(STATUSES)).reshape(
+                    sets, len(STATUSES)).tolist()
+            else:
+                data = bytes(self.statuses)
+                starts = self.starts
+                self.__counts__ = [
+                    [data.count(status, starts[i], starts[i + 1])
+                     for status in range(len(STATUSES))]
+                    for i in range(sets)]
+        return self.__counts__
+
+    def completeness(self, counts: list[int]) -> Literal['complete', 'partial',
+                                                         'missing']:
+        needed = sum(counts) - counts[NODUMP]
+        if counts[HAVE] == needed:
+            return 'complete'
+        return 'missing' if counts[HAVE] == 0 else 'partial'
+
+    def byGame(self) -> Iterator[tuple[Game, str, list[int]]]:
+        """
+        Yield every set as (game, completeness, status counts).
+        """
+        for game, counts in zip(self.games, self.counts()):
+            yield game, self.completeness(counts=counts), counts
+
+    def summary(self) -> dict[str, Any]:
+        sets = {'complete': 0, 'partial': 0, 'missing': 0}
+        roms = [0] * len(STATUSES)
+        for _, completeness, counts in self.byGame():
+            sets[completeness] += 1
+            for status, count in enumerate(counts):
+                roms[status] += count
+        return {'setType': self.setType, 'sets': len(self.games), **sets,
+                'roms': dict(zip(STATUSES, roms))}
+
+    def details(self, position: int) -> dict[str, list[Any]]:
+        """
+        Return the entries of the set at position that are not there, by
+        status, with the file found for wrong named and bad ones.
+        """
+        found: dict[str, list[Any]] = {}
+        for entry in range(self.starts[position], self.starts[position + 1]):
+            status = self.statuses[entry]
+            if status == HAVE:
+                continue
+            source = self.sources[entry]
+            name = self.entries[entry]
+            found.setdefault(STATUSES[status], []).append(
+                name if source < 0 else
+                {'rom': name, 'file': self.results[source].name})
+        return found
+
+    def writeCsv(self, file: IO[str]) -> None:
+        """
+        Write one line per set with its completeness and status counts.
+        """
+        writer = csv.writer(file)
+        writer.writerow(('game', 'category', 'status', *STATUSES, 'total'))
+        for game, completeness, counts in self.byGame():
+            writer.writerow((game.name, game.category, completeness, *counts,
+                             sum(counts)))
+
+    def writeJson(self, file: IO[str]) -> None:
+        """
+        Write the summary and every set, with the details of the ROMs that
+        are not there for incomplete ones.
+        """
+        games: list[dict[str, Any]] = []
+        for position, (game, completeness, counts) in enumerate(self.byGame()):
+            data: dict[str, Any] = {'name': game.name, 'category':
+                                    game.category, 'status': completeness,
+                                    **dict(zip(STATUSES, counts))}
+            if completeness != 'complete':
+                data['roms'] = self.details(position=position)
+            games.append(data)
+        json.dump({'summary': self.summary(), 'games': games}, file, indent=1)
+
+    def save(self, path: str) -> None:
+        """
+        Export to path, as JSON for .json files and as CSV otherwise.
+        """
+        with open(file=path, mode='w', encoding='utf-8', newline='') as file:
+            if os.path.splitext(path)[1].lower() == '.json':
+                self.writeJson(file=file)
+            else:
+                self.writeCsv(file=file)
+
+    def __str__(self) -> str:
+        summary = self.summary()
+        roms = ', '.join(f'{count} {status}' for status, count in
+                         summary['roms'].items())
+        return (f'{summary["sets"]} {self.setType} sets: {summary["complete"]} '
+                f'complete, {summary["partial"]} partial, '
+                f'{summary["missing"]} missing; ROMs: {roms} '
+                f'({self.elapsed:.3f}s)')
+
+class Auditor():
+    """
+    Bulk audit of the sets of a romset against scan results.
+    """
+    def __init__(self, graph: RomGraph, index: RomIndex, setType: SetType =
+                 'nonmerged', romset: Optional[str] = None,
+                 logger: Optional['Logger'] = None) -> None:
+        """
+        Constructor of the class.
+
+        Arguments:
+        - graph (RomGraph): Relationships of the romset, telling the
+          contents of every set.
+        - index (RomIndex): Hash index of the same romset.
+        - setType (str): Set type the collection is expected to be in.
+        - romset (str): Romset folder, only files in there can be in their
+          set; without it every dump found is elsewhere.
+        """
+        global thisLogger
+        thisLogger = logger
+        self.graph = graph
+        self.index = index
+        self.setType = setType
+        self.romset = None if romset is None else os.path.abspath(romset)
+
+    def audit(self, results: Iterable[FileHashes]) -> AuditReport:
+        """
+        Audit every set against the scanned files.
+        """
+        report = AuditReport(setType=self.setType, results=list(results))
+        with metrics.timer(name='audit'):
+            setsByName = self.__expected__(report=report)
+            found = self.__join__(results=report.results)
+            self.__locate__(report=report, setsByName=setsByName)
+            self.__classify__(report=report, found=found)
+        report.finished = time.perf_counter()
+        metrics.count(name='audited', value=len(report.entries))
+        if thisLogger is not None and \
+                thisLogger.isEnabledFor(LOG_LEVELS['debug']): # summary is slow
+            _tryLogger_(log=f'Audit completed: {report}', level='debug')
+        return report
+
+    def __expected__(self, report: AuditReport) -> dict[str, int]:
+        """
+        List the entries of every set, return the set positions by the name
+        of their archive or folder.
+        """
+        setsByName: dict[str, int] = {}
+        entries, rows, starts = report.entries, report.rows, report.starts
+        for game, contents in self.graph.sets(setType=self.setType):
+            setsByName[safeName(name=game.name)] = len(report.games)
+            report.games.append(game)
+            if contents:
+                names, numbers = zip(*contents)
+                entries.extend(names)
+                rows.extend(numbers)
+            starts.append(len(entries))
+        count = len(report.entries)
+        report.statuses = array('B', bytes([MISSING])) * count
+        report.sources = array('i', [-1]) * count
+        return setsByName
+
+    def __join__(self, results: list[FileHashes]) -> array:
+        """
+        Return, for every RomTable row, the position in results of a file
+        holding its dump, -1 for none.
+        """
+        table = self.graph.gameSet.roms
+        if numpy is None:
+            found = array('i', [-1]) * len(table)
+            for position, result in enumerate(results):
+                rows: tuple[int, ...] = ()
+                if result.sha1 is not None:
+                    rows = self.index.rows(sha1=result.sha1)
+                if not rows and result.crc is not None:
+                    rows = self.index.rows(size=result.size, crc=result.crc)
+                for row in rows:
+                    if found[row] < 0:
+                        found[row] = position
+            return found
+        flags = numpy.frombuffer(table.flags, dtype=numpy.uint8)
+        sizes = numpy.frombuffer(table.sizes, dtype=numpy.uint64)
+        crcs = numpy.frombuffer(table.crcs, dtype=numpy.uint32)
+        scanCrcs = numpy.array([-1 if result.crc is None else result.crc
+                                for result in results], dtype=numpy.int64)
+        hashed = scanCrcs >= 0
+        positions = numpy.flatnonzero(hashed).astype(numpy.int32)
+        scanSizes = numpy.array([result.size for result in results],
+                                dtype=numpy.uint64)[hashed]
+        scanCrcs = scanCrcs[hashed].astype(numpy.uint64)
+        # sizes are ranked among the scanned ones so that rank and CRC fit a
+        # key whatever the size, sizes not scanned are told apart below
+        scanned = numpy.unique(scanSizes)
+        ranks = numpy.searchsorted(scanned, sizes).astype(numpy.uint64)
+        keys = ranks << numpy.uint64(32) | crcs.astype(numpy.uint64)
+        scanKeys = numpy.searchsorted(scanned, scanSizes).astype(
+            numpy.uint64) << numpy.uint64(32) | scanCrcs
+        order = numpy.argsort(scanKeys, kind='stable')
+        scanKeys = scanKeys[order]
+        found = numpy.full(len(table), -1, dtype=numpy.int32)
+        if len(scanKeys):
+            # searching sorted keys walks both sides in order, a merge join
+            queries = numpy.argsort(keys)
+            hits = numpy.empty(len(keys), dtype=numpy.intp)
+            hits[queries] = numpy.searchsorted(scanKeys, keys[queries])
+            numpy.minimum(hits, len(scanKeys) - 1, out=hits)
+            matched = (scanKeys[hits] == keys) & \
+                (scanSizes[order][hits] == sizes) & \
+                (flags & (HAS_SIZE | HAS_CRC) == HAS_SIZE | HAS_CRC)
+            found[matched] = positions[order][hits[matched]]
+        if numpy.any(flags & (HAS_SIZE | HAS_CRC) != HAS_SIZE | HAS_CRC):
+            for position, result in enumerate(results): # SHA1 only ROMs
+                if result.sha1 is not None:
+                    for row in self.index.rows(sha1=result.sha1):
+                        if found[row] < 0:
+                            found[row] = position
+        return array('i', found.tobytes())
+
+    def __locate__(self, report: AuditReport, setsByName: dict[str, int]
+                   ) -> None:
+        """
+        Mark entries having a file at their place as there or bad. Files of
+        a same archive or folder resolve their set once, the entries of a set
+        are indexed by name the first time one of its files is found and the
+        contents of every file found at its place are then compared at once.
+        """
+        if self.romset is None:
+            _tryLogger_(log='No romset folder, no ROM can be in its set',
+                        level='debug')
+            return
+        results = report.results
+        folders: dict[str, tuple[str, ...] | None] = {}
+        containers: dict[str, tuple[int, str] | None] = {}
+        places: dict[int, dict[str, int]] = {} # set -> entry name -> entry
+        located = array('i', [-1]) * len(results) # result -> entry
+        last: str | None = None
+        place: tuple[int, str] | None = None
+        names: dict[str, int] | None = None
+        prefix = ''
+        for position, result in enumerate(results):
+            if result.member is not None:
+                container, name = result.path, result.member
+            else:
+                container, _, name = result.path.rpartition(os.sep)
+            if container != last: # members of an archive come together
+                last = container
+                try:
+                    place = containers[container]
+                except KeyError:
+                    place = containers[container] = self.__place__(
+                        container=container, archive=result.member is not None,
+                        setsByName=setsByName, folders=folders)
+                names = None
+                if place is not None and place[0] >= 0:
+                    names = self.__names__(report=report, found=place[0],
+                                           places=places)
+                    prefix = place[1]
+            if names is not None:
+                located[position] = names.get(prefix + name, -1)
+            elif place is not None: # loose in the romset folder, one file sets
+                found = setsByName.get(_stem_(name=name), -1)
+                if found >= 0:
+                    located[position] = self.__names__(
+                        report=report, found=found, places=places).get(name, -1)
+        self.__compare__(report=report, located=located)
+
+    def __names__(self, report: AuditReport, found: int,
+                  places: dict[int, dict[str, int]]) -> dict[str, int]:
+        """
+        Return the entries of the set at position found by name, the first
+        entry of a name winning.
+        """
+        names = places.get(found)
+        if names is None:
+            entries, starts = report.entries, report.starts
+            names = places[found] = {
+                entries[at]: at for at in
+                range(starts[found + 1] - 1, starts[found] - 1, -1)}
+        return names
+
+    def __place__(self, container: str, archive: bool,
+                  setsByName: dict[str, int],
+                  folders: dict[str, tuple[str, ...] | None]
+                  ) -> tuple[int, str] | None:
+        """
+        Return the set of files in container, as (set position, prefix of
+        their entry names), -1 for the romset folder itself where the set
+        goes by file name, None when they cannot be in a set.
+        """
+        if archive:
+            folder, _, name = container.rpartition(os.sep)
+            if self.__parts__(folder=folder, folders=folders) != ():
+                return None
+            found = setsByName.get(_stem_(name=name))
+            return None if found is None else (found, '')
+        parts = self.__parts__(folder=container, folders=folders)
+        if parts is None:
+            return None
+        if not parts:
+            return -1, ''
+        found = setsByName.get(parts[0])
+        return None if found is None else \
+            (found, ''.join(f'{part}/' for part in parts[1:]))
+
+    def __parts__(self, folder: str, folders: dict[str, tuple[str, ...] | None]
+                  ) -> tuple[str, ...] | None:
+        """
+        Return the components of folder below the romset folder, None when
+        outside, from the parent folder when already known.
+        """
+        try:
+            return folders[folder]
+        except KeyError:
+            pass
+        parent, _, name = folder.rpartition(os.sep)
+        normal = name not in ('', os.curdir, os.pardir)
+        up = folders.get(parent) if normal else None
+        if up is not None:
+            parts: tuple[str, ...] | None = up + (name,)
+        else:
+            try:
+                relative = os.path.relpath(os.path.abspath(folder or os.sep),
+                                           self.romset)
+            except ValueError: # another drive
+                relative = os.pardir
+            parts = None if relative.split(os.sep)[0] == os.pardir else () \
+                if relative == os.curdir else tuple(relative.split(os.sep))
+            if parts and normal: # its siblings resolve from the parent
+                folders.setdefault(parent, parts[:-1])
+        folders[folder] = parts
+        return parts
+
+    def __compare__(self, report: AuditReport, located: array) -> None:
+        """
+        Mark every located entry there when one of its files has its dump,
+        the first one being its source, and bad otherwise, the last file
+        found being its source.
+        """
+        table = self.graph.gameSet.roms
+        results = report.results
+        if numpy is not None and len(located):
+            where = numpy.flatnonzero(numpy.frombuffer(
+                located, dtype=numpy.int32) >= 0).astype(numpy.int32)
+            at = numpy.frombuffer(located, dtype=numpy.int32)[where]
+            rows = numpy.frombuffer(report.rows, dtype=numpy.uint32)[at]
+            files = [results[position] for position in where.tolist()]
+            scanCrcs = numpy.array([-1 if result.crc is None else result.crc
+                                    for result in files], dtype=numpy.int64)
+            scanSizes = numpy.array([result.size for result in files],
+                                    dtype=numpy.uint64)
+            flags = numpy.frombuffer(table.flags, dtype=numpy.uint8)[rows]
+            crcs = flags & (HAS_SIZE | HAS_CRC) == HAS_SIZE | HAS_CRC
+            crcs &= scanCrcs >= 0
+            same = crcs & (numpy.frombuffer(table.sizes, dtype=numpy.uint64)[
+                rows] == scanSizes) & (numpy.frombuffer(
+                    table.crcs, dtype=numpy.uint32)[rows] == scanCrcs)
+            for pair in numpy.flatnonzero(~crcs).tolist(): # SHA1 only ROMs
+                sha1 = files[pair].sha1
+                same[pair] = bool(flags[pair] & HAS_SHA1) and \
+                    sha1 is not None and \
+                    table.sha1(index=int(rows[pair])) == sha1
+            statuses = numpy.frombuffer(report.statuses,
+                                        dtype=numpy.uint8).copy()
+            sources = numpy.frombuffer(report.sources, dtype=numpy.int32).copy()
+            # bad first from the last file, then there from the first one
+            reverse = slice(None, None, -1)
+            entries, last = numpy.unique(at[reverse], return_index=True)
+            statuses[entries] = BAD
+            sources[entries] = where[reverse][last]
+            entries, first = numpy.unique(at[same], return_index=True)
+            statuses[entries] = HAVE
+            sources[entries] = where[same][first]
+            report.statuses = array('B', statuses.tobytes())
+            report.sources = array('i', sources.tobytes())
+            return
+        sizes, crcs, flags = table.sizes, table.crcs, table.flags
+        statuses = report.statuses
+        for position, at in enumerate(located):
+            if at < 0 or statuses[at] == HAVE:
+                continue
+            result = results[position]
+            row = report.rows[at]
+            if flags[row] & HAS_SIZE and flags[row] & HAS_CRC and \
+                    result.crc is not None:
+                same = sizes[row] == result.size and crcs[row] == result.crc
+            else:
+                same = flags[row] & HAS_SHA1 and result.sha1 is not None and \
+                    table.sha1(index=row) == result.sha1
+            statuses[at] = HAVE if same else BAD
+            report.sources[at] = position
+
+    def __classify__(self, report: AuditReport, found: array) -> None:
+        """
+        Tell the remaining entries apart: no dump known, dump found
+        elsewhere or missing.
+        """
+        table = self.graph.gameSet.roms
+        nodumps = {row for row, extra in table.extras.items()
+                   if extra.get('status') == 'nodump'}
+        if numpy is not None and len(report.entries):
+            rows = numpy.frombuffer(report.rows, dtype=numpy.uint32)
+            statuses = numpy.frombuffer(report.statuses,
+                                        dtype=numpy.uint8).copy()
+            sources = numpy.frombuffer(report.sources, dtype=numpy.int32).copy()
+            flags = numpy.frombuffer(table.flags, dtype=numpy.uint8)[rows]
+            nodump = flags & HASHES == 0
+            if nodumps:
+                nodump |= numpy.isin(rows, numpy.fromiter(
+                    nodumps, dtype=numpy.uint32, count=len(nodumps)))
+            elsewhere = numpy.frombuffer(found, dtype=numpy.int32)[rows]
+            missing = statuses == MISSING
+            statuses[missing & nodump] = NODUMP
+            wrong = missing & ~nodump & (elsewhere >= 0)
+            statuses[wrong] = WRONG_NAME
+            sources[wrong] = elsewhere[wrong]
+            report.statuses = array('B', statuses.tobytes())
+            report.sources = array('i', sources.tobytes())
+            return
+        flags = table.flags
+        statuses = report.statuses
+        for entry, row in enumerate(report.rows):
+            if statuses[entry] != MISSING:
+                continue
+            if not flags[row] & HASHES or row in nodumps:
+                statuses[entry] = NODUMP
+            elif found[row] >= 0:
+                statuses[entry] = WRONG_NAME
+                report.sources[entry] = found[row]
+
+def _tryLogger_(log: Any, level: Literal['debug', 'info', 'warning', 'error',
+                'critical'] = 'debug') -> None:
+    if thisLogger is not None:
+        number = LOG_LEVELS[level]
+        if thisLogger.isEnabledFor(number): # nothing else when filtered out
+            thisLogger.name = __name__
+            thisLogger.log(number, log)
+    else:
+        print(f'Error writing log, continuing with simple print\n{log}')
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+# Time and memory benchmark of romix, phase by phase: descriptor parse, game
+# conversion, hash index and relationship graph over the descriptors in DAT/
+# (or synthetic MAME-scale ones), then scanning of a synthetic feed tree with
+# the thread and asyncio engines. Every case runs in a fresh process so peak
+# RSS is not polluted by the previous ones; results can be saved as JSON to
+# compare versions.
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from typing import IO, Any
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+datFolder: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'DAT')
+
+def _peakRss_() -> int:
+    """
+    Return the peak resident set size of this process in KiB, 0 if unknown.
+    """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == 'Darwin':
+        peak //= 1024 # macOS reports bytes
+    return peak
+
+def _quietLogger_() -> logging.Logger:
+    quiet = logging.getLogger(name='benchmark')
+    quiet.addHandler(hdlr=logging.NullHandler())
+    quiet.propagate = False
+    return quiet
+
+class Phase():
+    """
+    Context manager measuring one phase: wall time, growth of the peak RSS
+    and, when tracemalloc is tracing, peak and retained Python allocations.
+    """
+    def __init__(self, results: dict[str, dict[str, Any]], name: str) -> None:
+        self.results = results
+        self.name = name
+
+    def __enter__(self) -> 'Phase':
+        self.rss = _peakRss_()
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            self.traced = tracemalloc.get_traced_memory()[0]
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        result: dict[str, Any] = {'seconds': time.perf_counter() - self.started,
+                                  'rss': _peakRss_() - self.rss}
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            result['allocated'] = (peak - self.traced) // 1024 # KiB
+            result['retained'] = (current - self.traced) // 1024
+        self.results[self.name] = result
+
+def runCase(path: str, streaming: bool, allocations: bool) -> dict[str, Any]:
+    """
+    Load a descriptor and run every model phase on it.
+    """
+    from detector import openDescriptor
+    from romset import Romset
+    if allocations:
+        tracemalloc.start()
+    phases: dict[str, dict[str, Any]] = {}
+    case: dict[str, Any] = {'dat': os.path.basename(path),
+                            'mode': 'stream' if streaming else 'tree',
+                            'phases': phases}
+    try:
+        with openDescriptor(path=path) as file:
+            with Phase(results=phases, name='parse'):
+                romset = Romset(descriptor=file, logger=_quietLogger_(),
+                                streaming=streaming)
+            with Phase(results=phases, name='convert'):
+                case['games'] = sum(1 for _ in romset.iterGames())
+            with Phase(results=phases, name='index'):
+                index = romset.index
+            case['roms'] = len(index.gameSet.roms)
+            with Phase(results=phases, name='relations'):
+                romset.relations
+    except SystemExit:
+        case['error'] = 'unsupported descriptor'
+    return case
+
+def runScan(folder: str, engine: str, allocations: bool) -> dict[str, Any]:
+    """
+    Hash a feed tree with the thread ('scan') or asyncio ('aio') engine.
+    """
+    from pipeline import AsyncScanner
+    from scanner import Scanner
+    if allocations:
+        tracemalloc.start()
+    logger = _quietLogger_()
+    scanner = AsyncScanner(logger=logger) if engine == 'aio' \
+        else Scanner(logger=logger)
+    phases: dict[str, dict[str, Any]] = {}
+    with Phase(results=phases, name='scan'):
+        files = sum(1 for _ in scanner.scan(folders=[folder], recursive=True))
+    return {'feed': folder, 'mode': engine, 'files': files,
+            'bytes': scanner.stats.bytes, 'phases': phases}
+
+def generateDat(file: IO[str], games: int = 45000, roms: int = 10,
+                bioses: int = 50, clones: float = 0.6, seed: int = 0) -> None:
+    """
+    Write a synthetic Logiqx descriptor shaped like a MAME one: BIOS sets,
+    parents using them through romof and clones merging part of their
+    parent ROMs, every ROM with size, CRC32 and SHA1.
+    """
+    randomizer = random.Random(seed)
+    def rom(name: str) -> tuple[str, str]:
+        size = randomizer.choice((1024, 2048, 65536, 131072, 524288,
+                                  1048576, 2097152, 4194304))
+        sha1 = randomizer.getrandbits(160)
+        attributes = (f' size="{size}" crc="{randomizer.getrandbits(32):08x}"'
+                      f' sha1="{sha1:040x}"')
+        return name, attributes
+    def write(name: str, extra: str, entries: list[tuple[str, str, str]]
+              ) -> None:
+        file.write(f'\t<game name="{name}"{extra}>\n'
+                   f'\t\t<description>{name} (synthetic)</description>\n'
+                   f'\t\t<year>{randomizer.randint(1975, 2010)}</year>\n'
+                   f'\t\t<manufacturer>Maker {randomizer.randint(1, 200)}'
+                   '</manufacturer>\n')
+        for entry, merge, attributes in entries:
+            merged = f' merge="{merge}"' if merge else ''
+            file.write(f'\t\t<rom name="{entry}"{merged}{attributes}/>\n')
+        file.write('\t</game>\n')
+    file.write('<?xml version="1.0"?>\n<!DOCTYPE datafile PUBLIC '
+               '"-//Logiqx//DTD ROM Management Datafile//EN" '
+               '"http://www.logiqx.com/Dats/datafile.dtd">\n<datafile>\n'
+               '\t<header>\n\t\t<name>Synthetic MAME-scale set</name>\n'
+               f'\t\t<description>{games} games</description>\n'
+               '\t</header>\n')
+    biosRoms: dict[str, list[tuple[str, str]]] = {}
+    for number in range(min(bioses, games)):
+        name = f'bios{number}'
+        biosRoms[name] = [rom(name=f'{name}_{i}.bin') for i in range(2)]
+        write(name=name, extra=' isbios="yes"',
+              entries=[(n, '', a) for n, a in biosRoms[name]])
+    parents: list[tuple[str, str | None, list[tuple[str, str, str]]]] = []
+    for number in range(games - len(biosRoms)):
+        name = f'game{number}'
+        if not parents or randomizer.random() >= clones:
+            bios = randomizer.choice(list(biosRoms)) if biosRoms and \
+                randomizer.random() < 0.3 else None
+            entries = [(n, n, a) for n, a in biosRoms[bios]] if bios else []
+            entries += [(n, '', a) for n, a in
+                        (rom(name=f'{name}_{i}.bin') for i in range(roms))]
+            parents.append((name, bios, entries))
+            write(name=name, extra=f' romof="{bios}"' if bios else '',
+                  entries=entries)
+            continue
+        parent, bios, inherited = randomizer.choice(parents)
+        entries = [(n, n, a) for n, _, a in inherited
+                   if randomizer.random() < 0.7]
+        entries += [(n, '', a) for n, a in
+                    (rom(name=f'{name}_{i}.bin') for i in range(roms // 3))]
+        write(name=name, extra=f' cloneof="{parent}" romof="{parent}"',
+              entries=entries)
+    file.write('</datafile>\n')
+
+def generateFeed(folder: str, files: int = 1000, size: int = 64 * 1024,
+                 fanout: int = 16, archives: float = 0.2, seed: int = 0
+                 ) -> None:
+    """
+    Fill folder with files of random content, about size bytes each, spread
+    over fanout subfolders two levels deep; a share of them are zips of
+    three members.
+    """
+    randomizer = random.Random(seed)
+    for number in range(files):
+        branch = os.path.join(folder, f'{number % fanout:02x}',
+                              f'{number // fanout % fanout:02x}')
+        os.makedirs(name=branch, exist_ok=True)
+        length = max(1, int(size * randomizer.uniform(0.5, 1.5)))
+        if randomizer.random() < archives:
+            with zipfile.ZipFile(file=os.path.join(branch, f'{number}.zip'),
+                                 mode='w', compression=zipfile.ZIP_DEFLATED,
+                                 compresslevel=1) as archive:
+                for member in range(3):
+                    archive.writestr(f'{member}.bin',
+                                     randomizer.randbytes(length // 3 or 1))
+        else:
+            with open(file=os.path.join(branch, f'{number}.bin'),
+                      mode='wb') as output:
+                output.write(randomizer.randbytes(length))
+
+def _isolated_(function: Any, *args: Any) -> dict[str, Any]:
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes=1) as pool:
+        return pool.apply(function, args)
+
+def _print_(case: dict[str, Any]) -> None:
+    label = case.get('dat') or f'feed {case.get("files", 0)} files'
+    if 'error' in case:
+        print(f'{label:<28}{case["mode"]:<8} {case["error"]}')
+        return
+    for name, phase in case['phases'].items():
+        allocated = phase.get('allocated', '')
+        print(f'{label:<28}{case["mode"]:<8}{name:<10}'
+              f'{phase["seconds"]:>9.3f}{phase["rss"]:>10}{allocated:>12}')
+        label = ''
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Romix phases benchmark')
+    parser.add_argument('dats', metavar='file', nargs='*',
+                        help=f'descriptors to load (default: all in {datFolder})')
+    parser.add_argument('-m', '--mode', choices=('tree', 'stream', 'both'),
+                        default='both', help='descriptor loading mode')
+    parser.add_argument('-s', '--synthetic', metavar='games', type=int,
+                        help='add a synthetic MAME-scale descriptor with this '
+                        'many games')
+    parser.add_argument('-f', '--feed', metavar='files', type=int, default=0,
+                        help='scan a synthetic feed tree of this many files')
+    parser.add_argument('--feed-size', metavar='KiB', type=int, default=64,
+                        help='average size of the feed files (default: 64)')
+    parser.add_argument('-a', '--allocations', action='store_true',
+                        help='trace Python allocations with tracemalloc, '
+                        'which slows every phase down')
+    parser.add_argument('-j', '--json', metavar='file',
+                        help='write the results to this JSON file')
+    parser.add_argument('-g', '--generate', metavar='file',
+                        help='only write a synthetic descriptor (with '
+                        '--synthetic games) to file and exit')
+    args = parser.parse_args()
+    if args.generate:
+        with open(file=args.generate, mode='w', encoding='utf-8') as file:
+            generateDat(file=file, games=args.synthetic or 45000)
+        return
+    dats = args.dats or sorted(os.path.join(datFolder, name)
+                               for name in os.listdir(datFolder))
+    modes = (False, True) if args.mode == 'both' else (args.mode == 'stream',)
+    results: dict[str, Any] = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'allocations': args.allocations,
+        'cases': []
+    }
+    print(f'{"case":<28}{"mode":<8}{"phase":<10}{"seconds":>9}'
+          f'{"rss KiB":>10}{"alloc KiB":>12}')
+    with tempfile.TemporaryDirectory(prefix='romix-bench-') as temporary:
+        if args.synthetic:
+            synthetic = os.path.join(temporary, f'synthetic-{args.synthetic}.dat')
+            with open(file=synthetic, mode='w', encoding='utf-8') as file:
+                generateDat(file=file, games=args.synthetic)
+            dats.append(synthetic)
+        for path in dats:
+            for streaming in modes:
+                case = _isolated_(runCase, path, streaming, args.allocations)
+                results['cases'].append(case)
+                _print_(case=case)
+        if args.feed:
+            feed = os.path.join(temporary, 'feed')
+            generateFeed(folder=feed, files=args.feed,
+                         size=args.feed_size * 1024)
+            for engine in ('scan', 'aio'):
+                case = _isolated_(runScan, feed, engine, args.allocations)
+                case['feed'] = f'{args.feed} files of {args.feed_size} KiB'
+                results['cases'].append(case)
+                _print_(case=case)
+    if args.json:
+        with open(file=args.json, mode='w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+        print(f'Results written to {args.json}', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
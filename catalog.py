@@ -0,0 +1,226 @@
+# This module manages many descriptors at once: every DAT is compiled in
+# parallel into the descriptor cache, then loaded as a Romset and merged into a
+# single hash index tagging each dump with the system it belongs to, so one
+# scan pass can sort files into every system romset.
+
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from logging import Logger
+from typing import Any, Iterable, Literal, Optional
+
+from detector import openDescriptor
+from metrics import LOG_LEVELS
+from model import RomIndex
+from rebuilder import safeName
+from romset import Romset
+
+thisLogger: Logger | None = None
+
+def _loggerName_(logger: Optional['Logger']) -> str | None:
+    """
+    Return the name a logger is registered with: _tryLogger_ renames it on
+    every call, and loggers are pickled by name.
+    """
+    if logger is None:
+        return None
+    for name, registered in logging.Logger.manager.loggerDict.items():
+        if registered is logger:
+            return name
+    return logger.name
+
+def _open_(path: str, cacheDir: str, streaming: bool,
+           logger: Optional['Logger']) -> Romset | str:
+    """
+    Load a descriptor, return the Romset or why it cannot be parsed.
+    """
+    try:
+        with openDescriptor(path=path) as file:
+            return Romset(descriptor=file, logger=logger, streaming=streaming,
+                          cacheDir=cacheDir)
+    except SystemExit: # Romset gives up on unparsable descriptors
+        return 'syntax error'
+    except Exception as e: # one bad descriptor must not stop the others
+        return f'{type(e).__name__}: {e}'
+
+def _compile_(path: str, cacheDir: str, streaming: bool,
+              loggerName: str | None) -> str | None:
+    """
+    Parse a descriptor in a worker process, leaving its model in cacheDir.
+    Return None when done, why it failed otherwise.
+    """
+    logger = None if loggerName is None else logging.getLogger(loggerName)
+    romset = _open_(path=path, cacheDir=cacheDir, streaming=streaming,
+                    logger=logger)
+    return romset if isinstance(romset, str) else None
+
+class CatalogIndex():
+    """
+    Hash lookup indexes merged across every system of a Catalog. Values pack
+    the system number and its RomTable row as system << 32 | row, a bare int
+    for a single owner or a list when more rows share the dump.
+    """
+    __slots__ = ('systems', 'indexes', 'crcs', 'sha1s', 'md5s', 'sizes')
+
+    def __init__(self, systems: list[str], indexes: list[RomIndex]) -> None:
+        self.systems = systems
+        self.indexes = indexes
+        self.crcs: dict[int, int | list[int]] = {}
+        self.sha1s: dict[bytes, int | list[int]] = {}
+        self.md5s: dict[bytes, int | list[int]] = {}
+        sizes: set[int] | None = set()
+        for system, index in enumerate(indexes):
+            for merged, source in ((self.crcs, index.crcs),
+                                   (self.sha1s, index.sha1s),
+                                   (self.md5s, index.md5s)):
+                _merge_(merged=merged, source=source, system=system)
+            if sizes is not None and index.sizes is not None:
+                sizes.update(index.sizes)
+            else:
+                sizes = None
+        self.sizes: frozenset[int] | None = None if sizes is None \
+            else frozenset(sizes)
+
+    def __resolve__(self, entries: int | list[int] | None
+                    ) -> tuple[tuple[str, str, str], ...]:
+        if entries is None:
+            return ()
+        if isinstance(entries, int):
+            entries = [entries]
+        found = []
+        for entry in entries:
+            system, row = entry >> 32, entry & 0xFFFFFFFF
+            index = self.indexes[system]
+            found.append((self.systems[system], index.game(row=row).name,
+                          index.gameSet.roms.names[row]))
+        return tuple(found)
+
+    def byCrc(self, size: int, crc: int) -> tuple[tuple[str, str, str], ...]:
+        """
+        Return every (system, game name, rom name) using the dump of given
+        size and CRC32.
+        """
+        return self.__resolve__(entries=self.crcs.get(size << 32 | crc))
+
+    def bySha1(self, sha1: bytes) -> tuple[tuple[str, str, str], ...]:
+        return self.__resolve__(entries=self.sha1s.get(sha1))
+
+    def byMd5(self, md5: bytes) -> tuple[tuple[str, str, str], ...]:
+        return self.__resolve__(entries=self.md5s.get(md5))
+
+def _merge_(merged: dict, source: dict, system: int) -> None:
+    tag = system << 32
+    for key, rows in source.items():
+        if isinstance(rows, int):
+            rows = [rows]
+        found = merged.get(key)
+        if found is None:
+            if len(rows) == 1:
+                merged[key] = tag | rows[0]
+            else:
+                merged[key] = [tag | row for row in rows]
+        elif isinstance(found, int):
+            merged[key] = [found] + [tag | row for row in rows]
+        else:
+            found.extend(tag | row for row in rows)
+
+class Catalog():
+    """
+    Collection of romsets loaded together, one per system.
+    """
+    def __init__(self, paths: Iterable[str], cacheDir: Optional[str] = None,
+                 workers: Optional[int] = None, streaming: bool = False,
+                 logger: Optional['Logger'] = None) -> None:
+        """
+        Constructor of the class.
+
+        Arguments:
+        - paths (Iterable[str]): Descriptor files to load.
+        - cacheDir (str): Folder of the pre-compiled descriptor cache, a
+          temporary one is used when not given.
+        - workers (int): Descriptors parsed in parallel, all cores by default.
+        - streaming (bool): Parse descriptors in streaming mode.
+        """
+        global thisLogger
+        thisLogger = logger
+        self.paths = list(paths)
+        self.workers = workers or os.cpu_count() or 1
+        self.streaming = streaming
+        self.romsets: dict[str, Romset] = {}
+        self.__index__: CatalogIndex | None = None
+        if cacheDir is not None:
+            self.__load__(cacheDir=cacheDir)
+        else:
+            with tempfile.TemporaryDirectory(prefix='romix-') as temporary:
+                self.__load__(cacheDir=temporary)
+
+    def __load__(self, cacheDir: str) -> None:
+        """
+        Compile every descriptor in parallel, then load them from the cache
+        in the main process, which takes milliseconds each.
+        """
+        workers = min(self.workers, len(self.paths)) or 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            errors = list(executor.map(_compile_, self.paths,
+                                       repeat(cacheDir),
+                                       repeat(self.streaming),
+                                       repeat(_loggerName_(logger=thisLogger))))
+        for path, error in zip(self.paths, errors):
+            if error is None:
+                romset = _open_(path=path, cacheDir=cacheDir,
+                                streaming=self.streaming, logger=thisLogger)
+                error = romset if isinstance(romset, str) else None
+            if error is not None:
+                _tryLogger_(log=f'Skipping {path}, it cannot be parsed '
+                            f'({error})', level='error')
+                continue
+            system = self.__systemName__(romset=romset, path=path)
+            self.romsets[system] = romset
+            _tryLogger_('%s: %d games loaded', system, len(romset.model),
+                        level='info')
+
+    def __systemName__(self, romset: Romset, path: str) -> str:
+        """
+        Name the system after the descriptor header, made safe as a folder
+        and file name like the rebuilt sets.
+        """
+        name = romset.header.get('name', {}).get('text') or \
+            os.path.splitext(os.path.basename(path))[0]
+        name = safeName(name=name)
+        if name in self.romsets: # same system from two descriptors
+            name = safeName(name=f'{name} ({os.path.basename(path)})')
+        return name
+
+    def __len__(self) -> int:
+        return len(self.romsets)
+
+    @property
+    def index(self) -> CatalogIndex:
+        """
+        Merged hash index of every system, built once on first access.
+        """
+        if self.__index__ is None:
+            self.__index__ = CatalogIndex(
+                systems=list(self.romsets.keys()),
+                indexes=[romset.index for romset in self.romsets.values()])
+            _tryLogger_('Catalog index built: %d size+crc, %d sha1 keys over '
+                        '%d systems', len(self.__index__.crcs),
+                        len(self.__index__.sha1s), len(self.romsets),
+                        level='debug')
+        return self.__index__
+
+def _tryLogger_(log: Any, *args: Any, level: Literal['debug', 'info', 'warning',
+                'error', 'critical'] = 'debug') -> None:
+    """
+    Log a message, args being %-formatted into it only when it is emitted.
+    """
+    if thisLogger is not None:
+        number = LOG_LEVELS[level]
+        if thisLogger.isEnabledFor(number): # nothing else when filtered out
+            thisLogger.name = __name__
+            thisLogger.log(number, log, *args)
+    else:
+        print('Error writing log, continuing with simple print\n' +
+              (str(log) % args if args else str(log)))
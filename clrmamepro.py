@@ -0,0 +1,183 @@
+# This module reads ClrMamePro text descriptors, the format older than Logiqx
+# XML still shipped by many DAT sources:
+#
+#     clrmamepro ( name "Set" version 2021-04-16 )
+#     game ( name "x" cloneof "y" rom ( name x.bin size 1024 crc 89abcdef ) )
+#
+# A tokenizer built on str.split reads them a chunk of lines at a time and
+# every top level block is turned into the lxml element the equivalent Logiqx
+# XML would give (<header>, <game> with name/cloneof/romof as attributes, <rom>
+# with its fields as attributes...), so Romset loads both formats with the same
+# code and memory stays flat as in XML streaming mode.
+
+from logging import Logger
+from typing import IO, Any, Iterator, Literal, Optional
+
+from lxml import etree
+
+from metrics import LOG_LEVELS
+
+thisLogger: Logger | None = None
+
+HEADER: str = 'clrmamepro'
+# Blocks read as games, resource is the old name of BIOS sets
+GAMES: dict[str, dict[str, str]] = {
+    'game': {},
+    'machine': {},
+    'resource': {'isbios': 'yes'}
+}
+# Game fields that are attributes in Logiqx XML, the others are subelements
+ATTRIBUTES: frozenset[str] = frozenset(('name', 'id', 'cloneof', 'cloneofid',
+                                        'romof', 'sampleof', 'isbios',
+                                        'isdevice', 'ismechanical', 'runnable',
+                                        'sourcefile', 'board', 'rebuildto'))
+RENAMED: dict[str, str] = {'flags': 'status'} # rom field -> XML attribute
+
+CHUNK_SIZE: int = 1024 * 1024 # read at a time, cut at the last line end
+
+Block = list[tuple[str, 'str | Block']]
+
+def chunks(source: IO) -> Iterator[str]:
+    """
+    Read a descriptor in big chunks of whole lines, quoted strings never
+    span lines in this format so no chunk starts within one.
+    """
+    rest: str | bytes = ''
+    while True:
+        block = source.read(CHUNK_SIZE)
+        if not block:
+            break
+        block = rest + block if rest else block
+        end = block.rfind(b'\n' if isinstance(block, bytes) else '\n') + 1
+        rest = block[end:]
+        if end:
+            yield _decode_(block[:end])
+    if rest:
+        yield _decode_(rest)
+
+def _decode_(text: str | bytes) -> str:
+    if isinstance(text, bytes):
+        return text.decode('utf-8', errors='replace')
+    return text
+
+def blocks(source: IO) -> Iterator[tuple[str, Block]]:
+    """
+    Yield the (name, contents) top level blocks of a descriptor, contents
+    being lists of key value pairs where nested blocks are lists again.
+    Chunks are split on quotes first, odd parts being quoted strings, and
+    the others on whitespace around parentheses: plain str methods and an
+    explicit stack keep this the fast path of the format.
+    """
+    stack: list[Block] = [] # blocks being read
+    names: list[str] = [] # and their names
+    key: str | None = None # waiting for its value
+    for chunk in chunks(source=source):
+        quoted = True
+        for part in chunk.split('"'):
+            quoted = not quoted
+            if quoted:
+                if key is None:
+                    key = part
+                elif stack:
+                    stack[-1].append((key, part))
+                    key = None
+                else:
+                    raise SyntaxError(f'Top level block expected, found {key}')
+                continue
+            for word in part.replace('(', ' ( ').replace(')', ' ) ').split():
+                if word == '(':
+                    if key is None:
+                        raise SyntaxError('Block without a name')
+                    stack.append([])
+                    names.append(key)
+                    key = None
+                elif word == ')':
+                    if key is not None or not stack:
+                        raise SyntaxError(f'Unexpected ) after {key}')
+                    block = stack.pop()
+                    if stack:
+                        stack[-1].append((names.pop(), block))
+                    else:
+                        yield names.pop(), block
+                elif key is None:
+                    key = word
+                elif stack:
+                    stack[-1].append((key, word))
+                    key = None
+                else:
+                    raise SyntaxError(f'Top level block expected, found {key}')
+    if stack or key is not None:
+        raise SyntaxError('Unexpected end of descriptor')
+
+def toHeader(block: Block) -> etree._Element:
+    header = etree.Element('header')
+    for key, value in block:
+        child = etree.SubElement(header, key)
+        if isinstance(value, str):
+            child.text = value
+        else:
+            for name, field in value:
+                if isinstance(field, str):
+                    child.set(name, field)
+    return header
+
+def toGame(block: Block, extra: dict[str, str] | None = None
+           ) -> etree._Element:
+    """
+    Build the <game> element of a game block.
+    """
+    game = etree.Element('game')
+    for key, value in block:
+        if isinstance(value, str):
+            if key in ATTRIBUTES:
+                game.set(key, value)
+            else:
+                etree.SubElement(game, key).text = value
+        else:
+            etree.SubElement(game, key, {RENAMED.get(name, name): field
+                                         for name, field in value
+                                         if isinstance(field, str)})
+    for key, value in (extra or {}).items():
+        game.set(key, value)
+    return game
+
+def iterElements(source: IO, logger: Optional['Logger'] = None
+                 ) -> Iterator[etree._Element]:
+    """
+    Stream a descriptor from its start yielding the <header> element first,
+    when there is one, and then one <game> element at a time.
+    """
+    global thisLogger
+    thisLogger = logger or thisLogger
+    source.seek(0)
+    for name, block in blocks(source=source):
+        if name == HEADER:
+            yield toHeader(block=block)
+        elif name in GAMES:
+            yield toGame(block=block, extra=GAMES[name])
+        else:
+            _tryLogger_(log=f'Skipping unknown {name} block', level='debug')
+
+def readHeader(source: IO) -> etree._Element | None:
+    """
+    Return the header element of a descriptor reading only its first block,
+    None when it starts with a game.
+    """
+    elements = iterElements(source=source)
+    try:
+        element = next(elements, None)
+    finally:
+        elements.close()
+    if element is None or element.tag != 'header':
+        return None
+    return element
+
+def _tryLogger_(log: Any, level: Literal['debug', 'info', 'warning', 'error',
+                'critical'] = 'debug') -> None:
+    if thisLogger is not None:
+        number = LOG_LEVELS[level]
+        if thisLogger.isEnabledFor(number): # nothing else when filtered out
+            thisLogger.name = __name__
+            thisLogger.log(number, log)
+    else:
+        print(f'Error writing log, continuing with simple print\n{log}')
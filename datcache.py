@@ -0,0 +1,165 @@
+# This module stores the parsed model of a DAT descriptor, together with its
+# hash indexes, in a compact binary file named after the DAT content hash.
+# Loading it back is a handful of memory copies from a memory-mapped file
+# instead of a full XML parse, any change to the DAT changes its hash and so
+# simply misses the cache.
+#
+# File layout: MAGIC, FORMAT_VERSION and the Python version (marshal is not
+# portable across versions) followed by length prefixed blobs, see BLOBS.
+
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+import sys
+from array import array
+from logging import Logger
+from typing import IO, Any, Literal
+
+from metrics import LOG_LEVELS
+from model import Game, GameSet, RomIndex, RomTable
+
+thisLogger: Logger | None = None
+
+MAGIC: bytes = b'RMXD'
+FORMAT_VERSION: int = 1
+EXTENSION: str = '.rmxd'
+_prologue_ = struct.Struct('<4sIBB')
+_length_ = struct.Struct('<Q')
+
+# Blob order: marshal encoded ones first, then the raw columns
+BLOBS: tuple[str, ...] = ('meta', 'games', 'names', 'extras', 'index',
+                          'sizes', 'crcs', 'flags', 'md5s', 'sha1s', 'owners')
+
+def contentHash(descriptor: IO) -> str:
+    """
+    Return the SHA1 hex digest of a descriptor content, leaving it rewound.
+    """
+    source = getattr(descriptor, 'buffer', descriptor)
+    source.seek(0)
+    digest = hashlib.sha1()
+    while True:
+        block = source.read(1024 * 1024)
+        if not block:
+            break
+        digest.update(block if isinstance(block, bytes) else block.encode())
+    source.seek(0)
+    return digest.hexdigest()
+
+def cachePath(folder: str, digest: str) -> str:
+    return os.path.join(folder, digest + EXTENSION)
+
+def save(path: str, meta: dict[str, Any], gameSet: GameSet,
+         index: RomIndex, logger: Logger | None = None) -> None:
+    """
+    Write a model and its indexes, atomically so concurrent runs never see
+    half written files.
+    """
+    global thisLogger
+    thisLogger = logger
+    table = gameSet.roms
+    blobs = {
+        'meta': marshal.dumps(meta),
+        'games': marshal.dumps([(g.name, g.category, g.attributes,
+                                 g.description, g.year, g.manufacturer,
+                                 g.extra, g.start, g.stop)
+                                for g in gameSet.games]),
+        'names': marshal.dumps(table.names),
+        'extras': marshal.dumps(table.extras),
+        'index': marshal.dumps((index.crcs, index.sha1s, index.md5s,
+                                None if index.sizes is None
+                                else tuple(index.sizes))),
+        'sizes': table.sizes.tobytes(),
+        'crcs': table.crcs.tobytes(),
+        'flags': table.flags.tobytes(),
+        'md5s': bytes(table.md5s),
+        'sha1s': bytes(table.sha1s),
+        'owners': index.owners.tobytes()
+    }
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(file=temporary, mode='wb') as file:
+        file.write(_prologue_.pack(MAGIC, FORMAT_VERSION,
+                                   sys.version_info.major,
+                                   sys.version_info.minor))
+        for name in BLOBS:
+            file.write(_length_.pack(len(blobs[name])))
+            file.write(blobs[name])
+    os.replace(temporary, path)
+    _tryLogger_(log=f'Descriptor cache written to {path}', level='debug')
+
+def load(path: str, logger: Logger | None = None
+         ) -> tuple[dict[str, Any], GameSet, RomIndex] | None:
+    """
+    Load a model and its indexes, None if the file is missing, corrupted or
+    was written by another format or Python version.
+    """
+    global thisLogger
+    thisLogger = logger
+    try:
+        with open(file=path, mode='rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                magic, version, major, minor = _prologue_.unpack_from(mapped, 0)
+                if (magic != MAGIC or version != FORMAT_VERSION or
+                        (major, minor) != sys.version_info[:2]):
+                    _tryLogger_(log=f'Descriptor cache {path} is outdated',
+                                level='debug')
+                    return None
+                offset = _prologue_.size
+                view = memoryview(mapped)
+                blobs: dict[str, memoryview] = {}
+                try:
+                    for name in BLOBS:
+                        (length,) = _length_.unpack_from(mapped, offset)
+                        offset += _length_.size
+                        if offset + length > len(mapped): # slices never fail
+                            raise ValueError(f'{name} is truncated')
+                        blobs[name] = view[offset:offset + length]
+                        offset += length
+                    return _build_(blobs=blobs)
+                finally: # mmap cannot be closed while views are exported
+                    for blob in blobs.values():
+                        blob.release()
+                    view.release()
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, EOFError, TypeError, struct.error) as e:
+        _tryLogger_(log=f'Cannot read descriptor cache {path}: {e}',
+                    level='warning')
+        return None
+
+def _build_(blobs: dict[str, memoryview]
+            ) -> tuple[dict[str, Any], GameSet, RomIndex]:
+    meta = marshal.loads(blobs['meta'])
+    gameSet = GameSet()
+    table = gameSet.roms
+    table.names = marshal.loads(blobs['names'])
+    table.extras = marshal.loads(blobs['extras'])
+    table.sizes.frombytes(blobs['sizes'])
+    table.crcs.frombytes(blobs['crcs'])
+    table.flags.frombytes(blobs['flags'])
+    table.md5s = bytearray(blobs['md5s'])
+    table.sha1s = bytearray(blobs['sha1s'])
+    for (name, category, attributes, description, year, manufacturer, extra,
+         start, stop) in marshal.loads(blobs['games']):
+        gameSet.add(game=Game(name=name, category=category,
+                              attributes=attributes, table=table, start=start,
+                              stop=stop, description=description, year=year,
+                              manufacturer=manufacturer, extra=extra))
+    index = RomIndex.__new__(RomIndex)
+    index.gameSet = gameSet
+    index.owners = array('I')
+    index.owners.frombytes(blobs['owners'])
+    index.crcs, index.sha1s, index.md5s, sizes = marshal.loads(blobs['index'])
+    index.sizes = None if sizes is None else frozenset(sizes)
+    return meta, gameSet, index
+
+def _tryLogger_(log: Any, level: Literal['debug', 'info', 'warning', 'error',
+                'critical'] = 'debug') -> None:
+    if thisLogger is not None:
+        number = LOG_LEVELS[level]
+        if thisLogger.isEnabledFor(number): # nothing else when filtered out
+            thisLogger.name = __name__
+            thisLogger.log(number, log)
+    else:
+        print(f'Error writing log, continuing with simple print\n{log}')
@@ -0,0 +1,524 @@
+# This module finds the dumps stored more than once across feed folders, the
+# same content under another name, in another folder or inside a zip archive,
+# and reclaims the space they take. Candidates are narrowed in stages so most
+# files are barely read: files are grouped by size from the directory listing
+# alone, then by the SHA1 of their first bytes, and only the groups still
+# ambiguous are read whole for their SHA1. Duplicate files can then be
+# replaced by hard links to a single copy, or moved out of the feed folders
+# into a content addressed store (store/ab/abcdef...) which later scans read
+# once instead of once per copy.
+
+import errno
+import hashlib
+import os
+import time
+import zipfile
+from concurrent.futures import Executor, ThreadPoolExecutor
+from logging import Logger
+from typing import (TYPE_CHECKING, Any, Callable, Hashable, Iterable, Literal,
+                    Optional)
+
+from metrics import LOG_LEVELS, metrics
+from rebuilder import cloneFile
+from scanner import (DEFAULT_CHUNK_SIZE, READ_ERRORS, FileHashes, hashFile,
+                     hashStream, isArchive, walkFolders)
+
+if TYPE_CHECKING:
+    from hashcache import HashCache
+
+thisLogger: Logger | None = None
+
+PARTIAL_SIZE: int = 64 * 1024 # bytes first read from files sharing a size
+MANIFEST: str = 'manifest.tsv' # sha1, size and original path of stored files
+
+class Copy():
+    """
+    One copy of a content, a file or a zip member when member is set. Its
+    digest is the partial SHA1 first, then the full one.
+    """
+    __slots__ = ('path', 'member', 'size', 'stat', 'digest')
+
+    def __init__(self, path: str, size: int, stat: os.stat_result | None
+                 = None, member: str | None = None) -> None:
+        self.path = path
+        self.member = member
+        self.size = size
+        self.stat = stat
+        self.digest: bytes | None = None
+
+    def __repr__(self) -> str:
+        return f'Copy({self.name!r}, size={self.size})'
+
+    @property
+    def name(self) -> str:
+        """
+        Printable location, archive/member for archive members.
+        """
+        if self.member is None:
+            return self.path
+        return os.path.join(self.path, self.member)
+
+class DuplicateGroup():
+    """
+    Copies of the same content, files first in listing order, then zip
+    members; only files are linked or moved.
+    """
+    __slots__ = ('sha1', 'size', 'copies')
+
+    def __init__(self, sha1: bytes, size: int, copies: list[Copy]) -> None:
+        self.sha1 = sha1
+        self.size = size
+        self.copies = sorted(copies, key=lambda copy: copy.member is not None)
+
+    def __repr__(self) -> str:
+        return (f'DuplicateGroup({self.sha1.hex()}, size={self.size}, '
+                f'copies={len(self.copies)})')
+
+    @property
+    def files(self) -> list[Copy]:
+        return [copy for copy in self.copies if copy.member is None]
+
+    @property
+    def members(self) -> list[Copy]:
+        return [copy for copy in self.copies if copy.member is not None]
+
+    @property
+    def reclaimable(self) -> int:
+        """
+        Bytes taken by the files beyond the first one.
+        """
+        return self.size * max(len(self.files) - 1, 0)
+
+class DedupStats():
+    """
+    Counters of a duplicate search, sameSize and samePartial tell how many
+    copies every stage left.
+    """
+    __slots__ = ('files', 'members', 'linked', 'sameSize', 'samePartial',
+                 'partialBytes', 'fullBytes', 'cached', 'groups',
+                 'duplicates', 'reclaimable', 'started', 'finished')
+
+    def __init__(self) -> None:
+        self.files: int = 0
+        self.members: int = 0 # zip members compared
+        self.linked: int = 0 # files already hard links of a listed one
+        self.sameSize: int = 0 # copies sharing their size with another
+        self.samePartial: int = 0 # and their first bytes
+        self.partialBytes: int = 0
+        self.fullBytes: int = 0
+        self.cached: int = 0 # full SHA1 served by the hash cache
+        self.groups: int = 0
+        self.duplicates: int = 0 # files beyond the first of every group
+        self.reclaimable: int = 0
+        self.started: float = time.perf_counter()
+        self.finished: float | None = None
+
+    @property
+    def elapsed(self) -> float:
+        end = self.finished if self.finished is not None else time.perf_counter()
+        return max(end - self.started, 1e-9)
+
+    def __str__(self) -> str:
+        megabytes = 1024 * 1024
+        report = (f'{self.files} files and {self.members} archive members, '
+                  f'{self.sameSize} of a shared size, {self.samePartial} '
+                  f'with the same first bytes; {self.groups} contents stored '
+                  f'more than once, {self.duplicates} duplicate files, '
+                  f'{self.reclaimable / megabytes:.1f} MB reclaimable; '
+                  f'{self.partialBytes / megabytes:.1f} MB read partially and '
+                  f'{self.fullBytes / megabytes:.1f} MB fully in '
+                  f'{self.elapsed:.2f}s')
+        if self.cached:
+            report += f', {self.cached} files from cache'
+        if self.linked:
+            report += f', {self.linked} files already hard linked'
+        return report
+
+def _members_(path: str) -> list[tuple[str, int]]:
+    """
+    List the (name, size) members of a zip archive from its headers.
+    """
+    try:
+        with zipfile.ZipFile(file=path, mode='r') as archive:
+            return [(info.filename, info.file_size) for info in
+                    archive.infolist() if not info.is_dir() and info.file_size]
+    except (OSError, zipfile.BadZipFile) as e:
+        _tryLogger_(log=f'Cannot list archive {path}: {e}', level='warning')
+        return []
+
+def _partials_(path: str, members: list[str | None], limit: int
+               ) -> list[bytes | None]:
+    """
+    Return the SHA1 of the first limit bytes of a file, members being
+    [None], or of the given members of a zip archive, opened once for all.
+    None stands for what cannot be read.
+    """
+    try:
+        if members == [None]:
+            with open(file=path, mode='rb') as file: # reads whole blocks
+                return [hashlib.sha1(file.read(limit)).digest()]
+        digests: list[bytes | None] = []
+        with zipfile.ZipFile(file=path, mode='r') as archive:
+            for member in members:
+                try:
+                    with archive.open(name=member, mode='r') as stream: # type: ignore
+                        digests.append(hashlib.sha1(stream.read(limit)).digest())
+                except READ_ERRORS as e:
+                    _tryLogger_(log=f'Cannot read {member} in {path}: {e}',
+                                level='warning')
+                    digests.append(None)
+        return digests
+    except READ_ERRORS as e:
+        _tryLogger_(log=f'Cannot read {path}: {e}', level='warning')
+        return [None] * len(members)
+
+def _fullHashes_(path: str, members: list[str | None], chunkSize: int,
+                 algorithms: tuple[Literal['crc', 'md5', 'sha1'], ...]
+                 ) -> list[FileHashes | None]:
+    """
+    Hash a whole file, members being [None], or zip members like _partials_.
+    """
+    try:
+        if members == [None]:
+            return [hashFile(path=path, chunkSize=chunkSize,
+                             algorithms=algorithms)]
+        results: list[FileHashes | None] = []
+        with zipfile.ZipFile(file=path, mode='r') as archive:
+            for member in members:
+                try:
+                    with archive.open(name=member, mode='r') as stream: # type: ignore
+                        size, _, _, sha1 = hashStream(
+                            stream=stream, chunkSize=chunkSize,
+                            algorithms=('sha1',))
+                    results.append(FileHashes(path=path, size=size, sha1=sha1,
+                                              member=member))
+                except READ_ERRORS as e:
+                    _tryLogger_(log=f'Cannot read {member} in {path}: {e}',
+                                level='warning')
+                    results.append(None)
+        return results
+    except READ_ERRORS as e:
+        _tryLogger_(log=f'Cannot read {path}: {e}', level='warning')
+        return [None] * len(members)
+
+def _split_(copies: Iterable[Copy], key: Callable[[Copy], Hashable | None]
+            ) -> list[list[Copy]]:
+    """
+    Group copies by key keeping the groups of more than one, in order;
+    copies whose key is None are dropped.
+    """
+    groups: dict[Hashable, list[Copy]] = {}
+    for copy in copies:
+        value = key(copy)
+        if value is not None:
+            groups.setdefault(value, []).append(copy)
+    return [group for group in groups.values() if len(group) > 1]
+
+def _current_(copy: Copy) -> os.stat_result | None:
+    """
+    Return the stat of a file when it did not change since it was listed.
+    """
+    try:
+        stat = os.stat(copy.path, follow_symlinks=False)
+    except OSError:
+        return None
+    listed = copy.stat
+    if listed is None or (stat.st_dev, stat.st_ino, stat.st_size,
+                          stat.st_mtime_ns) != (listed.st_dev, listed.st_ino,
+                                                listed.st_size,
+                                                listed.st_mtime_ns):
+        _tryLogger_(log=f'{copy.path} changed since it was compared, left '
+                    'as it is', level='warning')
+        return None
+    return stat
+
+def _move_(source: str, target: str) -> None:
+    """
+    Move a file, copying it when target is on another device.
+    """
+    try:
+        os.replace(source, target)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    temporary = f'{target}.{os.getpid()}.tmp'
+    try:
+        cloneFile(source=source, target=temporary)
+        os.replace(temporary, target)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    os.remove(source)
+
+class Deduplicator():
+    """
+    Staged duplicate finder over feed folders: size, partial SHA1, full SHA1.
+    """
+    def __init__(self, workers: Optional[int] = None, chunkSize: int
+                 = DEFAULT_CHUNK_SIZE, partialSize: int = PARTIAL_SIZE,
+                 archives: bool = True, cache: Optional['HashCache'] = None,
+                 logger: Optional['Logger'] = None) -> None:
+        """
+        Constructor of the class.
+
+        Arguments:
+        - workers (int): Parallel reading threads, all cores by default.
+        - chunkSize (int): Size of every read when hashing whole files.
+        - partialSize (int): Bytes read from every file sharing its size with
+          another one; files up to this size are then known entirely.
+        - archives (bool): Compare zip members too, they are reported with
+          their group but never linked nor moved.
+        - cache (HashCache): Persistent hash cache, files hashed by a
+          previous scan are not read whole again, and those read whole are
+          stored for the next scan.
+        """
+        global thisLogger
+        thisLogger = logger
+        self.workers = workers or os.cpu_count() or 1
+        self.chunkSize = chunkSize
+        self.partialSize = partialSize
+        self.archives = archives
+        self.cache = cache
+        self.stats = DedupStats()
+
+    def __list__(self, folders: Iterable[str], recursive: bool,
+                 executor: Executor) -> list[Copy]:
+        """
+        List files, once per inode, and the members of zip archives.
+        """
+        copies: list[Copy] = []
+        inodes: set[tuple[int, int]] = set()
+        archives: list[str] = []
+        for path, stat in metrics.timed(name='walk', items=walkFolders(
+                folders=folders, recursive=recursive)):
+            if not stat.st_size: # every empty file is alike
+                continue
+            inode = (stat.st_dev, stat.st_ino)
+            if inode in inodes:
+                self.stats.linked += 1
+                continue
+            inodes.add(inode)
+            copies.append(Copy(path=path, size=stat.st_size, stat=stat))
+            if self.archives and path.lower().endswith('.zip'):
+                archives.append(path)
+        self.stats.files = len(copies)
+        for path, members in zip(archives, executor.map(_members_, archives)):
+            copies.extend(Copy(path=path, size=size, member=member)
+                          for member, size in members)
+            self.stats.members += len(members)
+        return copies
+
+    def __cached__(self, copy: Copy) -> bytes | None:
+        if self.cache is None or copy.stat is None or isArchive(copy.path):
+            return None
+        cached = self.cache.get(path=copy.path, stat=copy.stat)
+        if not cached or cached[0].member is not None:
+            return None
+        return cached[0].sha1
+
+    def __read__(self, copies: list[Copy], executor: Executor, partial: bool
+                 ) -> None:
+        """
+        Set the partial or full digest of copies, reading files in parallel
+        and every archive once for all its members.
+        """
+        batches: dict[tuple[str, bool], list[Copy]] = {}
+        for copy in copies:
+            if not partial:
+                sha1 = self.__cached__(copy=copy)
+                if sha1 is not None:
+                    copy.digest = sha1
+                    self.stats.cached += 1
+                    continue
+            batches.setdefault((copy.path, copy.member is None), []).append(copy)
+        members = [[copy.member for copy in batch] for batch in batches.values()]
+        paths = [path for path, _ in batches]
+        if partial:
+            jobs = executor.map(_partials_, paths, members,
+                                [self.partialSize] * len(paths))
+        else:
+            # all the digests when they go into the hash cache
+            algorithms: tuple[Literal['crc', 'md5', 'sha1'], ...] = \
+                ('sha1',) if self.cache is None else ('crc', 'md5', 'sha1')
+            jobs = executor.map(_fullHashes_, paths, members,
+                                [self.chunkSize] * len(paths),
+                                [algorithms] * len(paths))
+        for batch, results in zip(batches.values(), jobs):
+            for copy, result in zip(batch, results):
+                if partial:
+                    copy.digest = result
+                    self.stats.partialBytes += min(copy.size, self.partialSize)
+                    continue
+                copy.digest = None if result is None else result.sha1
+                if result is None:
+                    continue
+                self.stats.fullBytes += result.size
+                if result.size != copy.size: # changed while being compared
+                    copy.digest = None
+                elif self.cache is not None and copy.stat is not None and \
+                        not isArchive(copy.path):
+                    self.cache.put(path=copy.path, stat=copy.stat,
+                                   results=[result])
+
+    def find(self, folders: Iterable[str], recursive: bool = False
+             ) -> list[DuplicateGroup]:
+        """
+        Return the groups of identical copies found in folders, the largest
+        reclaimable first.
+        """
+        self.stats = DedupStats()
+        with ThreadPoolExecutor(max_workers=self.workers,
+                                thread_name_prefix='romix-dedup') as executor:
+            copies = self.__list__(folders=folders, recursive=recursive,
+                                   executor=executor)
+            candidates = _split_(copies=copies, key=lambda copy: copy.size)
+            self.stats.sameSize = sum(len(group) for group in candidates)
+            with metrics.timer(name='partial'):
+                self.__read__(copies=[copy for group in candidates
+                                      for copy in group],
+                              executor=executor, partial=True)
+            candidates = [group for sized in candidates for group in
+                          _split_(copies=sized, key=lambda copy: copy.digest)]
+            self.stats.samePartial = sum(len(group) for group in candidates)
+            with metrics.timer(name='full hash'):
+                # the first bytes of small files are all of them
+                self.__read__(copies=[copy for group in candidates
+                                      if group[0].size > self.partialSize
+                                      for copy in group],
+                              executor=executor, partial=False)
+            candidates = [group for partials in candidates for group in
+                          _split_(copies=partials, key=lambda copy: copy.digest)]
+        groups = [DuplicateGroup(sha1=group[0].digest, size=group[0].size, # type: ignore
+                                 copies=group) for group in candidates]
+        groups.sort(key=lambda group: group.reclaimable, reverse=True)
+        self.stats.groups = len(groups)
+        self.stats.duplicates = sum(max(len(group.files) - 1, 0)
+                                    for group in groups)
+        self.stats.reclaimable = sum(group.reclaimable for group in groups)
+        self.stats.finished = time.perf_counter()
+        metrics.count(name='duplicates', value=self.stats.duplicates)
+        metrics.count(name='bytes dup', value=self.stats.reclaimable)
+        _tryLogger_('Duplicate search completed: %s', self.stats,
+                    level='debug')
+        return groups
+
+    def link(self, groups: Iterable[DuplicateGroup]) -> int:
+        """
+        Replace every duplicate file by a hard link to the first file of its
+        group on the same device, atomically, and return the bytes reclaimed.
+        """
+        reclaimed = 0
+        with metrics.timer(name='link'):
+            for group in groups:
+                keepers: dict[int, str] = {} # device -> kept file
+                for copy in group.files:
+                    stat = _current_(copy=copy)
+                    if stat is None:
+                        continue
+                    keeper = keepers.setdefault(stat.st_dev, copy.path)
+                    if keeper == copy.path:
+                        continue
+                    temporary = f'{copy.path}.{os.getpid()}.tmp'
+                    try:
+                        os.link(keeper, temporary)
+                        os.replace(temporary, copy.path)
+                    except OSError as e:
+                        if os.path.lexists(temporary):
+                            os.remove(temporary)
+                        _tryLogger_(log=f'Cannot link {copy.path} to {keeper}'
+                                    f': {e}', level='warning')
+                        continue
+                    if stat.st_nlink == 1: # else another name keeps it
+                        reclaimed += group.size
+                    _tryLogger_('%s linked to %s', copy.path, keeper,
+                                level='debug')
+        return reclaimed
+
+    def __holds__(self, path: str, group: DuplicateGroup) -> bool:
+        """
+        Tell if a store object holds the content of group, read whole.
+        """
+        try:
+            if os.path.getsize(path) == group.size and hashFile(
+                    path=path, chunkSize=self.chunkSize,
+                    algorithms=('sha1',)).sha1 == group.sha1:
+                return True
+        except OSError as e:
+            _tryLogger_(log=f'Cannot read {path}: {e}', level='warning')
+        _tryLogger_(log=f'{path} does not hold its content, replaced',
+                    level='warning')
+        return False
+
+    def store(self, groups: Iterable[DuplicateGroup], folder: str) -> int:
+        """
+        Move the files of every group out of the feed folders into a content
+        addressed store, keeping one object named after their SHA1, and
+        append their original paths to the store manifest. Return the bytes
+        reclaimed; files already inside the store are left alone, and so are
+        groups with a single file on disk, whose other copies are archive
+        members or hard links. Objects already stored are read whole and
+        replaced by a copy unless they hold the content.
+        """
+        reclaimed = 0
+        root = os.path.join(os.path.abspath(folder), '')
+        os.makedirs(name=folder, exist_ok=True)
+        with metrics.timer(name='store'), open(
+                file=os.path.join(folder, MANIFEST), mode='a',
+                encoding='utf-8') as manifest:
+            for group in groups:
+                current = [(copy, stat) for copy in group.files
+                           for stat in (_current_(copy=copy),)
+                           if stat is not None]
+                if len({(stat.st_dev, stat.st_ino) for _, stat in current}) < 2:
+                    _tryLogger_('%s: a single file on disk, left in place',
+                                group.sha1.hex(), level='debug')
+                    continue
+                files = [(copy, stat) for copy, stat in current
+                         if not os.path.abspath(copy.path).startswith(root)]
+                if not files:
+                    continue
+                digest = group.sha1.hex()
+                target = os.path.join(folder, digest[:2], digest)
+                if os.path.exists(target) and self.__holds__(path=target,
+                                                             group=group):
+                    kept = None # every file is a copy of the object
+                else: # a missing, stale or partly written object
+                    os.makedirs(name=os.path.dirname(target), exist_ok=True)
+                    try:
+                        _move_(source=files[0][0].path, target=target)
+                    except OSError as e:
+                        _tryLogger_(log=f'Cannot move {files[0][0].path} to '
+                                    f'{target}: {e}', level='warning')
+                        continue
+                    kept = files[0][0]
+                for copy, stat in files:
+                    if copy is not kept:
+                        try:
+                            os.remove(copy.path)
+                        except OSError as e:
+                            _tryLogger_(log=f'Cannot remove {copy.path}: {e}',
+                                        level='warning')
+                            continue
+                        if stat.st_nlink == 1:
+                            reclaimed += group.size
+                    manifest.write(f'{digest}\t{group.size}\t'
+                                   f'{os.path.abspath(copy.path)}\n')
+                    _tryLogger_('%s stored as %s', copy.path, target,
+                                level='debug')
+        return reclaimed
+
+def _tryLogger_(log: Any, *args: Any, level: Literal['debug', 'info', 'warning',
+                'error', 'critical'] = 'debug') -> None:
+    """
+    Log a message, args being %-formatted into it only when it is emitted.
+    """
+    if thisLogger is not None:
+        number = LOG_LEVELS[level]
+        if thisLogger.isEnabledFor(number): # nothing else when filtered out
+            thisLogger.name = __name__
+            thisLogger.log(number, log, *args)
+    else:
+        print('Error writing log, continuing with simple print\n' +
+              (str(log) % args if args else str(log)))
@@ -0,0 +1,269 @@
+# This module tells which kind of descriptor a file is by reading only its
+# first kilobytes: the DOCTYPE and the <header> element are fed to an
+# incremental lxml parser, which stops as soon as the header is complete, and
+# the schema (no-intro, finalburn, mame or logiqx) is weighed from them. The
+# result picks the loader used by Romset and makes listing and validating a
+# whole folder of descriptors take milliseconds instead of full parses.
+#
+# ClrMamePro text descriptors are recognized too, their header block is read
+# with the clrmamepro tokenizer, and gzip, xz or zip compressed descriptors are
+# opened as decompressing streams, told apart by their magic bytes.
+
+import gzip
+import lzma
+import os
+import re
+import zipfile
+from logging import Logger
+from typing import IO, Any, Literal, Optional
+
+from lxml import etree
+
+import clrmamepro
+from metrics import LOG_LEVELS
+
+thisLogger: Logger | None = None
+
+# Tags of the game elements of every schema, see Romset.nodeTags
+NODE_TAGS: dict[str, list[str]] = {
+    'no-intro': ['game'],
+    'finalburn': ['game'],
+    'mame': ['game', 'machine'],
+    'logiqx': ['game', 'machine']
+}
+ISSUERS: tuple[str, ...] = ('logiqx', 'no-intro') # words searched in doc info
+BLOCK_SIZE: int = 16 * 1024 # read at a time until the header is complete
+MAX_PREFIX: int = 1024 * 1024 # give up on headers beyond this
+EXTENSIONS: tuple[str, ...] = ('.dat', '.xml', '.zip', '.gz', '.xz')
+MAGIC: dict[bytes, str] = {
+    b'\x1f\x8b': 'gzip',
+    b'\xfd7zXZ\x00': 'xz',
+    b'PK\x03\x04': 'zip'
+}
+
+_block_ = re.compile(rb'[A-Za-z_]+\s*\(') # first ClrMamePro block
+
+class DatInfo():
+    """
+    What the prefix of a descriptor tells about it.
+    """
+    __slots__ = ('path', 'format', 'compression', 'schema', 'header',
+                 'docInfo', 'error')
+
+    def __init__(self, path: str | None = None) -> None:
+        self.path = path
+        self.format: Literal['xml', 'clrmamepro'] | None = None
+        self.compression: str | None = None
+        self.schema: str | None = None
+        self.header: dict[str, dict[str, Any]] = {}
+        self.docInfo: dict[str, Any] = {}
+        self.error: str | None = None
+
+    def __repr__(self) -> str:
+        return (f'DatInfo({self.path!r}, format={self.format}, '
+                f'schema={self.schema}, error={self.error!r})')
+
+    @property
+    def name(self) -> str | None:
+        return self.header.get('name', {}).get('text')
+
+    @property
+    def valid(self) -> bool:
+        """
+        True when the descriptor can be loaded by Romset.
+        """
+        return self.error is None and self.schema is not None
+
+def docInfoDict(docInfo: etree.DocInfo) -> dict[str, Any]:
+    """
+    Return the DOCTYPE data of a parsed document as a dictionary.
+    """
+    return {name: getattr(docInfo, name) for name in docInfo.__dir__()
+            if not name.startswith('__')}
+
+def headerDict(header: etree._Element) -> dict[str, dict[str, Any]]:
+    """
+    Return the header subelements as {tag: {'text': ..., 'attributes': ...}}.
+    """
+    data: dict[str, dict[str, Any]] = {}
+    for element in header:
+        data[element.tag] = {}
+        if element.text is not None:
+            data[element.tag]['text'] = element.text
+        if len(element.attrib) != 0:
+            data[element.tag]['attributes'] = dict(element.attrib)
+    return data
+
+def getWeight(issuer: str | None, hasId: bool, noteHead: str | None
+              ) -> str | None:
+    """
+    Weigh what has been found in DOC info and header to choose the schema;
+    header noteheads win over the DOC type issuer. Return None when nothing
+    is recognized.
+    """
+    if noteHead is not None:
+        return noteHead
+    if hasId or issuer == 'no-intro':
+        return 'no-intro'
+    if issuer == 'logiqx':
+        return 'logiqx'
+    return None
+
+def schemaOf(docInfo: dict[str, Any], header: dict[str, dict[str, Any]]
+             ) -> str | None:
+    """
+    Detect the schema of a descriptor from its DOCTYPE data and header.
+    """
+    issuer: str | None = None # If found in the doc info
+    for info, value in docInfo.items():
+        if isinstance(value, str):
+            issuer = next((i for i in ISSUERS if i in value.lower()), None)
+            if issuer is not None:
+                _tryLogger_(log=f'DOC Type seems like {issuer} - found in '
+                            f'"{info}" DOC Info tag', level='debug')
+                break
+    else:
+        _tryLogger_(log='Unknow xml DOC Type', level='debug')
+    hasId = 'id' in header # If header has ID field
+    noteHead: str | None = None # If found in the header
+    for element, value in header.items(): # some "unique" notehead
+        text = value.get('text', '').lower()
+        noteHead = next((n for n in NODE_TAGS if n in text), None)
+        if noteHead is not None:
+            _tryLogger_(log=f'Header seems like {noteHead} - found in '
+                        f'"{element}" header tag', level='debug')
+            break
+    return getWeight(issuer=issuer, hasId=hasId, noteHead=noteHead)
+
+def sniff(descriptor: IO, path: Optional[str] = None,
+          limit: int = MAX_PREFIX, logger: Optional['Logger'] = None
+          ) -> DatInfo:
+    """
+    Detect a descriptor from its first bytes, reading no further than the
+    end of its header, and leave it rewound.
+    """
+    global thisLogger
+    thisLogger = logger or thisLogger
+    info = DatInfo(path=path or getattr(descriptor, 'name', None))
+    source = getattr(descriptor, 'buffer', descriptor)
+    source.seek(0)
+    try:
+        block = source.read(BLOCK_SIZE)
+        if isinstance(block, str):
+            block = block.encode('utf-8')
+        start = block.lstrip(b'\xef\xbb\xbf \t\r\n')
+        if _block_.match(start):
+            info.format = 'clrmamepro'
+            header = clrmamepro.readHeader(source=source)
+            if header is not None:
+                info.header = headerDict(header=header)
+            # the format has no DOCTYPE and is the Logiqx ancestor
+            info.schema = schemaOf(docInfo={}, header=info.header) or 'logiqx'
+            return info
+        info.format = 'xml'
+        parser = etree.XMLPullParser(events=('start', 'end'),
+                                     tag=('header', 'game', 'machine'),
+                                     remove_blank_text=True)
+        read = 0
+        while block:
+            parser.feed(block)
+            read += len(block)
+            for event, element in parser.read_events():
+                if event == 'start' and element.tag != 'header':
+                    info.error = 'No header found'
+                    return info
+                if event == 'end' and element.tag == 'header':
+                    info.docInfo = docInfoDict(
+                        docInfo=element.getroottree().docinfo)
+                    info.header = headerDict(header=element)
+                    if not info.header:
+                        info.error = 'Empty header'
+                        return info
+                    info.schema = schemaOf(docInfo=info.docInfo,
+                                           header=info.header)
+                    if info.schema is None:
+                        info.error = 'Descriptor is of unknow type'
+                    return info
+            if read >= limit:
+                info.error = f'No header in the first {limit} bytes'
+                return info
+            block = source.read(BLOCK_SIZE)
+        info.error = 'No header found'
+        return info
+    except SyntaxError as e: # lxml errors included
+        info.error = f'Syntax error: {e}'
+        return info
+    finally:
+        descriptor.seek(0)
+
+def compressionOf(path: str) -> str | None:
+    """
+    Return gzip, xz or zip for compressed files, None for plain ones.
+    """
+    with open(file=path, mode='rb') as file:
+        start = file.read(6)
+    return next((kind for magic, kind in MAGIC.items()
+                 if start.startswith(magic)), None)
+
+def openDescriptor(path: str) -> IO[bytes]:
+    """
+    Open a descriptor as a seekable binary stream, decompressing it on the
+    fly when compressed; from a zip the first .dat or .xml member is read,
+    or the first member when there is none.
+    """
+    compression = compressionOf(path=path)
+    if compression == 'gzip':
+        return gzip.open(filename=path, mode='rb')
+    if compression == 'xz':
+        return lzma.open(filename=path, mode='rb')
+    if compression == 'zip':
+        with zipfile.ZipFile(file=path) as archive:
+            members = [member for member in archive.infolist()
+                       if not member.is_dir()]
+            if not members:
+                raise FileNotFoundError(f'No descriptor found in {path}')
+            member = next((member for member in members if os.path.splitext(
+                member.filename)[1].lower() in ('.dat', '.xml')), members[0])
+            return archive.open(name=member) # keeps the file open
+    return open(file=path, mode='rb')
+
+def detect(path: str, logger: Optional['Logger'] = None) -> DatInfo:
+    """
+    Detect the descriptor at path, compressed or not, see sniff.
+    """
+    global thisLogger
+    thisLogger = logger
+    try:
+        with openDescriptor(path=path) as file:
+            info = sniff(descriptor=file, path=path, logger=logger)
+        info.compression = compressionOf(path=path)
+        return info
+    except (OSError, EOFError, zipfile.BadZipFile, lzma.LZMAError) as e:
+        info = DatInfo(path=path)
+        info.error = str(e)
+        return info
+
+def listFolder(folder: str, recursive: bool = False,
+               logger: Optional['Logger'] = None) -> list[DatInfo]:
+    """
+    Detect every descriptor file in folder, valid or not, sorted by path.
+    """
+    found: list[DatInfo] = []
+    for root, folders, files in os.walk(folder):
+        for name in files:
+            if os.path.splitext(name)[1].lower() in EXTENSIONS:
+                found.append(detect(path=os.path.join(root, name),
+                                    logger=logger))
+        if not recursive:
+            break
+    return sorted(found, key=lambda info: info.path or '')
+
+def _tryLogger_(log: Any, level: Literal['debug', 'info', 'warning', 'error',
+                'critical'] = 'debug') -> None:
+    if thisLogger is not None:
+        number = LOG_LEVELS[level]
+        if thisLogger.isEnabledFor(number): # nothing else when filtered out
+            thisLogger.name = __name__
+            thisLogger.log(number, log)
+    else:
+        print(f'Error writing log, continuing with simple print\n{log}')
@@ -0,0 +1,221 @@
+# This module keeps a persistent SQLite cache of file hashes, so unchanged
+# files are not read again on the next scan. Entries are keyed by device,
+# inode, size and modification time: any change to a file, or a new file at
+# the same path, misses the cache and gets hashed again.
+#
+# Several runs may share the file: lookups never write, new entries and last
+# used stamps are committed in short batches, so the write lock is held for
+# milliseconds, and a database that stays locked or broken disables the
+# cache for the run instead of aborting the scan.
+
+import os
+import sqlite3
+import time
+from logging import Logger
+from typing import Any, Iterable, Literal, Optional
+
+from metrics import LOG_LEVELS
+from scanner import FileHashes
+
+thisLogger: Logger | None = None
+
+SCHEMA_VERSION: int = 1
+DEFAULT_MAX_ENTRIES: int = 2_000_000
+BATCH_ROWS: int = 1000 # pending entries committed at once
+BATCH_SECONDS: float = 2.0 # at most this old when committed
+LOCK_TIMEOUT: float = 10.0 # waiting for another run to commit
+
+class HashCache():
+    """
+    On-disk file hash cache with least recently used eviction.
+    """
+    def __init__(self, path: str, maxEntries: int = DEFAULT_MAX_ENTRIES,
+                 rehash: bool = False, logger: Optional['Logger'] = None
+                 ) -> None:
+        """
+        Constructor of the class.
+
+        Arguments:
+        - path (str): SQLite database file, created if missing.
+        - maxEntries (int): Entries kept on close, the least recently used
+          ones are evicted first.
+        - rehash (bool): Never trust cached values, every file is hashed
+          again and its entry refreshed.
+        """
+        global thisLogger
+        thisLogger = logger
+        self.path = path
+        self.maxEntries = maxEntries
+        self.rehash = rehash
+        self.stamp = time.time_ns() # marks entries used by this run
+        self.pending: list[tuple] = [] # rows waiting for the next commit
+        self.stale: list[tuple[int, int]] = [] # (device, inode) replaced
+        self.used: list[tuple[int, int, int]] = [] # (stamp, device, inode) hit
+        self.committed = time.perf_counter()
+        self.connection: sqlite3.Connection | None = None
+        try:
+            # autocommit, write transactions are opened by __commit__ only
+            self.connection = sqlite3.connect(database=path,
+                                              timeout=LOCK_TIMEOUT,
+                                              isolation_level=None)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS hashes (device INTEGER, inode '
+                'INTEGER, member TEXT, path TEXT, size INTEGER, mtime INTEGER, '
+                'length INTEGER, crc INTEGER, md5 BLOB, sha1 BLOB, used '
+                'INTEGER, PRIMARY KEY (device, inode, member))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS hashes_used '
+                                    'ON hashes (used)')
+            version = self.connection.execute('PRAGMA user_version'
+                                              ).fetchone()[0]
+            if version == 0: # just created, here or by a concurrent run
+                self.connection.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+            elif version != SCHEMA_VERSION:
+                # another run may be using it, never drop it under its feet
+                self.__disable__(reason=f'schema {version} is not '
+                                 f'{SCHEMA_VERSION}, delete {path} to rebuild it')
+        except sqlite3.Error as e:
+            self.__disable__(reason=str(e))
+
+    def __enter__(self) -> 'HashCache':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    @property
+    def enabled(self) -> bool:
+        return self.connection is not None
+
+    def __disable__(self, reason: str) -> None:
+        """
+        Go on without the cache, files are then all hashed.
+        """
+        _tryLogger_(log=f'Hash cache {self.path} disabled: {reason}',
+                    level='warning')
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except sqlite3.Error:
+                pass
+        self.connection = None
+        self.pending.clear()
+        self.stale.clear()
+        self.used.clear()
+
+    def get(self, path: str, stat: os.stat_result) -> list[FileHashes] | None:
+        """
+        Return the cached results of a file, the archive members for an
+        archive, or None when the file changed or was never hashed.
+        """
+        if self.rehash or self.connection is None:
+            return None
+        try:
+            rows = self.connection.execute(
+                'SELECT member, size, mtime, length, crc, md5, sha1 FROM '
+                'hashes WHERE device = ? AND inode = ?',
+                (stat.st_dev, stat.st_ino)).fetchall()
+        except sqlite3.Error as e:
+            self.__disable__(reason=str(e))
+            return None
+        if not rows or any(row[1] != stat.st_size or row[2] != stat.st_mtime_ns
+                           for row in rows):
+            return None
+        self.used.append((self.stamp, stat.st_dev, stat.st_ino)) # batched
+        self.__due__()
+        return [FileHashes(path=path, size=length, crc=crc, md5=md5, sha1=sha1,
+                           member=member or None)
+                for member, _, _, length, crc, md5, sha1 in rows]
+
+    def put(self, path: str, stat: os.stat_result,
+            results: Iterable[FileHashes]) -> None:
+        """
+        Store the results of a file, replacing whatever was cached for it,
+        at the next batch commit.
+        """
+        if self.connection is None:
+            return
+        self.stale.append((stat.st_dev, stat.st_ino))
+        self.pending.extend((stat.st_dev, stat.st_ino, result.member or '',
+                             path, stat.st_size, stat.st_mtime_ns, result.size,
+                             result.crc, result.md5, result.sha1, self.stamp)
+                            for result in results)
+        self.__due__()
+
+    def __due__(self) -> None:
+        if len(self.pending) + len(self.used) >= BATCH_ROWS or \
+                time.perf_counter() - self.committed >= BATCH_SECONDS:
+            self.__commit__()
+
+    def __commit__(self) -> None:
+        """
+        Write the pending entries and stamps in one short transaction.
+        """
+        self.committed = time.perf_counter()
+        if self.connection is None or not (self.pending or self.used):
+            return
+        try:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.executemany(
+                    'DELETE FROM hashes WHERE device = ? AND inode = ?',
+                    self.stale)
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, '
+                    '?, ?, ?, ?, ?)', self.pending)
+                self.connection.executemany(
+                    'UPDATE hashes SET used = ? WHERE device = ? AND '
+                    'inode = ?', self.used)
+                self.connection.execute('COMMIT')
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            self.__disable__(reason=str(e))
+            return
+        self.pending.clear()
+        self.stale.clear()
+        self.used.clear()
+
+    def evict(self) -> int:
+        """
+        Drop the least recently used entries above maxEntries, return how
+        many were dropped.
+        """
+        if self.connection is None:
+            return 0
+        try:
+            count = self.connection.execute('SELECT COUNT(*) FROM hashes'
+                                            ).fetchone()[0]
+            if count <= self.maxEntries:
+                return 0
+            self.connection.execute(
+                'DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes '
+                'ORDER BY used LIMIT ?)', (count - self.maxEntries,))
+        except sqlite3.Error as e:
+            self.__disable__(reason=str(e))
+            return 0
+        _tryLogger_(log=f'Hash cache: evicted {count - self.maxEntries} '
+                    'entries', level='debug')
+        return count - self.maxEntries
+
+    def flush(self) -> None:
+        self.__commit__()
+        self.evict()
+
+    def close(self) -> None:
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+def _tryLogger_(log: Any, level: Literal['debug', 'info', 'warning', 'error',
+                'critical'] = 'debug') -> None:
+    if thisLogger is not None:
+        number = LOG_LEVELS[level]
+        if thisLogger.isEnabledFor(number): # nothing else when filtered out
+            thisLogger.name = __name__
+            thisLogger.log(number, log)
+    else:
+        print(f'Error writing log, continuing with simple print\n{log}')
@@ -1,61 +1,308 @@
-# This module is needed by the main and takes care of the control and generation of the
-# configuration file through input requests.
+# This module is needed by the main and loads the configuration: options are
+# layered from the defaults, config.ini, ROMIX_<SECTION>_<OPTION> environment
+# variables and command line overrides, in this order, and parsed once per
+# process into an immutable Settings object. The file is only read; it is
+# written, atomically, just when a required option is missing and it can be
+# asked on a terminal, so batch workers and parallel jobs never race on it
+# nor wait for an input that will not come.
 
 import configparser
 import os
+import re
+import sys
 from logging import Logger
-from typing import Any, Literal
-
-settings: dict[Any, Any] = {}
-thisLogger: Logger | None
-
-def iniSettingsCheck(options, config_file, folders, logger) -> bool:
-    config = configparser.ConfigParser(inline_comment_prefixes=('#', ';'), comment_prefixes=('#', ';'),
-                                       empty_lines_in_values=False, allow_no_value=False)
-    config.read(filenames=config_file)
-    global thisLogger
-    thisLogger = logger
-    for section in options:
-        if not config.has_section(section=section):
-            _tryLogger_(log=f'Needed section {section} does not exist in your INI '
-                        f'file, creating...', level='info')
-            config.add_section(section=section)
-        for option in options[section]:
-            if config.has_option(section=section, option=option):
-                _tryLogger_(log=f'Ok, {section} {option} found.', level='info')
-            else:
-                config.set(
-                    section=section,
-                    option=option,
-                    value=input(f'Please insert the {section} {option}: ')
-                )
-    with open(file=config_file, mode='w') as configfile:
-        config.write(fp=configfile)
-    # Read INI file
-    for section in config.sections():
-        options = config.items(section=section)
-        data = {}
-        for option, value in options:
-            if value != ('' and None):
-                data[option] = value
-            settings[section] = data
-    if settings:
-        if iniStructCheck(folders=folders):
-            _tryLogger_(log=f'Ok, all folders are in place', level='info')
-            return True
-    return False
-
-def iniStructCheck(folders) -> bool:
-    for folder in folders:
-        if not os.path.exists(path=folders.get(folder)):
-            os.makedirs(name=folders.get(folder))
-    return True
+from types import MappingProxyType
+from typing import (Any, Callable, Iterable, Literal, Mapping, NamedTuple,
+                    Optional)
+
+from hashcache import DEFAULT_MAX_ENTRIES
+from metrics import LOG_LEVELS
+from pipeline import DEFAULT_IN_FLIGHT, DEFAULT_LISTERS
+from scanner import DEFAULT_BIG_FILE, DEFAULT_CHUNK_SIZE
+
+thisLogger: Logger | None = None
+
+ENV_PREFIX: str = 'ROMIX' # ROMIX_SCANNER_WORKERS=8 sets scanner.workers
+
+_size_ = re.compile(r'(\d+)\s*([kmgt]?)i?b?', re.IGNORECASE)
+_units_: dict[str, int] = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30,
+                           't': 1 << 40}
+
+def parseSize(value: str) -> int:
+    """
+    Parse a byte size, 4194304, 4M, 4MB and 4MiB being the same.
+    """
+    found = _size_.fullmatch(value.strip())
+    if found is None:
+        raise ValueError(f'{value!r} is not a size')
+    return int(found.group(1)) * _units_[found.group(2).lower()]
+
+def parseCount(value: str) -> int:
+    count = int(value)
+    if count < 1:
+        raise ValueError(f'{value!r} is not a positive number')
+    return count
+
+def parseBoolean(value: str) -> bool:
+    state = configparser.ConfigParser.BOOLEAN_STATES.get(value.strip().lower())
+    if state is None:
+        raise ValueError(f'{value!r} is not a boolean')
+    return state
+
+def _optional_(parse: Callable[[str], Any]) -> Callable[[str], Any]:
+    """
+    Let an option be switched off, or left to the default, with an empty
+    value, 0, none or auto.
+    """
+    def parseOptional(value: str) -> Any:
+        if value.strip().lower() in ('', '0', 'none', 'auto', 'off'):
+            return None
+        return parse(value)
+    return parseOptional
+
+# Settings field -> (section, option, parser)
+OPTIONS: dict[str, tuple[str, str, Callable[[str], Any]]] = {
+    'cacheDir': ('folders', 'cache', str),
+    'screenshotsDir': ('folders', 'screenshots', str),
+    'hashCache': ('cache', 'hash_cache', str),
+    'cacheEntries': ('cache', 'max_entries', parseCount),
+    'workers': ('scanner', 'workers', _optional_(parseCount)),
+    'processes': ('scanner', 'processes', parseBoolean),
+    'chunkSize': ('scanner', 'chunk_size', parseSize),
+    'bigFile': ('scanner', 'big_file', _optional_(parseSize)),
+    'inFlight': ('scanner', 'in_flight', parseCount),
+    'listers': ('scanner', 'listers', parseCount),
+    'memoryLimit': ('scanner', 'memory_limit', _optional_(parseSize)),
+    'trustDirs': ('scanner', 'trust_dirs', parseBoolean)
+}
+
+class Settings(NamedTuple):
+    """
+    Typed, read only settings of a process, see loadSettings. sections holds
+    every option found, the typed fields included, as strings.
+    """
+    configFile: str = 'config.ini'
+    cacheDir: str = 'cache'
+    screenshotsDir: str = 'img'
+    hashCache: str = 'hashes.sqlite' # in cacheDir unless absolute
+    cacheEntries: int = DEFAULT_MAX_ENTRIES
+    workers: int | None = None # all cores
+    processes: bool = False
+    chunkSize: int = DEFAULT_CHUNK_SIZE
+    bigFile: int | None = DEFAULT_BIG_FILE
+    inFlight: int = DEFAULT_IN_FLIGHT
+    listers: int = DEFAULT_LISTERS
+    memoryLimit: int | None = None # bytes of read buffers, None for no limit
+    trustDirs: bool = False # incremental scans skip unchanged folders
+    sections: Mapping[str, Mapping[str, str]] = MappingProxyType({})
+
+    @property
+    def hashCachePath(self) -> str:
+        return os.path.join(self.cacheDir, self.hashCache)
+
+    @property
+    def folders(self) -> dict[str, str]:
+        return {'screenshots': self.screenshotsDir, 'cache': self.cacheDir}
+
+    def readers(self, count: int | None = None) -> int:
+        """
+        Return how many files may be read at once, count or all the cores,
+        lowered so that their chunkSize buffers fit in memoryLimit.
+        """
+        count = count or os.cpu_count() or 1
+        if self.memoryLimit is None:
+            return count
+        return max(1, min(count, self.memoryLimit // self.chunkSize))
+
+    def get(self, section: str, option: str, fallback: str | None = None
+            ) -> str | None:
+        return self.sections.get(section, {}).get(option, fallback)
+
+    def __reduce__(self) -> tuple:
+        # mapping proxies cannot be pickled, process pools get them rebuilt
+        return (_settings_, (tuple(self)[:-1], {
+            section: dict(options) for section, options in
+            self.sections.items()}))
+
+def _freeze_(sections: Mapping[str, Mapping[str, str]]
+             ) -> Mapping[str, Mapping[str, str]]:
+    return MappingProxyType({section: MappingProxyType(dict(options))
+                             for section, options in sections.items()})
+
+def _settings_(fields: tuple, sections: Mapping[str, Mapping[str, str]]
+               ) -> Settings:
+    return Settings(*fields, sections=_freeze_(sections=sections))
+
+settings: Settings | None = None # parsed once per process
+
+def envName(section: str, option: str) -> str:
+    name = f'{ENV_PREFIX}_{section}_{option}'.upper()
+    return re.sub(r'\W', '_', name)
+
+def _readConfig_(configFile: str) -> configparser.ConfigParser:
+    config = configparser.ConfigParser(inline_comment_prefixes=('#', ';'),
+                                       comment_prefixes=('#', ';'),
+                                       empty_lines_in_values=False,
+                                       allow_no_value=False)
+    config.read(filenames=configFile)
+    return config
+
+def _parseOverride_(override: str) -> tuple[str, str, str]:
+    """
+    Split a section.option=value override.
+    """
+    key, separator, value = override.partition('=')
+    section, dot, option = key.strip().rpartition('.')
+    if not separator or not dot or not section or not option:
+        raise ValueError(f'{override!r} is not a section.option=value override')
+    return section.strip().lower(), option.strip().lower(), value.strip()
+
+_section_ = re.compile(r'\[(?P<header>.+)\]') # as ConfigParser.SECTCRE
+
+def _setOption_(lines: list[str], section: str, option: str, value: str
+                ) -> None:
+    """
+    Set an option in the lines of an INI file, replacing its line when it is
+    there, empty, or adding it after the last option of its section, the
+    section being appended when missing. Comments and order are kept.
+    """
+    line = f'{option} = {value}\n'
+    option = option.lower()
+    start = end = None # of the section body
+    for number, text in enumerate(lines):
+        header = _section_.match(text)
+        if header is not None:
+            if start is not None:
+                break
+            if header.group('header').strip() == section:
+                start = end = number + 1
+            continue
+        if start is None:
+            continue
+        stripped = text.strip()
+        if not stripped or stripped[0] in '#;':
+            continue
+        key = re.split(r'[=:]', stripped, maxsplit=1)[0].strip()
+        if key.lower() == option and not text[0].isspace():
+            lines[number] = line
+            return
+        end = number + 1
+    if start is None:
+        _tryLogger_(log=f'Needed section {section} does not exist in your '
+                    'INI file, creating...', level='info')
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        if lines and lines[-1].strip():
+            lines.append('\n')
+        lines.extend((f'[{section}]\n', line))
+    else:
+        lines.insert(end, line)
+
+def _ask_(configFile: str, missing: list[tuple[str, str]],
+          values: dict[str, dict[str, str]]) -> None:
+    """
+    Ask the missing options on the terminal and set them in the file, edited
+    line by line so its comments and order are kept, and replaced atomically
+    so a concurrent reader never sees it half written.
+    """
+    try:
+        with open(file=configFile) as file:
+            lines = file.readlines()
+    except FileNotFoundError:
+        lines = []
+    for section, option in missing:
+        value = input(f'Please insert the {section} {option}: ')
+        _setOption_(lines=lines, section=section, option=option, value=value)
+        values.setdefault(section, {})[option] = value
+    temporary = f'{configFile}.{os.getpid()}.tmp'
+    try:
+        with open(file=temporary, mode='w') as file:
+            file.writelines(lines)
+        os.replace(temporary, configFile)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+def loadSettings(configFile: str = 'config.ini', required:
+                 Optional[Mapping[str, Iterable[str]]] = None,
+                 overrides: Iterable[str] = (), headless: bool = False,
+                 environ: Optional[Mapping[str, str]] = None,
+                 logger: Optional['Logger'] = None) -> Settings:
+    """
+    Load the settings of the process, the first call parses them and the
+    next ones return the same object.
+
+    Arguments:
+    - configFile (str): INI file, a missing one is like an empty one.
+    - required (dict): Options that must have a value, {section: [option]}.
+    - overrides (Iterable[str]): section.option=value overrides, the last
+      one of an option wins.
+    - headless (bool): Never ask missing options, raise instead; implied
+      when stdin is not a terminal.
+    - environ (Mapping): Environment variables, os.environ by default.
+    Raise ValueError on missing or invalid options.
+    """
+    global settings, thisLogger
+    thisLogger = logger or thisLogger
+    if settings is not None:
+        return settings
+    environ = os.environ if environ is None else environ
+    config = _readConfig_(configFile=configFile)
+    values: dict[str, dict[str, str]] = {section: dict(config.items(section))
+                                         for section in config.sections()}
+    known = {(section, option) for section, option, _ in OPTIONS.values()}
+    known.update((section, option) for section, options in values.items()
+                 for option in options)
+    known.update((section, option) for section, options in
+                 (required or {}).items() for option in options)
+    for section, option in sorted(known):
+        value = environ.get(envName(section=section, option=option))
+        if value is not None:
+            _tryLogger_(log=f'{section}.{option} set by '
+                        f'{envName(section=section, option=option)}',
+                        level='debug')
+            values.setdefault(section, {})[option] = value
+    for override in overrides:
+        section, option, value = _parseOverride_(override=override)
+        values.setdefault(section, {})[option] = value
+    missing = [(section, option) for section, options in
+               (required or {}).items() for option in options
+               if not values.get(section, {}).get(option)]
+    if missing:
+        names = ', '.join(f'{section}.{option}' for section, option in missing)
+        if headless or not sys.stdin or not sys.stdin.isatty():
+            raise ValueError(f'Missing settings {names}, set them in '
+                             f'{configFile}, with {ENV_PREFIX}_<SECTION>_'
+                             '<OPTION> variables or --set section.option=value')
+        _tryLogger_(log=f'Missing settings {names}', level='info')
+        _ask_(configFile=configFile, missing=missing, values=values)
+    typed: dict[str, Any] = {}
+    for field, (section, option, parse) in OPTIONS.items():
+        value = values.get(section, {}).get(option)
+        if value is None:
+            continue
+        try:
+            typed[field] = parse(value)
+        except ValueError as e:
+            raise ValueError(f'Invalid {section}.{option}: {e}') from None
+    settings = Settings(configFile=configFile,
+                        sections=_freeze_(sections=values), **typed)
+    makeFolders(folders=settings.folders)
+    _tryLogger_(log=f'Ok, settings loaded from {configFile}', level='debug')
+    return settings
+
+def makeFolders(folders: Mapping[str, str]) -> None:
+    for folder in folders.values():
+        os.makedirs(name=folder, exist_ok=True) # other processes may race
+    _tryLogger_(log='Ok, all folders are in place', level='debug')
 
 def _tryLogger_(log: Any, level: Literal['debug', 'info', 'warning', 'error',
                 'critical'] = 'debug') -> None:
     if thisLogger is not None:
-        thisLogger.name = __name__
-        log_method = getattr(thisLogger, level)
-        log_method(log)
+        number = LOG_LEVELS[level]
+        if thisLogger.isEnabledFor(number): # nothing else when filtered out
+            thisLogger.name = __name__
+            thisLogger.log(number, log)
     else:
         print(f'Error writing log, continuing with simple print\n{log}')
@@ -0,0 +1,105 @@
+# This module collects per-phase timers and counters (parse, classify,
+# convert, walk, hash, match, bytes read, cache hits...) in a process wide
+# registry, so every module can report what it did without threading a stats
+# object through the calls, and the CLI can print a summary at the end. It is
+# meant for phases and totals, not for per-item events: modules keep their
+# own local counters in hot loops and add them here once.
+#
+# Only the current process is seen, work done in process pools (the catalog
+# compilation, scanner processes) is not accounted for.
+
+import logging
+import time
+from typing import Any, Iterable, Iterator, TypeVar
+
+# Level numbers of the names accepted by the _tryLogger_ helpers
+LOG_LEVELS: dict[str, int] = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL
+}
+
+_Item_ = TypeVar('_Item_')
+
+class _Timer_():
+    __slots__ = ('metrics', 'name', 'started')
+
+    def __init__(self, metrics: 'Metrics', name: str) -> None:
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self) -> '_Timer_':
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.metrics.add(name=self.name,
+                         seconds=time.perf_counter() - self.started)
+
+class Metrics():
+    """
+    Named timers, accumulating seconds and calls, and named counters.
+    """
+    def __init__(self) -> None:
+        self.timers: dict[str, list[float]] = {} # name -> [seconds, calls]
+        self.counters: dict[str, int] = {}
+
+    def timer(self, name: str) -> _Timer_:
+        """
+        Return a context manager adding the time spent in it to name.
+        """
+        return _Timer_(metrics=self, name=name)
+
+    def add(self, name: str, seconds: float, calls: int = 1) -> None:
+        found = self.timers.get(name)
+        if found is None:
+            self.timers[name] = [seconds, calls]
+        else:
+            found[0] += seconds
+            found[1] += calls
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def timed(self, name: str, items: Iterable[_Item_]) -> Iterator[_Item_]:
+        """
+        Yield items adding to name only the time spent producing them, not
+        the time the consumer spends between two of them.
+        """
+        iterator = iter(items)
+        spent = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    spent += time.perf_counter() - started
+                    break
+                spent += time.perf_counter() - started
+                yield item
+        finally:
+            self.add(name=name, seconds=spent)
+
+    def reset(self) -> None:
+        self.timers.clear()
+        self.counters.clear()
+
+    def asDict(self) -> dict[str, Any]:
+        return {'timers': {name: {'seconds': seconds, 'calls': calls}
+                           for name, (seconds, calls) in self.timers.items()},
+                'counters': dict(self.counters)}
+
+    def __str__(self) -> str:
+        lines = [f'{name:<12}{seconds:>10.3f}s{calls:>9} calls'
+                 for name, (seconds, calls) in self.timers.items()]
+        for name, value in self.counters.items():
+            if name.startswith('bytes'):
+                lines.append(f'{name:<12}{value / (1024 * 1024):>10.1f} MB')
+            else:
+                lines.append(f'{name:<12}{value:>11}')
+        return '\n'.join(lines)
+
+metrics = Metrics()
@@ -0,0 +1,485 @@
+# This module holds the compact in-memory model of a romset: games are small
+# slotted objects while every ROM dump lives in packed columnar arrays shared
+# by the whole set.
+
+from array import array
+from collections import OrderedDict
+from sys import intern
+from typing import Any, Iterator, Literal, Mapping, Optional
+
+# Bits of RomTable.flags telling which columns hold a real value
+HAS_SIZE = 1
+HAS_CRC = 2
+HAS_MD5 = 4
+HAS_SHA1 = 8
+MERGE_SELF = 16 # merge attribute equal to the ROM name, the usual case
+
+MD5_SIZE = 16
+SHA1_SIZE = 20
+
+class RomTable():
+    """
+    Columnar storage of ROM dumps: sizes and CRC32 are kept in arrays, MD5 and
+    SHA1 as fixed-width binary digests in bytearrays, uncommon attributes
+    (merge, status, serial...) in a sparse dictionary keyed by ROM index.
+    """
+    __slots__ = ('names', 'sizes', 'crcs', 'md5s', 'sha1s', 'flags', 'extras')
+
+    def __init__(self) -> None:
+        self.names: list[str] = []
+        self.sizes: array = array('Q')
+        self.crcs: array = array('I')
+        self.md5s: bytearray = bytearray()
+        self.sha1s: bytearray = bytearray()
+        self.flags: array = array('B')
+        self.extras: dict[int, dict[str, str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def append(self, attributes: Mapping[str, str]) -> int:
+        """
+        Store a ROM from its raw descriptor attributes and return its index.
+        Values that cannot be packed are kept untouched in the extras.
+        """
+        index = len(self.names)
+        flags = 0
+        extra: dict[str, str] = {}
+        size = crc = 0
+        md5 = sha1 = None
+        name = attributes.get('name')
+        for key, value in attributes.items():
+            if value is None or key == 'name':
+                continue
+            try:
+                if key == 'merge' and value == name:
+                    flags |= MERGE_SELF
+                elif key == 'size':
+                    size = int(value)
+                    flags |= HAS_SIZE
+                elif key == 'crc':
+                    crc = int(value, 16)
+                    if crc > 0xFFFFFFFF:
+                        raise ValueError(f'bad crc {value}')
+                    flags |= HAS_CRC
+                elif key == 'md5':
+                    md5 = bytes.fromhex(value)
+                    if len(md5) != MD5_SIZE:
+                        raise ValueError(f'bad md5 length {len(md5)}')
+                    flags |= HAS_MD5
+                elif key == 'sha1':
+                    sha1 = bytes.fromhex(value)
+                    if len(sha1) != SHA1_SIZE:
+                        raise ValueError(f'bad sha1 length {len(sha1)}')
+                    flags |= HAS_SHA1
+                elif key == 'status':
+                    extra[intern(key)] = intern(value)
+                else:
+                    extra[intern(key)] = value
+            except ValueError:
+                extra[intern(key)] = value
+        self.names.append(name)
+        self.sizes.append(size)
+        self.crcs.append(crc)
+        self.md5s += md5 if md5 is not None else bytes(MD5_SIZE)
+        self.sha1s += sha1 if sha1 is not None else bytes(SHA1_SIZE)
+        self.flags.append(flags)
+        if extra:
+            self.extras[index] = extra
+        return index
+
+    def md5(self, index: int) -> bytes | None:
+        if not self.flags[index] & HAS_MD5:
+            return None
+        return bytes(self.md5s[index * MD5_SIZE:(index + 1) * MD5_SIZE])
+
+    def sha1(self, index: int) -> bytes | None:
+        if not self.flags[index] & HAS_SHA1:
+            return None
+        return bytes(self.sha1s[index * SHA1_SIZE:(index + 1) * SHA1_SIZE])
+
+    def sameDump(self, first: int, second: int) -> bool:
+        """
+        Tell whether two ROMs describe the same dump: every hash both have
+        agrees, there is at least one, and so do their sizes when both have.
+        """
+        common = self.flags[first] & self.flags[second]
+        if not common & (HAS_CRC | HAS_MD5 | HAS_SHA1):
+            return False
+        if common & HAS_SIZE and self.sizes[first] != self.sizes[second]:
+            return False
+        if common & HAS_CRC and self.crcs[first] != self.crcs[second]:
+            return False
+        if common & HAS_MD5 and self.md5(first) != self.md5(second):
+            return False
+        return not common & HAS_SHA1 or self.sha1(first) == self.sha1(second)
+
+    def toDict(self, index: int) -> dict[str, Any]:
+        """
+        Return the ROM as getGames used to, with the size converted to int.
+        """
+        flags = self.flags[index]
+        data: dict[str, Any] = {'name': self.names[index]}
+        if flags & HAS_SIZE:
+            data['size'] = self.sizes[index]
+        if flags & HAS_CRC:
+            data['crc'] = f'{self.crcs[index]:08x}'
+        if flags & HAS_MD5:
+            data['md5'] = self.md5(index=index).hex() # type: ignore
+        if flags & HAS_SHA1:
+            data['sha1'] = self.sha1(index=index).hex() # type: ignore
+        if flags & MERGE_SELF:
+            data['merge'] = self.names[index]
+        extra = self.extras.get(index)
+        if extra is not None:
+            data.update(extra)
+        return data
+
+class Rom():
+    """
+    Lightweight view over a single row of a RomTable.
+    """
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table: RomTable, index: int) -> None:
+        self.table = table
+        self.index = index
+
+    def __repr__(self) -> str:
+        crc = None if self.crc is None else f'{self.crc:08x}'
+        return f'Rom({self.name!r}, size={self.size}, crc={crc})'
+
+    @property
+    def name(self) -> str:
+        return self.table.names[self.index]
+
+    @property
+    def size(self) -> int | None:
+        if not self.table.flags[self.index] & HAS_SIZE:
+            return None
+        return self.table.sizes[self.index]
+
+    @property
+    def crc(self) -> int | None:
+        if not self.table.flags[self.index] & HAS_CRC:
+            return None
+        return self.table.crcs[self.index]
+
+    @property
+    def md5(self) -> bytes | None:
+        return self.table.md5(index=self.index)
+
+    @property
+    def sha1(self) -> bytes | None:
+        return self.table.sha1(index=self.index)
+
+    @property
+    def merge(self) -> str | None:
+        if self.table.flags[self.index] & MERGE_SELF:
+            return self.name
+        return self.extra.get('merge')
+
+    @property
+    def extra(self) -> dict[str, str]:
+        return self.table.extras.get(self.index, {})
+
+    def toDict(self) -> dict[str, Any]:
+        return self.table.toDict(index=self.index)
+
+class Game():
+    """
+    A single game of the set, its ROMs are the [start, stop) slice of the
+    shared RomTable. Subelements other than description, year, manufacturer
+    and rom (comment, video, driver...) are kept already converted in extra.
+    """
+    __slots__ = ('name', 'category', 'attributes', 'description', 'year',
+                 'manufacturer', 'extra', 'table', 'start', 'stop')
+
+    def __init__(self, name: str, category: Literal['bioses', 'parents',
+                 'clones'], attributes: dict[str, Any], table: RomTable,
+                 start: int, stop: int, description: Optional[str] = None,
+                 year: int | str | None = None, manufacturer: Optional[str]
+                 = None, extra: Optional[dict[str, Any]] = None) -> None:
+        self.name = name
+        self.category = category
+        self.attributes = attributes
+        self.description = description
+        self.year = year
+        self.manufacturer = manufacturer
+        self.extra = extra
+        self.table = table
+        self.start = start
+        self.stop = stop
+
+    def __repr__(self) -> str:
+        return f'Game({self.name!r}, {self.category}, roms={len(self)})'
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    @property
+    def roms(self) -> tuple[Rom, ...]:
+        return tuple(Rom(table=self.table, index=i)
+                     for i in range(self.start, self.stop))
+
+    def toDict(self) -> dict[str, Any]:
+        """
+        Return the game with the same shape of a getGames value.
+        """
+        subelements: dict[str, Any] = {}
+        if self.extra is not None:
+            subelements.update(self.extra)
+        for key in ('description', 'year', 'manufacturer'):
+            value = getattr(self, key)
+            if value is not None:
+                subelements[key] = value
+        if self.stop > self.start:
+            subelements['rom'] = {
+                self.table.names[i]: self.table.toDict(index=i)
+                for i in range(self.start, self.stop)
+            }
+        return {'attributes': dict(self.attributes), 'subelements': subelements}
+
+class GameSet():
+    """
+    Ordered collection of the games of a romset sharing one RomTable.
+    """
+    __slots__ = ('roms', 'games', 'byName', 'groups')
+
+    def __init__(self) -> None:
+        self.roms = RomTable()
+        self.games: list[Game] = []
+        self.byName: dict[str, int] = {}
+        self.groups: dict[str, list[int]] = {
+            'parents': [],
+            'clones': [],
+            'bioses': []
+        }
+
+    def __len__(self) -> int:
+        return len(self.games)
+
+    def __iter__(self) -> Iterator[Game]:
+        return iter(self.games)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.byName
+
+    def add(self, game: Game) -> None:
+        index = len(self.games)
+        self.games.append(game)
+        self.byName[game.name] = index
+        self.groups[game.category].append(index)
+
+    def get(self, name: str) -> Game | None:
+        index = self.byName.get(name)
+        return None if index is None else self.games[index]
+
+    def select(self, rSet: Literal['bioses', 'parents', 'clones', 'all']
+               = 'all') -> Iterator[Game]:
+        """
+        Iterate games of one set; 'all' yields parents, clones and then bioses
+        like getGames always did.
+        """
+        for group in ('parents', 'clones', 'bioses'):
+            if rSet in (group, 'all'):
+                for index in self.groups[group]:
+                    yield self.games[index]
+
+    def toDict(self, rSet: Literal['bioses', 'parents', 'clones', 'all']
+               = 'all') -> dict[str, dict]:
+        return {game.name: game.toDict() for game in self.select(rSet=rSet)}
+
+class GameView(Mapping[str, dict]):
+    """
+    Lazy read-only mapping of game name to its getGames style dict. Games are
+    converted only when accessed and the most recent conversions are kept in
+    a LRU cache shared with every filtered view; returned dicts are shared
+    too, copy them before changing them.
+    """
+    def __init__(self, gameSet: GameSet, cacheSize: int = 1024,
+                 rSet: Literal['bioses', 'parents', 'clones', 'all'] = 'all',
+                 manufacturer: Optional[str] = None,
+                 year: int | str | None = None,
+                 cache: Optional['OrderedDict[str, dict]'] = None) -> None:
+        if rSet not in ('bioses', 'parents', 'clones', 'all'):
+            raise ValueError(f"Invalid set value: {rSet}")
+        self.gameSet = gameSet
+        self.cacheSize = cacheSize
+        self.rSet = rSet
+        self.manufacturer = manufacturer
+        self.year = year
+        self.cache: OrderedDict[str, dict] = cache if cache is not None \
+            else OrderedDict()
+        self.__names__: list[str] | None = None
+
+    def __accepts__(self, game: Game) -> bool:
+        if self.rSet != 'all' and game.category != self.rSet:
+            return False
+        if self.manufacturer is not None and (game.manufacturer is None or
+                game.manufacturer.lower() != self.manufacturer.lower()):
+            return False
+        if self.year is not None and str(game.year) != str(self.year):
+            return False
+        return True
+
+    def __filtered__(self) -> bool:
+        return (self.rSet != 'all' or self.manufacturer is not None or
+                self.year is not None)
+
+    def __getitem__(self, name: str) -> dict:
+        found = self.cache.get(name)
+        if found is not None:
+            self.cache.move_to_end(name)
+            if not self.__filtered__() or self.__accepts__(
+                    game=self.gameSet.get(name)): # type: ignore
+                return found
+            raise KeyError(name)
+        game = self.gameSet.get(name)
+        if game is None or (self.__filtered__() and
+                            not self.__accepts__(game=game)):
+            raise KeyError(name)
+        found = game.toDict()
+        self.cache[name] = found
+        if len(self.cache) > self.cacheSize:
+            self.cache.popitem(last=False)
+        return found
+
+    def __contains__(self, name: object) -> bool:
+        game = self.gameSet.get(name) if isinstance(name, str) else None
+        return game is not None and (not self.__filtered__() or
+                                     self.__accepts__(game=game))
+
+    def __listNames__(self) -> list[str]:
+        if self.__names__ is None:
+            self.__names__ = [game.name for game in
+                              self.gameSet.select(rSet=self.rSet)
+                              if self.__accepts__(game=game)]
+        return self.__names__
+
+    def __iter__(self) -> Iterator[str]:
+        if not self.__filtered__():
+            return (game.name for game in self.gameSet.select())
+        return iter(self.__listNames__())
+
+    def __len__(self) -> int:
+        if not self.__filtered__():
+            return len(self.gameSet)
+        return len(self.__listNames__())
+
+    def game(self, name: str) -> Game:
+        """
+        Return the compact Game itself, without any conversion.
+        """
+        game = self.gameSet.get(name)
+        if game is None or (self.__filtered__() and
+                            not self.__accepts__(game=game)):
+            raise KeyError(name)
+        return game
+
+    def select(self, rSet: Literal['bioses', 'parents', 'clones', 'all']
+               = 'all', manufacturer: Optional[str] = None,
+               year: int | str | None = None) -> 'GameView':
+        """
+        Return a filtered view by set type, manufacturer (case insensitive)
+        and year, sharing this view LRU cache.
+        """
+        return GameView(gameSet=self.gameSet, cacheSize=self.cacheSize,
+                        rSet=rSet, manufacturer=manufacturer, year=year,
+                        cache=self.cache)
+
+class RomIndex():
+    """
+    Hash lookup indexes over the ROM dumps of a GameSet, built in a single
+    pass over its RomTable. Keys are (size, crc32) packed in one int, binary
+    SHA1 and binary MD5 digests; values are the RomTable rows using that dump,
+    a bare int for the common single owner case or a list when a dump is
+    shared between parents, clones and bioses.
+    """
+    __slots__ = ('gameSet', 'owners', 'crcs', 'sha1s', 'md5s', 'sizes')
+
+    def __init__(self, gameSet: GameSet) -> None:
+        self.gameSet = gameSet
+        table = gameSet.roms
+        self.owners: array = array('I', bytes(4 * len(table))) # row -> game
+        self.crcs: dict[int, int | list[int]] = {}
+        self.sha1s: dict[bytes, int | list[int]] = {}
+        self.md5s: dict[bytes, int | list[int]] = {}
+        sizes: set[int] = set()
+        unsized = 0
+        for position, game in enumerate(gameSet.games):
+            for row in range(game.start, game.stop):
+                self.owners[row] = position
+                flags = table.flags[row]
+                if flags & HAS_SIZE:
+                    sizes.add(table.sizes[row])
+                else:
+                    unsized += 1
+                if flags & HAS_SIZE and flags & HAS_CRC:
+                    _addRow_(index=self.crcs, key=table.sizes[row] << 32 |
+                             table.crcs[row], row=row)
+                if flags & HAS_SHA1:
+                    _addRow_(index=self.sha1s, key=bytes(table.sha1s[
+                             row * SHA1_SIZE:(row + 1) * SHA1_SIZE]), row=row)
+                if flags & HAS_MD5:
+                    _addRow_(index=self.md5s, key=bytes(table.md5s[
+                             row * MD5_SIZE:(row + 1) * MD5_SIZE]), row=row)
+        # Every valid ROM size, None when some ROM has no size and a file
+        # cannot be ruled out by its size alone
+        self.sizes: frozenset[int] | None = frozenset(sizes) if not unsized \
+            else None
+
+    def __resolve__(self, rows: int | list[int] | None
+                    ) -> tuple[tuple[str, str], ...]:
+        if rows is None:
+            return ()
+        if isinstance(rows, int):
+            rows = [rows]
+        games = self.gameSet.games
+        names = self.gameSet.roms.names
+        return tuple((games[self.owners[row]].name, names[row]) for row in rows)
+
+    def rows(self, size: int | None = None, crc: int | None = None,
+             sha1: bytes | None = None, md5: bytes | None = None
+             ) -> tuple[int, ...]:
+        """
+        Return the RomTable rows matching the strongest hash given.
+        """
+        if sha1 is not None:
+            found = self.sha1s.get(sha1)
+        elif md5 is not None:
+            found = self.md5s.get(md5)
+        elif size is not None and crc is not None:
+            found = self.crcs.get(size << 32 | crc)
+        else:
+            raise ValueError('Lookup needs sha1, md5 or size and crc')
+        if found is None:
+            return ()
+        if isinstance(found, int):
+            return (found,)
+        return tuple(found)
+
+    def byCrc(self, size: int, crc: int) -> tuple[tuple[str, str], ...]:
+        """
+        Return every (game name, rom name) using the dump of given size and
+        CRC32.
+        """
+        return self.__resolve__(rows=self.crcs.get(size << 32 | crc))
+
+    def bySha1(self, sha1: bytes) -> tuple[tuple[str, str], ...]:
+        return self.__resolve__(rows=self.sha1s.get(sha1))
+
+    def byMd5(self, md5: bytes) -> tuple[tuple[str, str], ...]:
+        return self.__resolve__(rows=self.md5s.get(md5))
+
+    def game(self, row: int) -> Game:
+        return self.gameSet.games[self.owners[row]]
+
+def _addRow_(index: dict, key: Any, row: int) -> None:
+    found = index.get(key)
+    if found is None:
+        index[key] = row
+    elif isinstance(found, int):
+        index[key] = [found, row]
+    else:
+        found.append(row)
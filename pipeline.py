@@ -0,0 +1,288 @@
+# This module is an asyncio flavour of the scanning engine for collections on
+# network mounts (NFS, SMB) where every listdir, stat and open costs a round
+# trip and latency, not bandwidth, bounds a serial walk. Directory listings
+# (with their stats) and file hashing are offloaded to a thread pool and many
+# of them are kept in flight at once: a walker lists several folders
+# concurrently and feeds a bounded queue consumed by a fixed number of hashing
+# tasks, whose results go through a second bounded queue. Full queues suspend
+# the producers, so memory stays bounded by about inFlight * chunkSize bytes
+# of read buffers however big the collection is.
+
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger
+from typing import (TYPE_CHECKING, Any, AsyncIterator, Container, Iterable,
+                    Iterator, Literal, Optional, TypeVar)
+
+from metrics import LOG_LEVELS, metrics
+from scanner import (DEFAULT_BIG_FILE, DEFAULT_CHUNK_SIZE, READ_ERRORS,
+                     FileHashes, ScanStats, Scanner, _initWorker_,
+                     identifyArchive, identifyFile, isArchive)
+
+if TYPE_CHECKING:
+    from hashcache import HashCache
+
+thisLogger: Logger | None = None
+
+DEFAULT_IN_FLIGHT: int = 32 # files hashed at once
+DEFAULT_LISTERS: int = 8 # folders listed at once
+
+_Item_ = TypeVar('_Item_')
+_done_ = object() # end of stream marker
+
+def _listDir_(folder: str) -> tuple[list[tuple[str, os.stat_result]],
+                                    list[str]]:
+    """
+    List a folder in a worker thread, returning its (path, stat) files and
+    its subfolders.
+    """
+    files: list[tuple[str, os.stat_result]] = []
+    folders: list[str] = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    if stat.st_ino == 0: # Windows scandir leaves it out
+                        stat = os.stat(entry.path, follow_symlinks=False)
+                    files.append((entry.path, stat))
+                elif entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+            except OSError as e:
+                _tryLogger_(log=f'Cannot stat {entry.path}: {e}',
+                            level='warning')
+    return files, folders
+
+def _drive_(generator: AsyncIterator[_Item_]) -> Iterator[_Item_]:
+    """
+    Iterate an async generator from synchronous code, on a private event
+    loop run in the calling thread, so objects bound to that thread (the
+    SQLite hash cache) keep working. The pipeline only moves while the
+    caller asks for items, which is backpressure too.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                item = loop.run_until_complete(generator.__anext__())
+            except StopAsyncIteration:
+                break
+            yield item
+    finally:
+        loop.run_until_complete(generator.aclose()) # type: ignore
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+class AsyncScanner(Scanner):
+    """
+    Scanner running listings, stats and hashing as concurrent asyncio jobs
+    over a thread pool, for high latency folders. It keeps the Scanner
+    interface, hash cache included; process pools are not supported.
+    """
+    def __init__(self, inFlight: int = DEFAULT_IN_FLIGHT, listers: int
+                 = DEFAULT_LISTERS, chunkSize: int = DEFAULT_CHUNK_SIZE,
+                 bigFile: int | None = DEFAULT_BIG_FILE, archives: bool = True,
+                 verify: bool = False, cache: Optional['HashCache'] = None,
+                 logger: Optional['Logger'] = None) -> None:
+        """
+        Constructor of the class.
+
+        Arguments:
+        - inFlight (int): Files being hashed at the same time, each one
+          holding a chunkSize read buffer.
+        - listers (int): Folders being listed at the same time.
+        See Scanner for the others.
+        """
+        global thisLogger
+        thisLogger = logger
+        super().__init__(workers=inFlight, chunkSize=chunkSize,
+                         processes=False, bigFile=bigFile, archives=archives,
+                         verify=verify, cache=cache, logger=logger)
+        self.inFlight = max(1, inFlight)
+        self.listers = max(1, listers)
+
+    async def __walk__(self, folders: Iterable[str], recursive: bool,
+                       executor: ThreadPoolExecutor, queue: asyncio.Queue,
+                       sizes: Container[int] | None) -> None:
+        """
+        List folders, at most listers at once, and queue their files.
+        """
+        loop = asyncio.get_running_loop()
+        pending = list(folders)
+        listing: dict[asyncio.Future, tuple[str, float]] = {}
+        while pending or listing:
+            while pending and len(listing) < self.listers:
+                folder = pending.pop()
+                listing[loop.run_in_executor(executor, _listDir_, folder)] = \
+                    (folder, time.perf_counter())
+            done, _ = await asyncio.wait(listing.keys(),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                folder, started = listing.pop(future)
+                # listings overlap, this is their summed latency
+                metrics.add(name='walk', seconds=time.perf_counter() - started)
+                try:
+                    files, subfolders = future.result()
+                except OSError as e:
+                    _tryLogger_(log=f'Cannot list {folder}: {e}',
+                                level='warning')
+                    continue
+                if recursive:
+                    pending.extend(subfolders)
+                if sizes is not None:
+                    files = list(self.__prefilter__(files=files, sizes=sizes))
+                for item in files:
+                    await queue.put(item) # waits while hashers are busy
+
+    async def __feed__(self, files: Iterable[tuple[str, os.stat_result]],
+                       queue: asyncio.Queue) -> None:
+        for item in files:
+            await queue.put(item)
+
+    async def __hasher__(self, executor: ThreadPoolExecutor,
+                       queue: asyncio.Queue, output: asyncio.Queue,
+                       crcKeys: Container[int] | None,
+                       sizes: Container[int] | None) -> None:
+        """
+        Hashing task: take files from queue until the end marker and put
+        (path, stat, results, read) on output. An unexpected error is put
+        on output too, for the pipeline to raise it: a dead hasher would
+        leave the producer waiting on a full queue.
+        """
+        try:
+            await self.__hash__(executor=executor, queue=queue, output=output,
+                                crcKeys=crcKeys, sizes=sizes)
+        except Exception as e:
+            await output.put(e)
+
+    async def __hash__(self, executor: ThreadPoolExecutor,
+                       queue: asyncio.Queue, output: asyncio.Queue,
+                       crcKeys: Container[int] | None,
+                       sizes: Container[int] | None) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await queue.get()
+            if item is _done_:
+                await queue.put(_done_) # for the other hashers
+                return
+            path, stat = item
+            if self.cache is not None:
+                cached = self.cache.get(path=path, stat=stat)
+                if cached and self.__complete__(path=path, results=cached,
+                                                crcKeys=crcKeys, sizes=sizes):
+                    self.stats.cached += 1
+                    await output.put((path, stat, cached, False))
+                    continue
+            try:
+                if self.archives and isArchive(path=path):
+                    results = await loop.run_in_executor(
+                        executor, identifyArchive, path, self.chunkSize,
+                        self.verify)
+                else:
+                    results = [await loop.run_in_executor(
+                        executor, identifyFile, path, self.chunkSize,
+                        self.bigFile)]
+            except READ_ERRORS as e: # as Scanner, one bad file is skipped
+                self.__unreadable__(path=path, error=e)
+                continue
+            await output.put((path, stat, results, True))
+
+    async def __pipeline__(self, produce: Any, crcKeys: Container[int] | None,
+                           sizes: Container[int] | None
+                           ) -> AsyncIterator[FileHashes]:
+        """
+        Run produce(executor, queue) against inFlight hashing tasks and
+        yield their results as they complete.
+        """
+        _initWorker_(crcKeys=crcKeys, sizes=sizes) # threads share globals
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.inFlight * 2)
+        output: asyncio.Queue = asyncio.Queue(maxsize=self.inFlight)
+        executor = ThreadPoolExecutor(max_workers=self.inFlight + self.listers,
+                                      thread_name_prefix='romix-aio')
+        producer = asyncio.ensure_future(produce(executor, queue))
+        hashers = [asyncio.ensure_future(self.__hasher__(
+            executor=executor, queue=queue, output=output, crcKeys=crcKeys,
+            sizes=sizes)) for _ in range(self.inFlight)]
+        async def closer() -> None:
+            # end markers once the producer, then every hasher, are done
+            await asyncio.wait([producer])
+            await queue.put(_done_)
+            await asyncio.wait(hashers)
+            await output.put(_done_)
+        tasks = [producer, *hashers, asyncio.ensure_future(closer())]
+        try:
+            while True:
+                item = await output.get()
+                if item is _done_:
+                    break
+                if isinstance(item, Exception): # from a hasher
+                    raise item
+                path, stat, results, read = item
+                if read and self.cache is not None:
+                    self.cache.put(path=path, stat=stat, results=results)
+                for result in self.__filter__(results=results, sizes=sizes,
+                                              read=read):
+                    yield result
+            for task in tasks:
+                task.result() # raise what a task may have raised
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.stats.finished = time.perf_counter()
+
+    async def scanAsync(self, folders: Iterable[str], recursive: bool = False,
+                        sizes: Container[int] | None = None, crcKeys:
+                        Container[int] | None = None
+                        ) -> AsyncIterator[FileHashes]:
+        """
+        Walk folders and hash every file found, yielding results as soon as
+        they are ready; see Scanner.scanFiles for sizes and crcKeys.
+        """
+        self.stats = ScanStats()
+        folders = [os.path.normpath(folder) for folder in folders]
+        async def produce(executor: ThreadPoolExecutor,
+                          queue: asyncio.Queue) -> None:
+            await self.__walk__(folders=folders, recursive=recursive,
+                                executor=executor, queue=queue, sizes=sizes)
+        pipeline = self.__pipeline__(produce=produce, crcKeys=crcKeys,
+                                     sizes=sizes)
+        try:
+            async for result in pipeline:
+                yield result
+        finally:
+            await pipeline.aclose() # now, not when garbage collected
+        self.__account__()
+        _tryLogger_(log=f'Scan completed: {self.stats}', level='debug')
+
+    def scan(self, folders: Iterable[str], recursive: bool = False,
+             sizes: Container[int] | None = None, crcKeys: Container[int]
+             | None = None) -> Iterator[FileHashes]:
+        yield from _drive_(generator=self.scanAsync(
+            folders=folders, recursive=recursive, sizes=sizes,
+            crcKeys=crcKeys))
+
+    def hashMany(self, files: Iterable[tuple[str, os.stat_result]], crcKeys:
+                 Container[int] | None = None, sizes: Container[int] | None
+                 = None) -> Iterator[FileHashes]:
+        """
+        Hash already listed (path, stat) pairs through the pipeline.
+        """
+        async def produce(executor: ThreadPoolExecutor,
+                          queue: asyncio.Queue) -> None:
+            await self.__feed__(files=files, queue=queue)
+        yield from _drive_(generator=self.__pipeline__(
+            produce=produce, crcKeys=crcKeys, sizes=sizes))
+
+def _tryLogger_(log: Any, level: Literal['debug', 'info', 'warning', 'error',
+                'critical'] = 'debug') -> None:
+    if thisLogger is not None:
+        number = LOG_LEVELS[level]
+        if thisLogger.isEnabledFor(number): # nothing else when filtered out
+            thisLogger.name = __name__
+            thisLogger.log(number, log)
+    else:
+        print(f'Error writing log, continuing with simple print\n{log}')
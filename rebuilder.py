@@ -0,0 +1,583 @@
+# This module rebuilds romsets: every set of the chosen type (see
+# relations.RomGraph) is written as a zip archive, or a folder, named after
+# the game and holding its ROMs under their descriptor names, taking the dumps
+# from the files found by a scan.
+#
+# Data is moved without going through Python whenever possible: a ROM already
+# deflated in a source zip is copied as raw compressed bytes into the new zip,
+# no inflate nor deflate, and plain files are cloned (reflink) or copied in
+# kernel with os.copy_file_range/os.sendfile. Rebuilding from archives is then
+# bound by disk bandwidth; only plain files going into zips, and 7z members,
+# are compressed or decompressed.
+
+import errno
+import os
+import re
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+from collections import OrderedDict
+from logging import Logger
+from typing import IO, Any, Iterable, Literal, Optional
+
+from metrics import LOG_LEVELS, metrics
+from model import HAS_CRC, HAS_SIZE, RomIndex
+from relations import RomGraph, SetType
+from scanner import DEFAULT_CHUNK_SIZE, FileHashes, Py7zIO, WriterFactory
+
+try:
+    import fcntl
+except ImportError: # no reflinks outside Unix
+    fcntl = None
+
+try:
+    import py7zr
+except ImportError:
+    py7zr = None
+
+thisLogger: Logger | None = None
+
+FICLONE: int = 0x40049409 # Linux ioctl cloning a whole file (btrfs, xfs...)
+ZIP_LIMIT: int = 0xFFFFFFFF # sizes and offsets from it on go in zip64 fields
+ZIP_ENTRIES: int = 0xFFFF # entries from it on need the zip64 end record
+OPEN_ARCHIVES: int = 16 # source zips kept open across sets
+# Fixed entry timestamp, 1996-12-24 23:32:00 as TorrentZip uses, so rebuilt
+# archives of the same set are identical byte by byte
+DOS_TIME: int = (23 << 11) | (32 << 5)
+DOS_DATE: int = ((1996 - 1980) << 9) | (12 << 5) | 24
+
+SPOOL_SIZE: int = 64 * 1024 * 1024 # 7z members beyond it are spooled on disk
+
+_unsafe_ = re.compile(r'[\x00-\x1f/\\]') # never in a single file name
+_drive_ = re.compile(r'[A-Za-z]:')
+
+_local_ = struct.Struct('<4s5H3L2H')
+_central_ = struct.Struct('<4s6H3L5H2L')
+_end_ = struct.Struct('<4s4H2LH')
+_extra_ = struct.Struct('<2H') # extra field id and length, values follow
+_end64_ = struct.Struct('<4sQ2H2L4Q')
+_locator_ = struct.Struct('<4sLQL')
+
+class RebuildStats():
+    """
+    Counters of a rebuild.
+    """
+    __slots__ = ('sets', 'complete', 'roms', 'missing', 'rawBytes',
+                 'packedBytes', 'started', 'finished')
+
+    def __init__(self) -> None:
+        self.sets: int = 0 # sets written
+        self.complete: int = 0 # sets written with every ROM
+        self.roms: int = 0
+        self.missing: int = 0 # ROMs of written sets without a dump
+        self.rawBytes: int = 0 # bytes copied as they are
+        self.packedBytes: int = 0 # bytes compressed or decompressed
+        self.started: float = time.perf_counter()
+        self.finished: float | None = None
+
+    @property
+    def elapsed(self) -> float:
+        end = self.finished if self.finished is not None else time.perf_counter()
+        return max(end - self.started, 1e-9)
+
+    def __str__(self) -> str:
+        megabytes = (self.rawBytes + self.packedBytes) / (1024 * 1024)
+        return (f'{self.sets} sets ({self.complete} complete), {self.roms} '
+                f'ROMs, {self.missing} missing, {megabytes:.1f} MB in '
+                f'{self.elapsed:.2f}s ({megabytes / self.elapsed:.1f} MB/s, '
+                f'{self.rawBytes / (1024 * 1024):.1f} MB copied raw)')
+
+def safeName(name: str) -> str:
+    """
+    Make a descriptor supplied name usable as a single file name: path
+    separators and control characters become _, as do . and .. alone.
+    """
+    name = _unsafe_.sub('_', name)
+    return '_' if name in ('', '.', '..') else name
+
+def entryParts(entry: str) -> list[str] | None:
+    """
+    Split a set entry name on /, None when it could leave the set folder:
+    empty, . or .. parts, absolute paths and drive letters.
+    """
+    parts = entry.replace('\\', '/').split('/')
+    if any(part in ('', '.', '..') or part != safeName(part) or
+           _drive_.match(part) for part in parts):
+        return None
+    return parts
+
+if Py7zIO is not None:
+    class _SpoolWriter_(Py7zIO): # type: ignore
+        """
+        py7zr writer keeping a member in memory up to SPOOL_SIZE, in a
+        temporary file beyond.
+        """
+        def __init__(self) -> None:
+            self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+            self.length = 0
+
+        def write(self, s: bytes | bytearray) -> int:
+            self.length += len(s)
+            return self.file.write(s)
+
+        def read(self, size: int | None = None) -> bytes:
+            return self.file.read(-1 if size is None else size)
+
+        def seek(self, offset: int, whence: int = 0) -> int:
+            return self.file.seek(offset, whence)
+
+        def flush(self) -> None:
+            self.file.flush()
+
+        def size(self) -> int:
+            return self.length
+
+    class _SpoolWriters_(WriterFactory): # type: ignore
+        def __init__(self) -> None:
+            self.writers: dict[str, _SpoolWriter_] = {}
+
+        def create(self, filename: str) -> _SpoolWriter_:
+            writer = _SpoolWriter_()
+            self.writers[filename] = writer
+            return writer
+
+def copyRange(source: int, target: int, offset: int, count: int,
+              targetOffset: int) -> None:
+    """
+    Copy count bytes between file descriptors at the given offsets, in
+    kernel when the OS allows it: copy_file_range (which reflinks on CoW
+    filesystems), then sendfile, then plain reads and writes.
+    """
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < count:
+                done = os.copy_file_range(source, target, count - copied,
+                                          offset + copied,
+                                          targetOffset + copied)
+                if not done:
+                    break
+                copied += done
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               errno.EOPNOTSUPP, errno.EBADF):
+                raise
+    if copied < count and hasattr(os, 'sendfile'):
+        try:
+            os.lseek(target, targetOffset + copied, os.SEEK_SET)
+            while copied < count:
+                done = os.sendfile(target, source, offset + copied,
+                                   count - copied)
+                if not done:
+                    break
+                copied += done
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                               errno.ENOTSOCK):
+                raise
+    while copied < count:
+        block = os.pread(source, min(DEFAULT_CHUNK_SIZE, count - copied),
+                         offset + copied)
+        if not block:
+            raise EOFError(f'Source ended {count - copied} bytes early')
+        os.pwrite(target, block, targetOffset + copied)
+        copied += len(block)
+    os.lseek(target, targetOffset + count, os.SEEK_SET)
+
+def cloneFile(source: str, target: str) -> None:
+    """
+    Copy a whole file as a reflink when the filesystem supports it, sharing
+    its blocks, otherwise with copyRange.
+    """
+    with open(file=source, mode='rb', buffering=0) as reader, \
+            open(file=target, mode='wb', buffering=0) as writer:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(writer.fileno(), FICLONE, reader.fileno())
+                return
+            except OSError:
+                pass
+        copyRange(source=reader.fileno(), target=writer.fileno(), offset=0,
+                  count=os.fstat(reader.fileno()).st_size, targetOffset=0)
+
+def _zip64_(values: Iterable[int]) -> tuple[list[int], bytes]:
+    """
+    Return header values with those from ZIP_LIMIT on replaced by the
+    0xFFFFFFFF marker, and the zip64 extra field holding them in full.
+    """
+    large = [value for value in values if value >= ZIP_LIMIT]
+    if not large:
+        return list(values), b''
+    return [0xFFFFFFFF if value >= ZIP_LIMIT else value for value in values], \
+        _extra_.pack(1, 8 * len(large)) + struct.pack(f'<{len(large)}Q', *large)
+
+class ZipWriter():
+    """
+    Minimal zip writer able to store entries from raw compressed data. Zip64
+    fields and records are written only for the sizes, offsets or entry
+    counts that need them, small sets stay plain zips.
+    """
+    def __init__(self, path: str) -> None:
+        self.file = open(file=path, mode='wb', buffering=0)
+        self.entries: list[tuple[bytes, int, int, int, int, int, int]] = []
+
+    def __enter__(self) -> 'ZipWriter':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.file.close()
+
+    def __begin__(self, name: str, size: int) -> tuple[bytes, int, int, bool]:
+        """
+        Reserve the local header of an entry of about size bytes, with room
+        for zip64 sizes when they may not fit, as zipfile guesses it.
+        """
+        try:
+            encoded, flags = name.encode('ascii'), 0
+        except UnicodeEncodeError:
+            encoded, flags = name.encode('utf-8'), 0x800
+        offset = self.file.tell()
+        large = size * 1.05 >= ZIP_LIMIT
+        self.file.write(bytes(_local_.size) + encoded + # filled by __end__
+                        bytes(_extra_.size + 16 if large else 0))
+        return encoded, flags, offset, large
+
+    def __end__(self, encoded: bytes, flags: int, offset: int, large: bool,
+                method: int, crc: int, packed: int, size: int) -> None:
+        if not large and (packed >= ZIP_LIMIT or size >= ZIP_LIMIT):
+            raise ValueError(f'{encoded.decode(errors="replace")} grew beyond '
+                             'the room left for its zip64 sizes')
+        version = 45 if large else 20 if method == zipfile.ZIP_DEFLATED \
+            else 10
+        extra = _extra_.pack(1, 16) + struct.pack('<2Q', size, packed) \
+            if large else b''
+        os.pwrite(self.file.fileno(), _local_.pack(
+            b'PK\x03\x04', version, flags, method, DOS_TIME, DOS_DATE, crc,
+            0xFFFFFFFF if large else packed, 0xFFFFFFFF if large else size,
+            len(encoded), len(extra)) + encoded + extra, offset)
+        self.entries.append((encoded, flags, offset, method, crc, packed,
+                             size))
+
+    def copyRaw(self, name: str, source: int, offset: int, method: int,
+                crc: int, packed: int, size: int) -> None:
+        """
+        Store an entry copying packed bytes of data as they are from the
+        source file descriptor.
+        """
+        encoded, flags, start, large = self.__begin__(name=name,
+                                                      size=max(packed, size))
+        copyRange(source=source, target=self.file.fileno(), offset=offset,
+                  count=packed, targetOffset=self.file.tell())
+        self.__end__(encoded=encoded, flags=flags, offset=start, large=large,
+                     method=method, crc=crc, packed=packed, size=size)
+
+    def deflate(self, name: str, stream: IO[bytes], size: int = 0,
+                chunkSize: int = DEFAULT_CHUNK_SIZE) -> tuple[int, int]:
+        """
+        Store an entry deflating a binary stream of about size bytes, return
+        its size and crc.
+        """
+        encoded, flags, start, large = self.__begin__(name=name, size=size)
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        size = crc = packed = 0
+        while True:
+            block = stream.read(chunkSize)
+            if not block:
+                break
+            size += len(block)
+            crc = zlib.crc32(block, crc)
+            data = compressor.compress(block)
+            packed += len(data)
+            self.file.write(data)
+        data = compressor.flush()
+        packed += len(data)
+        self.file.write(data)
+        self.__end__(encoded=encoded, flags=flags, offset=start, large=large,
+                     method=zipfile.ZIP_DEFLATED, crc=crc, packed=packed,
+                     size=size)
+        return size, crc
+
+    def close(self) -> None:
+        directory = self.file.tell()
+        for encoded, flags, offset, method, crc, packed, size in self.entries:
+            # the zip64 extra holds size, packed size and offset, in order
+            (size, packed, offset), extra = _zip64_(values=(size, packed,
+                                                            offset))
+            version = 45 if extra else 20 if method == zipfile.ZIP_DEFLATED \
+                else 10
+            self.file.write(_central_.pack(
+                b'PK\x01\x02', version, version, flags, method, DOS_TIME,
+                DOS_DATE, crc, packed, size, len(encoded), len(extra), 0, 0,
+                0, 0, offset) + encoded + extra)
+        end = self.file.tell()
+        count, length = len(self.entries), end - directory
+        if count >= ZIP_ENTRIES or length >= ZIP_LIMIT or directory >= ZIP_LIMIT:
+            self.file.write(_end64_.pack(
+                b'PK\x06\x06', _end64_.size - 12, 45, 45, 0, 0, count, count,
+                length, directory) + _locator_.pack(b'PK\x06\x07', 0, end, 1))
+            # markers telling readers to take the zip64 values
+            if count >= ZIP_ENTRIES:
+                count = 0xFFFF
+            if length >= ZIP_LIMIT:
+                length = 0xFFFFFFFF
+            if directory >= ZIP_LIMIT:
+                directory = 0xFFFFFFFF
+        self.file.write(_end_.pack(b'PK\x05\x06', 0, 0, count, count, length,
+                                   directory, 0))
+        self.file.close()
+
+def _dataOffset_(archive: zipfile.ZipFile, info: zipfile.ZipInfo) -> int:
+    """
+    Return where the packed data of a member starts, after its local header
+    whose name and extra field lengths may differ from the central ones.
+    """
+    header = os.pread(archive.fp.fileno(), _local_.size, # type: ignore
+                      info.header_offset)
+    if len(header) != _local_.size or header[:4] != b'PK\x03\x04':
+        raise zipfile.BadZipFile(f'Bad local header for {info.filename}')
+    fields = _local_.unpack(header)
+    return info.header_offset + _local_.size + fields[9] + fields[10]
+
+class Rebuilder():
+    """
+    Writer of romset sets from scanned dumps.
+    """
+    def __init__(self, graph: RomGraph, index: RomIndex, output: str,
+                 setType: SetType = 'nonmerged', folders: bool = False,
+                 logger: Optional['Logger'] = None) -> None:
+        """
+        Constructor of the class.
+
+        Arguments:
+        - graph (RomGraph): Relationships of the romset, see Romset.relations.
+        - index (RomIndex): Hash index of the same romset.
+        - output (str): Folder receiving the sets, created if missing.
+        - setType (str): split, merged, nonmerged or full.
+        - folders (bool): Write every set as a folder instead of a zip.
+
+        Output should not be one of the scanned folders: a rebuilt archive
+        replaces the old one, which may still be the source of other sets.
+        """
+        global thisLogger
+        thisLogger = logger
+        self.graph = graph
+        self.index = index
+        self.output = output
+        self.setType: SetType = setType
+        self.folders = folders
+        self.sources: dict[int, FileHashes] = {} # RomTable row -> dump
+        self.archives: OrderedDict[str, zipfile.ZipFile] = OrderedDict()
+        self.stats = RebuildStats()
+
+    def add(self, results: Iterable[FileHashes]) -> int:
+        """
+        Record scanned files as sources of the ROMs they match, the first
+        match wins. Return how many results matched.
+        """
+        matched = 0
+        for result in results:
+            rows: tuple[int, ...] = ()
+            if result.sha1 is not None:
+                rows = self.index.rows(sha1=result.sha1)
+            if not rows and result.crc is not None:
+                rows = self.index.rows(size=result.size, crc=result.crc)
+            if rows:
+                matched += 1
+            for row in rows:
+                self.sources.setdefault(row, result)
+        return matched
+
+    def __archive__(self, path: str) -> zipfile.ZipFile:
+        archive = self.archives.get(path)
+        if archive is not None:
+            self.archives.move_to_end(path)
+            return archive
+        archive = zipfile.ZipFile(file=path, mode='r')
+        self.archives[path] = archive
+        if len(self.archives) > OPEN_ARCHIVES:
+            self.archives.popitem(last=False)[1].close()
+        return archive
+
+    def __release__(self, path: str) -> None:
+        archive = self.archives.pop(path, None)
+        if archive is not None:
+            archive.close()
+
+    def __open__(self, source: FileHashes) -> IO[bytes]:
+        """
+        Return a binary stream of the uncompressed dump.
+        """
+        if source.member is None:
+            return open(file=source.path, mode='rb')
+        if os.path.splitext(source.path)[1].lower() == '.7z':
+            if py7zr is None or Py7zIO is None:
+                raise OSError(f'Cannot read {source.name} without py7zr 0.22 '
+                              'or later')
+            factory = _SpoolWriters_()
+            with py7zr.SevenZipFile(source.path, mode='r') as archive:
+                archive.extract(targets=[source.member], factory=factory)
+            writer = factory.writers.get(source.member)
+            if writer is None:
+                raise OSError(f'{source.name} not found')
+            writer.file.seek(0)
+            return writer.file # type: ignore
+        archive = self.__archive__(path=source.path)
+        return archive.open(name=source.member, mode='r')
+
+    def __zipEntry__(self, writer: ZipWriter, name: str, source: FileHashes
+                     ) -> None:
+        if source.member is not None and source.path.lower().endswith('.zip'):
+            archive = self.__archive__(path=source.path)
+            info = archive.getinfo(name=source.member)
+            if info.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) \
+                    and not info.flag_bits & 0x1: # not encrypted
+                writer.copyRaw(name=name, source=archive.fp.fileno(), # type: ignore
+                               offset=_dataOffset_(archive=archive, info=info),
+                               method=info.compress_type, crc=info.CRC,
+                               packed=info.compress_size, size=info.file_size)
+                self.stats.rawBytes += info.compress_size
+                return
+        with self.__open__(source=source) as stream:
+            size, _ = writer.deflate(name=name, stream=stream,
+                                     size=source.size)
+        self.stats.packedBytes += size
+
+    def __fileEntry__(self, path: str, source: FileHashes) -> None:
+        os.makedirs(name=os.path.dirname(path), exist_ok=True)
+        if source.member is None:
+            cloneFile(source=source.path, target=path)
+            self.stats.rawBytes += source.size
+            return
+        if source.path.lower().endswith('.zip'):
+            archive = self.__archive__(path=source.path)
+            info = archive.getinfo(name=source.member)
+            if info.compress_type == zipfile.ZIP_STORED and \
+                    not info.flag_bits & 0x1:
+                with open(file=path, mode='wb', buffering=0) as writer:
+                    copyRange(source=archive.fp.fileno(), # type: ignore
+                              target=writer.fileno(),
+                              offset=_dataOffset_(archive=archive, info=info),
+                              count=info.file_size, targetOffset=0)
+                self.stats.rawBytes += info.file_size
+                return
+        with self.__open__(source=source) as stream, \
+                open(file=path, mode='wb') as writer:
+            while True:
+                block = stream.read(DEFAULT_CHUNK_SIZE)
+                if not block:
+                    break
+                writer.write(block)
+                self.stats.packedBytes += len(block)
+
+    def __empty__(self, row: int) -> bool:
+        """
+        Tell if a ROM is an empty dump, written without any source.
+        """
+        table = self.index.gameSet.roms
+        flags = table.flags[row]
+        return bool(flags & HAS_SIZE and table.sizes[row] == 0 and
+                    (not flags & HAS_CRC or table.crcs[row] == 0))
+
+    def __writeSet__(self, name: str, entries: list[tuple[str, int]]) -> None:
+        entries = sorted(dict(entries).items(), # once per entry name
+                         key=lambda entry: entry[0].lower())
+        if self.folders:
+            target = os.path.join(self.output, name)
+            root = os.path.abspath(target)
+            for entry, row in entries:
+                path = os.path.join(target, *entryParts(entry) or ['..'])
+                if os.path.commonpath([root, os.path.abspath(path)]) != root:
+                    raise ValueError(f'{entry} is outside the set folder')
+                source = self.sources.get(row)
+                if source is not None:
+                    self.__fileEntry__(path=path, source=source)
+                else: # an empty dump
+                    os.makedirs(name=os.path.dirname(path), exist_ok=True)
+                    open(file=path, mode='wb').close()
+            return
+        target = os.path.join(self.output, f'{name}.zip')
+        temporary = f'{target}.{os.getpid()}.tmp'
+        try:
+            with ZipWriter(path=temporary) as writer:
+                for entry, row in entries:
+                    source = self.sources.get(row)
+                    if source is not None:
+                        self.__zipEntry__(writer=writer, name=entry,
+                                          source=source)
+                    else:
+                        writer.deflate(name=entry, stream=_Empty_())
+                writer.close()
+            self.__release__(path=target) # it may be a source itself
+            os.replace(temporary, target)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+    def rebuild(self, complete: bool = False) -> RebuildStats:
+        """
+        Write every set having at least one dump, or only those having all of
+        them with complete, replacing sets already in output.
+        """
+        self.stats = RebuildStats()
+        os.makedirs(name=self.output, exist_ok=True)
+        try:
+            for game, contents in self.graph.sets(setType=self.setType):
+                found = [(entry, row) for entry, row in contents
+                         if row in self.sources or self.__empty__(row=row)]
+                unsafe = [entry for entry, _ in found
+                          if entryParts(entry=entry) is None]
+                if unsafe: # counted as missing
+                    _tryLogger_(log=f'{game.name}: refusing entries outside '
+                                f'the set: {", ".join(unsafe)}', level='warning')
+                    found = [(entry, row) for entry, row in found
+                             if entry not in unsafe]
+                if not found or (complete and len(found) < len(contents)):
+                    continue
+                try:
+                    self.__writeSet__(name=safeName(name=game.name),
+                                      entries=found)
+                except (OSError, EOFError, KeyError, ValueError, struct.error,
+                        zipfile.BadZipFile) as e:
+                    _tryLogger_(log=f'Cannot rebuild {game.name}: {e}',
+                                level='error')
+                    continue
+                self.stats.sets += 1
+                self.stats.roms += len(found)
+                self.stats.missing += len(contents) - len(found)
+                if len(found) == len(contents):
+                    self.stats.complete += 1
+                else:
+                    _tryLogger_('%s: %d of %d ROMs missing', game.name,
+                                len(contents) - len(found), len(contents),
+                                level='debug')
+        finally:
+            for archive in self.archives.values():
+                archive.close()
+            self.archives.clear()
+        self.stats.finished = time.perf_counter()
+        metrics.add(name='rebuild', seconds=self.stats.elapsed)
+        metrics.count(name='bytes copied', value=self.stats.rawBytes)
+        metrics.count(name='bytes packed', value=self.stats.packedBytes)
+        _tryLogger_('Rebuild completed: %s', self.stats, level='debug')
+        return self.stats
+
+class _Empty_():
+    def read(self, size: int = -1) -> bytes:
+        return b''
+
+def _tryLogger_(log: Any, *args: Any, level: Literal['debug', 'info', 'warning',
+                'error', 'critical'] = 'debug') -> None:
+    """
+    Log a message, args being %-formatted into it only when it is emitted.
+    """
+    if thisLogger is not None:
+        number = LOG_LEVELS[level]
+        if thisLogger.isEnabledFor(number): # nothing else when filtered out
+            thisLogger.name = __name__
+            thisLogger.log(number, log, *args)
+    else:
+        print('Error writing log, continuing with simple print\n' +
+              (str(log) % args if args else str(log)))
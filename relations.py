@@ -0,0 +1,262 @@
+# This module resolves the relationships between the games of a romset:
+# parent/clone links from cloneof (cloneofid in No-Intro descriptors), the
+# romof chains leading to BIOS sets and the merge attribute of every ROM,
+# which names the ROM of the romof game holding the same dump. Everything is
+# resolved once, walking games in topological order so a game always comes
+# after the one it takes ROMs from, and kept in flat arrays indexed by game
+# position or RomTable row; listing the contents of split, merged or
+# non-merged sets is then a linear pass without chasing any chain.
+
+from array import array
+from collections import deque
+from logging import Logger
+from typing import Any, Iterator, Literal, Optional
+
+from metrics import LOG_LEVELS
+from model import MERGE_SELF, Game, GameSet
+
+thisLogger: Logger | None = None
+
+# Origin of a ROM row, the values of RomGraph.kinds
+OWN = 0 # dump stored in the set of the game itself
+INHERITED = 1 # dump stored in the parent set
+FROM_BIOS = 2 # dump stored in the BIOS set
+
+NONE = -1 # no parent, romof or BIOS game
+
+SetType = Literal['split', 'merged', 'nonmerged', 'full']
+
+class RomGraph():
+    """
+    Precomputed parent, clone and BIOS relationships of a GameSet together
+    with the resolved owner of every ROM dump.
+
+    Set types, as ROM managers name them:
+    - split: every game holds only its own dumps.
+    - merged: parents hold their own dumps and those of their clones, clones
+      have no set of their own.
+    - nonmerged: every game holds all its dumps but the BIOS ones.
+    - full: every game holds all its dumps, BIOS ones included.
+    """
+    __slots__ = ('gameSet', 'parents', 'romOf', 'bioses', 'clones', 'order',
+                 'owners', 'kinds')
+
+    def __init__(self, gameSet: GameSet, logger: Optional['Logger'] = None
+                 ) -> None:
+        global thisLogger
+        thisLogger = logger
+        self.gameSet = gameSet
+        count = len(gameSet.games)
+        self.parents: array = array('i', [NONE]) * count
+        self.romOf: array = array('i', [NONE]) * count
+        self.bioses: array = array('i', [NONE]) * count
+        self.clones: dict[int, list[int]] = {}
+        self.order: array = array('I')
+        table = gameSet.roms
+        self.owners: array = array('I', range(len(table))) # row -> dump row
+        self.kinds: array = array('B', bytes(len(table)))
+        self.__link__()
+        self.__sort__()
+        self.__resolve__()
+
+    def __link__(self) -> None:
+        """
+        Turn cloneof, cloneofid and romof names into game positions.
+        """
+        games = self.gameSet.games
+        byName = self.gameSet.byName
+        byId = {game.attributes['id']: position
+                for position, game in enumerate(games)
+                if 'id' in game.attributes}
+        for position, game in enumerate(games):
+            attributes = game.attributes
+            if 'cloneofid' in attributes:
+                parent = byId.get(attributes['cloneofid'], NONE)
+            elif 'cloneof' in attributes:
+                parent = byName.get(attributes['cloneof'], NONE)
+            else:
+                parent = None
+            if parent == NONE:
+                _tryLogger_(log=f'{game.name}: parent not found in the set',
+                            level='debug')
+            elif parent is not None and parent != position:
+                self.parents[position] = parent
+                self.clones.setdefault(parent, []).append(position)
+            romOf = attributes.get('romof')
+            if romOf is not None and romOf != game.name:
+                found = byName.get(romOf, NONE)
+                if found == NONE:
+                    _tryLogger_(log=f'{game.name}: romof {romOf} not found in '
+                                'the set', level='debug')
+                self.romOf[position] = found
+            elif parent is not None and parent != position:
+                self.romOf[position] = self.parents[position]
+
+    def __sort__(self) -> None:
+        """
+        Order games so that every one follows its romof game (Kahn), games
+        caught in a romof cycle are appended last as they are.
+        """
+        count = len(self.gameSet.games)
+        dependents: dict[int, list[int]] = {}
+        pending = array('B', bytes(count))
+        for position in range(count):
+            source = self.romOf[position]
+            if source != NONE:
+                dependents.setdefault(source, []).append(position)
+                pending[position] = 1
+        queue = deque(position for position in range(count)
+                      if not pending[position])
+        while queue:
+            position = queue.popleft()
+            self.order.append(position)
+            for dependent in dependents.get(position, ()):
+                pending[dependent] = 0
+                queue.append(dependent)
+        if len(self.order) < count:
+            cyclic = [position for position in range(count) if pending[position]]
+            _tryLogger_(log=f'romof cycle among {len(cyclic)} games, their '
+                        'merges are left unresolved', level='warning')
+            for position in cyclic:
+                self.romOf[position] = NONE
+            self.order.extend(cyclic)
+
+    def __resolve__(self) -> None:
+        """
+        Find the BIOS of every game and the row really holding every dump,
+        following merge names into the romof game, already resolved since it
+        comes first in topological order.
+        """
+        games = self.gameSet.games
+        table = self.gameSet.roms
+        names: dict[int, dict[str, int]] = {} # romof game -> rom name -> row
+        for position in self.order:
+            source = self.romOf[position]
+            if source == NONE:
+                continue
+            if games[source].category == 'bioses':
+                self.bioses[position] = source
+            else:
+                self.bioses[position] = self.bioses[source]
+            lookup = names.get(source)
+            if lookup is None:
+                sourceGame = games[source]
+                lookup = {table.names[row]: row for row in
+                          range(sourceGame.start, sourceGame.stop)}
+                names[source] = lookup
+            game = games[position]
+            for row in range(game.start, game.stop):
+                if table.flags[row] & MERGE_SELF:
+                    merge = table.names[row]
+                else:
+                    merge = table.extras.get(row, {}).get('merge')
+                if merge is None:
+                    continue
+                target = lookup.get(merge)
+                if target is None:
+                    _tryLogger_(log=f'{game.name}: {merge} not found in '
+                                f'{games[source].name}', level='debug')
+                    continue
+                owner = self.owners[target]
+                self.owners[row] = owner
+                holder = self.game(row=owner)
+                self.kinds[row] = FROM_BIOS if holder.category == 'bioses' \
+                    else INHERITED
+
+    def game(self, row: int) -> Game:
+        """
+        Return the game a RomTable row belongs to.
+        """
+        games = self.gameSet.games
+        low, high = 0, len(games)
+        while low < high: # games own consecutive, ascending row slices
+            middle = (low + high) // 2
+            if games[middle].stop <= row:
+                low = middle + 1
+            else:
+                high = middle
+        return games[low]
+
+    def __position__(self, name: str) -> int:
+        position = self.gameSet.byName.get(name)
+        if position is None:
+            raise KeyError(name)
+        return position
+
+    def parent(self, name: str) -> str | None:
+        parent = self.parents[self.__position__(name=name)]
+        return None if parent == NONE else self.gameSet.games[parent].name
+
+    def clonesOf(self, name: str) -> tuple[str, ...]:
+        return tuple(self.gameSet.games[clone].name for clone in
+                     self.clones.get(self.__position__(name=name), ()))
+
+    def bios(self, name: str) -> str | None:
+        bios = self.bioses[self.__position__(name=name)]
+        return None if bios == NONE else self.gameSet.games[bios].name
+
+    def contents(self, name: str, setType: SetType = 'nonmerged'
+                 ) -> list[tuple[str, int]]:
+        """
+        Return the (entry name, RomTable row) pairs the set of a game must
+        hold for the given set type, empty for clones of a merged set. Clone
+        dumps clashing with a different parent dump of the same name are
+        stored as clone/rom in merged sets.
+        """
+        return self.__contents__(position=self.__position__(name=name),
+                                 setType=setType)
+
+    def __contents__(self, position: int, setType: SetType
+                     ) -> list[tuple[str, int]]:
+        game = self.gameSet.games[position]
+        names = self.gameSet.roms.names
+        kinds = self.kinds
+        if setType == 'full':
+            return [(names[row], row) for row in range(game.start, game.stop)]
+        if setType == 'nonmerged':
+            return [(names[row], row) for row in range(game.start, game.stop)
+                    if kinds[row] != FROM_BIOS]
+        if setType == 'split':
+            return [(names[row], row) for row in range(game.start, game.stop)
+                    if kinds[row] == OWN]
+        if setType != 'merged':
+            raise ValueError(f'Invalid set type: {setType}')
+        if self.parents[position] != NONE:
+            return []
+        entries = {names[row]: row for row in range(game.start, game.stop)
+                   if kinds[row] == OWN}
+        table = self.gameSet.roms
+        for clone in self.clones.get(position, ()):
+            cloneGame = self.gameSet.games[clone]
+            for row in range(cloneGame.start, cloneGame.stop):
+                if kinds[row] != OWN:
+                    continue
+                entry = names[row]
+                found = entries.get(entry)
+                if found is not None:
+                    if table.sameDump(first=found, second=row):
+                        continue # same dump without a merge attribute
+                    entry = f'{cloneGame.name}/{entry}'
+                entries.setdefault(entry, row)
+        return list(entries.items())
+
+    def sets(self, setType: SetType = 'nonmerged'
+             ) -> Iterator[tuple[Game, list[tuple[str, int]]]]:
+        """
+        Yield every game having a set of the given type with its contents,
+        in descriptor order.
+        """
+        for position, game in enumerate(self.gameSet.games):
+            if setType == 'merged' and self.parents[position] != NONE:
+                continue
+            yield game, self.__contents__(position=position, setType=setType)
+
+def _tryLogger_(log: Any, level: Literal['debug', 'info', 'warning', 'error',
+                'critical'] = 'debug') -> None:
+    if thisLogger is not None:
+        number = LOG_LEVELS[level]
+        if thisLogger.isEnabledFor(number): # nothing else when filtered out
+            thisLogger.name = __name__
+            thisLogger.log(number, log)
+    else:
+        print(f'Error writing log, continuing with simple print\n{log}')
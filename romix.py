@@ -6,18 +6,32 @@ import colorlog
 import argparse
 import os
 import json
-from typing import Any, Literal
+import hashlib
+import cProfile
+import time
+import tracemalloc
+from typing import Any, Iterable, Literal
+from metrics import LOG_LEVELS, metrics
 from romset import Romset
-from ini import iniSettingsCheck, settings
+from catalog import Catalog, CatalogIndex
+from detector import listFolder, openDescriptor
+from model import RomIndex
+from scanner import FileHashes, Scanner
+from pipeline import DEFAULT_IN_FLIGHT, AsyncScanner
+from rebuilder import Rebuilder
+from audit import Auditor
+from dedup import Deduplicator
+from snapshot import Snapshot, watch
+from hashcache import HashCache
+from ini import Settings, loadSettings
 
 """
 Defining root variables
 """
 supportedOs: list[str] = ['Darwin', 'Windows', 'Linux']
 os_name = platform.system()
-configFile = 'config.ini'
+configFile = os.environ.get('ROMIX_CONFIG', 'config.ini')
 settingsNeeded = {'test1': ['brand', 'api_key'], 'pixel': ['data1', 'data2']}
-foldersNeeded: dict[str, str] = {'screenshots': 'img'}
 logLevel = 'debug'
 feedFolders: int = 0
 
@@ -48,22 +62,13 @@ if logLevel != ('' and None and currentLevel):
 def _tryLogger_(log: Any, level: Literal['debug', 'info', 'warning', 'error',
                 'critical'] = 'debug') -> None:
     if logger is not None:
-        logger.name = __name__
-        log_method = getattr(logger, level)
-        log_method(log)
+        number = LOG_LEVELS[level]
+        if logger.isEnabledFor(number): # nothing else when filtered out
+            logger.name = __name__
+            logger.log(number, log)
     else:
         print(f'Error writing log, continuing with simple print\n{log}')
 
-def buildSettings(data) -> None:
-    for key, value in data.items():
-        for sub_key, sub_value in value.items():
-            variable_name = f'{key}_{sub_key}'
-            variable_name = variable_name.replace(' ', '_')
-            variable_name = variable_name.replace('-', '_')
-            _tryLogger_(log=f'Assigning global variable {variable_name}'
-                            f'from {configFile}', level='debug')
-            globals()[variable_name] = sub_value
-
 def foldersFeed(value):
     if not os.path.isdir(s=value):
         raise argparse.ArgumentTypeError(f"{value} is not a directory.")
@@ -78,9 +83,12 @@ def foldersFeed(value):
 def argparsing() -> Romset | None:
     parser = argparse.ArgumentParser(description='Romix description')
     parser.add_argument('-d', '--dat', metavar='file',
-                        type=argparse.FileType(mode='r'),
-                        required=True,
+                        type=argparse.FileType(mode='rb'),
+                        nargs='+', # many descriptors are loaded as a catalog
                         help='path to romset descriptor')
+    parser.add_argument('-l', '--list', metavar='folder', dest='listFolder',
+                        help='Detect and validate every descriptor in folder, '
+                        'then exit.')
     parser.add_argument('-r', '--romset', metavar='folder',
                         type=foldersFeed, help='Path to romset folder')
     parser.add_argument('-f', '--feed', metavar='folder',
@@ -88,57 +96,369 @@ def argparsing() -> Romset | None:
                         type=foldersFeed, help='Path to feeding folder')
     parser.add_argument('-rc', '--recursive', help='Enable recursive scanning.',
                         action='store_true')
+    parser.add_argument('-w', '--workers', metavar='number', type=int,
+                        help='Parallel hashing workers (default: all cores, '
+                        'or scanner.workers)')
+    parser.add_argument('-p', '--processes', help='Hash with a process pool '
+                        'instead of threads.', action='store_true')
+    parser.add_argument('-a', '--aio', help='Scan with the asyncio pipeline, '
+                        'for folders on network mounts.', action='store_true')
+    parser.add_argument('--in-flight', dest='inFlight', metavar='number',
+                        type=int, help='Files hashed at once by the asyncio '
+                        f'pipeline (default: {DEFAULT_IN_FLIGHT}, or '
+                        'scanner.in_flight).')
+    parser.add_argument('-v', '--verify', help='Decompress and SHA1 verify '
+                        'archive members instead of trusting their headers.',
+                        action='store_true')
+    parser.add_argument('--rehash', help='Ignore the hash cache and hash '
+                        'every file again.', action='store_true')
+    parser.add_argument('-i', '--incremental', help='Only process files '
+                        'added or changed since the previous scan.',
+                        action='store_true')
+    parser.add_argument('--trust-dirs', dest='trustDirs', help='Incremental '
+                        'scans skip folders whose mtime did not change, '
+                        'missing files rewritten in place (or '
+                        'scanner.trust_dirs).', action='store_true')
+    parser.add_argument('--watch', help='Keep running and rescan '
+                        'incrementally on every change (needs watchdog).',
+                        action='store_true')
+    parser.add_argument('-o', '--output', metavar='folder',
+                        help='Rebuild the sets found by the scan into folder.')
+    parser.add_argument('-t', '--set-type', dest='setType',
+                        choices=('split', 'merged', 'nonmerged', 'full'),
+                        default='nonmerged', help='Type of the rebuilt sets '
+                        '(default: nonmerged).')
+    parser.add_argument('--folders', help='Rebuild sets as folders instead '
+                        'of zip archives.', action='store_true')
+    parser.add_argument('--audit', metavar='file', help='Audit the scanned '
+                        'sets (of --set-type) and export the report to file, '
+                        'JSON for .json files, CSV otherwise.')
+    parser.add_argument('--dedup', choices=('report', 'link', 'store'),
+                        nargs='?', const='report', help='Find the dumps '
+                        'stored more than once in the feed folders and report '
+                        'the reclaimable space (default), replace duplicates '
+                        'by hard links, or move them to the --store folder.')
+    parser.add_argument('--store', metavar='folder', help='Content addressed '
+                        'store of --dedup store, to be fed to later scans.')
+    parser.add_argument('--stats', help='Print per phase timers and '
+                        'counters at the end.', action='store_true')
+    parser.add_argument('--profile', metavar='file', help='Profile the run, '
+                        'writing cProfile data to file and the top Python '
+                        'allocations (tracemalloc) to file.mem.txt.')
+    parser.add_argument('--config', metavar='file', default=configFile,
+                        help='Settings file, only read (default: $ROMIX_CONFIG '
+                        'or config.ini).')
+    parser.add_argument('--set', metavar='section.option=value',
+                        action='append', dest='overrides', default=[],
+                        help='Override a setting, as ROMIX_SECTION_OPTION '
+                        'variables do, e.g. --set scanner.chunk_size=8M.')
+    parser.add_argument('--headless', help='Never ask for missing settings, '
+                        'fail instead (default when stdin is not a terminal, '
+                        'or with ROMIX_HEADLESS=1).', action='store_true',
+                        default=os.environ.get('ROMIX_HEADLESS', '').lower()
+                        in ('1', 'yes', 'true', 'on'))
+    parser.add_argument('-s', '--stream', help='Stream the descriptor instead '
+                        'of keeping it in memory, for huge DATs.',
+                        action='store_true')
     args = parser.parse_args()
-    _tryLogger_(log='Ok, romset descriptor found', level='debug')
-    with open(file=args.dat.name, mode="r", encoding="utf-8") as file:
-        romset = Romset(descriptor=file, logger=logger)
-        _tryLogger_(log='Ok, descriptor parsing has been completed successfully', level='debug' )
-        if args.romset:
-            scanner(romset=romset, arguments=args)
+    if args.listFolder:
+        listDescriptors(folder=args.listFolder, recursive=args.recursive)
+        return None
+    if not (args.dat or args.dedup):
+        parser.error('the following arguments are required: -d/--dat')
+    if args.aio and args.processes:
+        parser.error('-p/--processes does not apply to -a/--aio, which '
+                     'hashes in threads')
+    if args.dedup:
+        if not args.feed:
+            parser.error('--dedup needs -f/--feed folders')
+        if args.dedup == 'store' and not args.store:
+            parser.error('--dedup store needs a --store folder')
+    if args.output:
+        # rebuilt sets replace archives that may still be the source of others
+        for folder in [args.romset, *(args.feed or ())]:
+            if folder and isInside(path=args.output, folder=folder):
+                parser.error(f'-o/--output {args.output} is in the scanned '
+                             f'folder {folder}, rebuild into another folder')
+    try:
+        settings = loadSettings(configFile=args.config,
+                                required=settingsNeeded,
+                                overrides=cliOverrides(arguments=args),
+                                headless=args.headless, logger=logger)
+    except (ValueError, OSError, EOFError) as e:
+        _tryLogger_(log=f'An error as occured initialising settings: {e}',
+                    level='critical')
+        return None
+    if args.dedup:
+        deduplicate(arguments=args, settings=settings)
+    romset = None
+    if args.dat:
+        _tryLogger_(log='Ok, romset descriptor found', level='debug')
+        if args.profile:
+            romset = profiled(path=args.profile, arguments=args,
+                              settings=settings)
+        else:
+            romset = run(args=args, settings=settings)
+    if args.stats:
+        _tryLogger_(log=f'Run statistics:\n{metrics}', level='info')
+    return romset
+
+def isInside(path: str, folder: str) -> bool:
+    """
+    Tell if path is folder or anything below it, links resolved.
+    """
+    path, folder = os.path.realpath(path), os.path.realpath(folder)
+    try:
+        return os.path.commonpath([path, folder]) == folder
+    except ValueError: # another drive
+        return False
+
+def cliOverrides(arguments: argparse.Namespace) -> list[str]:
+    """
+    Return the --set overrides followed by those of the scanner options,
+    which win.
+    """
+    overrides = list(arguments.overrides)
+    if arguments.workers is not None:
+        overrides.append(f'scanner.workers={arguments.workers}')
+    if arguments.processes:
+        overrides.append('scanner.processes=yes')
+    if arguments.inFlight is not None:
+        overrides.append(f'scanner.in_flight={arguments.inFlight}')
+    if arguments.trustDirs:
+        overrides.append('scanner.trust_dirs=yes')
+    return overrides
+
+def listDescriptors(folder: str, recursive: bool = False) -> None:
+    """
+    Print the type detected for every descriptor in folder, reading only
+    their prefix.
+    """
+    infos = listFolder(folder=folder, recursive=recursive, logger=logger)
+    for info in infos:
+        state = 'ok' if info.valid else info.error
+        print(f'{os.path.relpath(info.path or "", folder):<48}'
+              f'{info.format or "-":<12}{info.compression or "-":<6}'
+              f'{info.schema or "-":<11}'
+              f'{info.name or "-"} [{state}]')
+    valid = sum(1 for info in infos if info.valid)
+    _tryLogger_(log=f'{valid} of {len(infos)} descriptors can be loaded',
+                level='info')
+
+def deduplicate(arguments: argparse.Namespace, settings: Settings) -> None:
+    """
+    Find the dumps stored more than once across the feed folders and reclaim
+    their space as asked, before any scan so it reads every content once.
+    """
+    cache = HashCache(path=settings.hashCachePath,
+                      maxEntries=settings.cacheEntries,
+                      rehash=arguments.rehash, logger=logger)
+    finder = Deduplicator(workers=settings.readers(settings.workers),
+                          chunkSize=settings.chunkSize, cache=cache,
+                          logger=logger)
+    try:
+        groups = finder.find(folders=arguments.feed,
+                             recursive=arguments.recursive)
+    finally:
+        cache.close()
+    if logger.isEnabledFor(logging.DEBUG):
+        for group in groups:
+            _tryLogger_(log=f'{group.sha1.hex()} ({group.size} bytes) in '
+                        + ', '.join(copy.name for copy in group.copies),
+                        level='debug')
+    _tryLogger_(log=f'Duplicates: {finder.stats}', level='info')
+    if arguments.dedup == 'link':
+        reclaimed = finder.link(groups=groups)
+    elif arguments.dedup == 'store':
+        reclaimed = finder.store(groups=groups, folder=arguments.store)
+    else:
+        return
+    _tryLogger_(log=f'{reclaimed / (1024 * 1024):.1f} MB reclaimed',
+                level='info')
+
+def profiled(path: str, arguments: argparse.Namespace, settings: Settings
+             ) -> Romset | None:
+    """
+    Run under cProfile and tracemalloc, saving both reports to path.
+    """
+    profiler = cProfile.Profile()
+    tracemalloc.start(10)
+    try:
+        romset = profiler.runcall(run, args=arguments, settings=settings)
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        profiler.dump_stats(file=path)
+        with open(file=f'{path}.mem.txt', mode='w') as report:
+            for statistic in snapshot.statistics(key_type='traceback')[:25]:
+                report.write(f'{statistic}\n')
+                report.writelines(f'    {line}\n' for line in
+                                  statistic.traceback.format())
+        _tryLogger_(log=f'Profile written to {path} (see python -m pstats) '
+                    f'and {path}.mem.txt', level='info')
+    return romset
+
+def run(args: argparse.Namespace, settings: Settings) -> Romset | None:
+    """
+    Load the descriptors, then scan and rebuild as asked.
+    """
+    for dat in args.dat:
+        dat.close()
+    if len(args.dat) == 1:
+        with openDescriptor(path=args.dat[0].name) as file:
+            romset = Romset(descriptor=file, logger=logger,
+                            streaming=args.stream,
+                            cacheDir=settings.cacheDir)
+            _tryLogger_(log='Ok, descriptor parsing has been completed successfully', level='debug' )
+            if args.romset or args.feed:
+                scanner(index=romset.index, arguments=args,
+                        settings=settings, romsets={'': romset})
+        return romset
+    catalog = Catalog(paths=[dat.name for dat in args.dat],
+                      cacheDir=settings.cacheDir, workers=settings.workers,
+                      streaming=args.stream, logger=logger)
+    _tryLogger_(log=f'Ok, {len(catalog)} descriptors loaded in the catalog',
+                level='debug')
+    if args.romset or args.feed:
+        scanner(index=catalog.index, arguments=args, settings=settings,
+                romsets=catalog.romsets)
     return None
 
-def scanner(romset: Romset, arguments: argparse.Namespace):
-    data = romset.getGames()
-    # print(data.keys())
-    # if data is not None:
-    #     all_files = []
-    #     all_dirs = []
-    #     if arguments.recursive:
-    #         _tryLogger_(log='Recursive mode enable...')
-    #         for root, dirs, files in os.walk(top=arguments.romset):
-    #             for dir_name in dirs:
-    #                 dir_path = os.path.join(root, dir_name)
-    #                 all_dirs.append(dir_path)
-    #             for file_name in files:
-    #                 file_path = os.path.join(root, file_name)
-    #                 all_files.append(file_path)
-    #     else:
-    #         _tryLogger_(log='Recursive mode disabled (default)...')
-    #         for entry in os.listdir(arguments.romset):
-    #             full_path = os.path.join(arguments.romset, entry)
-    #             if os.path.isfile(path=full_path):
-    #                 all_files.append(full_path)
-    #             elif os.path.isdir(s=full_path):
-    #                 all_dirs.append(full_path)
-    #     for game in data.keys():
-    #         for basename in all_dirs:
-    #             if os.path.basename(basename):
-    #                 print('ok')
-    #             else:
-    #                 print('error')
-    # else:
-    #     print('nessuno')
+def scanner(index: RomIndex | CatalogIndex, arguments: argparse.Namespace,
+            settings: Settings, romsets: dict[str, Romset]):
+    folders: list[str] = []
+    if arguments.romset:
+        folders.append(arguments.romset)
+    if arguments.feed:
+        folders.extend(arguments.feed)
+    if arguments.recursive:
+        _tryLogger_(log='Recursive mode enable...')
+    else:
+        _tryLogger_(log='Recursive mode disabled (default)...')
+    cache = HashCache(path=settings.hashCachePath,
+                      maxEntries=settings.cacheEntries,
+                      rehash=arguments.rehash, logger=logger)
+    engine: Scanner
+    if arguments.aio:
+        engine = AsyncScanner(inFlight=settings.readers(settings.inFlight),
+                              listers=settings.listers,
+                              chunkSize=settings.chunkSize,
+                              bigFile=settings.bigFile,
+                              verify=arguments.verify, cache=cache,
+                              logger=logger)
+    else:
+        engine = Scanner(workers=settings.readers(settings.workers),
+                         chunkSize=settings.chunkSize,
+                         processes=settings.processes,
+                         bigFile=settings.bigFile,
+                         verify=arguments.verify, cache=cache, logger=logger)
+    if index.sizes is None:
+        _tryLogger_(log='Some ROMs have no size, size prefilter disabled',
+                    level='warning')
+    if not (arguments.incremental or arguments.watch):
+        # bad dumps match no crc, the audit needs them all
+        results: Iterable[FileHashes] = engine.scan(
+            folders=folders, recursive=arguments.recursive, sizes=index.sizes,
+            crcKeys=None if arguments.audit else index.crcs)
+        if arguments.output or arguments.audit:
+            results = list(results) # matched first, then rebuilt or audited
+        matchResults(index=index, engine=engine, results=results)
+        cache.close()
+        if arguments.audit:
+            auditSets(romsets=romsets, results=results, arguments=arguments)
+        if arguments.output:
+            rebuildSets(romsets=romsets, results=results, arguments=arguments)
+        return
+    if arguments.output or arguments.audit:
+        _tryLogger_(log='Rebuilding and auditing need a full scan, ignoring '
+                    '--output and --audit in incremental mode',
+                    level='warning')
+    key = hashlib.sha1(repr((sorted(os.path.abspath(f) for f in folders),
+                             arguments.recursive)).encode()).hexdigest()[:16]
+    snapshot = Snapshot(path=os.path.join(settings.cacheDir,
+                                          f'snapshot-{key}.bin'),
+                        trustDirs=settings.trustDirs, logger=logger)
+    def rescan() -> None:
+        changes = snapshot.update(folders=folders, recursive=arguments.recursive)
+        _tryLogger_(log=f'Changes since last scan: {changes}', level='info')
+        for path in changes.removed:
+            _tryLogger_(log=f'{path} has been removed', level='debug')
+        matchResults(index=index, engine=engine,
+                     results=engine.scanFiles(files=changes.files,
+                                              sizes=index.sizes,
+                                              crcKeys=index.crcs))
+        cache.flush()
+        snapshot.save()
+    rescan()
+    if arguments.watch:
+        _tryLogger_(log='Watching for changes, Ctrl+C to stop...', level='info')
+        watch(folders=folders, recursive=arguments.recursive, onChange=rescan)
+    cache.close()
+
+def matchResults(index: RomIndex | CatalogIndex, engine: Scanner,
+                 results: Iterable[FileHashes]) -> int:
+    matched = 0
+    spent = 0.0
+    verbose = logger.isEnabledFor(logging.DEBUG)
+    for result in results:
+        started = time.perf_counter()
+        found: tuple = ()
+        if result.sha1 is not None:
+            found = index.bySha1(sha1=result.sha1)
+        if not found and result.crc is not None:
+            # no sha1 in the descriptor, or a big file whose crc matched nothing
+            found = index.byCrc(size=result.size, crc=result.crc)
+        spent += time.perf_counter() - started
+        if found:
+            matched += 1
+            if verbose: # skip building the message when not shown
+                _tryLogger_(log=f'{result.name} is {"/".join(found[0])}'
+                            + (f' (+{len(found) - 1} more)' if len(found) > 1
+                               else ''), level='debug')
+    metrics.add(name='match', seconds=spent, calls=matched)
+    metrics.count(name='matched', value=matched)
+    _tryLogger_(log=f'{matched} of {engine.stats.files + engine.stats.members}'
+                ' files matched the descriptor', level='info')
+    _tryLogger_(log=f'Throughput: {engine.stats}', level='info')
+    return matched
+
+def rebuildSets(romsets: dict[str, Romset], results: Iterable[FileHashes],
+                arguments: argparse.Namespace) -> None:
+    results = list(results)
+    for system, romset in romsets.items():
+        rebuilder = Rebuilder(graph=romset.relations, index=romset.index,
+                              output=os.path.join(arguments.output, system),
+                              setType=arguments.setType,
+                              folders=arguments.folders, logger=logger)
+        if not rebuilder.add(results=results):
+            continue
+        stats = rebuilder.rebuild()
+        _tryLogger_(log=f'{system or "Romset"} rebuilt: {stats}', level='info')
+
+def auditSets(romsets: dict[str, Romset], results: Iterable[FileHashes],
+              arguments: argparse.Namespace) -> None:
+    results = list(results)
+    root, extension = os.path.splitext(arguments.audit)
+    if not arguments.romset:
+        _tryLogger_(log='No romset folder given, every dump found is audited '
+                    'as elsewhere', level='warning')
+    for system, romset in romsets.items():
+        auditor = Auditor(graph=romset.relations, index=romset.index,
+                          setType=arguments.setType,
+                          romset=arguments.romset and os.path.join(
+                              arguments.romset, system), logger=logger)
+        report = auditor.audit(results=results)
+        path = f'{root} ({system}){extension}' if len(romsets) > 1 \
+            else arguments.audit
+        report.save(path=path)
+        _tryLogger_(log=f'{system or "Romset"} audit: {report}, written to '
+                    f'{path}', level='info')
 
 def main() -> None:
     if os_name not in supportedOs:
         _tryLogger_(log=f'{os_name} usupported OS', level='critical')
         return
     _tryLogger_(log=f'{os_name} detected, continuing with supported OS...', level='debug')
-    if not iniSettingsCheck(options=settingsNeeded, config_file=configFile,
-            folders=foldersNeeded, logger=logger):
-        _tryLogger_(log=f'An error as occured initialising settings', level='critical')
-        return
-    buildSettings(data=settings)
     romset = argparsing()
 
 if __name__ == '__main__':
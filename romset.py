@@ -1,7 +1,14 @@
-from typing import IO, Optional, Literal, Any, Union
+from typing import IO, Optional, Literal, Any, Union, Iterator
 from logging import Logger
 from lxml import etree
+from metrics import LOG_LEVELS, metrics
+from model import Game, GameSet, GameView, RomIndex, RomTable
+from relations import RomGraph
+import clrmamepro
+import datcache
+import detector
 import sys
+import time
 
 thisLogger: Logger | None
 
@@ -9,33 +16,98 @@ class Romset():
     """
     This class object is a simple timer implementation...
     """
-    def __init__(self, descriptor: IO[str], logger: Optional['Logger'] 
-                = None) -> None:
+    # Defining game nodeTags, keys are used to scan for some notehead in header and
+    # values are used to scan for game elements
+    nodeTags: dict[str, list[str]] = detector.NODE_TAGS
+
+    def __init__(self, descriptor: IO, logger: Optional['Logger']
+                = None, streaming: bool = False, cacheDir: Optional[str] = None
+                ) -> None:
         """
         Constructor of the class.
 
         Arguments:
-        - seconds (IO[str]): Romset sidecar file descriptor.
+        - descriptor (IO): Romset descriptor, Logiqx XML or ClrMamePro text,
+          see detector.openDescriptor for compressed ones.
+        - streaming (bool): Do not keep the parsed tree in memory, only the
+          header is read here and games are streamed by iterGames, one at a
+          time, every time they are needed.
+        - cacheDir (str): Folder of the pre-compiled descriptor cache, when
+          given the parsed model and its indexes are loaded from there if the
+          descriptor content did not change, and saved there otherwise. In
+          streaming mode both happen only once the model is needed.
         """
         global thisLogger
         thisLogger = logger
         self.descriptor = descriptor
+        self.streaming = streaming
+        self.format: str = 'xml' # or clrmamepro
+        self.__model__: GameSet | None = None
+        self.__index__: RomIndex | None = None
+        self.__games__: GameView | None = None
+        self.__timings__: list[float] = [0.0, 0.0] # classify, convert
+        self.__relations__: RomGraph | None = None
+        self.cacheDir = cacheDir
+        if not streaming and self.__loadCache__():
+            return
         if not self.__extractData__():
             _tryLogger_(log='Cannot extract data, syntax error parsing xml file',
                         level='critical')
             sys.exit(0)
+        if not streaming: # streamed models are saved once built, see index
+            self.__saveCache__()
+
+    def __loadCache__(self) -> bool:
+        """
+        Load model and indexes from the pre-compiled descriptor cache.
+        """
+        if self.cacheDir is None:
+            return False
+        self.__cachePath__ = datcache.cachePath(
+            folder=self.cacheDir,
+            digest=datcache.contentHash(descriptor=self.descriptor))
+        with metrics.timer(name='load'):
+            cached = datcache.load(path=self.__cachePath__, logger=thisLogger)
+        if cached is None:
+            return False
+        meta, self.__model__, self.__index__ = cached
+        self.schema = meta['schema']
+        self.format = meta.get('format', 'xml')
+        self.header = meta['header']
+        self.docInfo = meta['docInfo']
+        _tryLogger_(log=f'Descriptor loaded from cache {self.__cachePath__}',
+                    level='debug')
+        return True
+
+    def __saveCache__(self) -> None:
+        """
+        Store model and indexes in the pre-compiled descriptor cache, built
+        first when they are not already.
+        """
+        if self.cacheDir is None:
+            return
+        meta = {
+            'schema': self.schema,
+            'format': self.format,
+            'header': self.header,
+            # DocInfo also exposes methods, only plain values are kept
+            'docInfo': {key: value for key, value in
+                        getattr(self, 'docInfo', {}).items()
+                        if isinstance(value, (str, int, bool, type(None)))}
+        }
+        try:
+            datcache.save(path=self.__cachePath__, meta=meta, gameSet=self.model,
+                          index=self.index, logger=thisLogger)
+        except OSError as e:
+            _tryLogger_(log=f'Cannot write descriptor cache: {e}',
+                        level='warning')
     
     def __getDocInfo__(self, data: etree.DocInfo) -> bool:
         """
         Extract DOCTYPE data from the XML descriptor using lxml
         and store it in a dictionary named docInfo
         """
-        docInfo: dict = {}
-        # for prop_name in dir(data):
-        for prop_name in data.__dir__():
-            if not prop_name.startswith("__"):
-                prop_value = getattr(data, prop_name)
-                docInfo.update({prop_name: prop_value})
+        docInfo = detector.docInfoDict(docInfo=data)
         if len(docInfo) > 0:
             self.docInfo = docInfo
             _tryLogger_(log='Doc info as been retrieved', level='debug')
@@ -48,140 +120,320 @@ class Romset():
         and store it in a dictionary named header
         """
         if data is not None:
-            if len(data) > 0:
-                header_data: dict = {}
-                for i in data:
-                    header_data.update({i.tag: {}})
-                    if i.text is not None:
-                        header_data[i.tag]['text'] = i.text
-                    if len(i.attrib) != 0:
-                        header_data[i.tag]['attributes'] = i.attrib
-                if header_data:
-                    self.header = header_data
-                    _tryLogger_(log='Header as been retrieved', level='debug')
-                    return True
+            header = detector.headerDict(header=data)
+            if header:
+                self.header = header
+                _tryLogger_(log='Header as been retrieved', level='debug')
+                return True
         return False
     
+    def __classify__(self, element: etree._Element) -> Literal['bioses',
+                     'parents', 'clones']:
+        """
+        Classify a single game element as BIOS, parent or clone.
+        """
+        if element.get(key='isbios') == 'yes':
+            return 'bioses'
+        if 'id' in self.header.keys():
+            # Working with No-Intro standard dat
+            cloneKey = 'cloneofid'
+        else:
+            # Working with Logiqx standard dat
+            cloneKey = 'cloneof'
+        if element.get(key=cloneKey) is None:
+            return 'parents'
+        return 'clones'
+
     def __extractElements__(self, elements) -> bool:
         """
         Extract games and roms data from the XML descriptor using lxml
-        keeping it in etree._Elements
+        loading them into the compact model, see model.GameSet
         """
-        bioses: list[etree._Element] = []
-        parents: list[etree._Element] = []
-        clones: list[etree._Element] = []
+        labels = {'bioses': 'Bioses', 'parents': 'Parent ROMs',
+                  'clones': 'Clone ROMs'}
+        self.__model__ = GameSet()
         try:
             if isinstance(elements, list):
                 if len(elements) > 0:
                     for element in elements:
                         if isinstance(element, etree._Element):
-                            if element.get(key='isbios') == 'yes':
-                                bioses.append(element)
-                            else:
-                                if 'id' in self.header.keys():
-                                    # Working with No-Intro standard dat
-                                    if element.get(key='cloneofid') is None:
-                                        parents.append(element)
-                                    else:
-                                        clones.append(element)
-                                else:
-                                    # Working with Logiqx standard dat
-                                    if element.get(key='cloneof') is None:
-                                        parents.append(element)
-                                    else:
-                                        clones.append(element)
-                    if len(bioses) > 0:
-                        self.bioses = tuple(bioses)
-                        _tryLogger_(log=f'Bioses: {len(self.bioses)}',
-                                    level='info')
-                    if len(parents) > 0:
-                        self.parents = tuple(parents)
-                        _tryLogger_(log=f'Parent ROMs: {len(self.parents)}',
-                                    level='info')
-                    if len(clones) > 0:
-                        self.clones = tuple(clones)
-                        _tryLogger_(log=f'Clone ROMs: {len(self.clones)}',
-                                    level='info')
-                    if ('bioses' or 'parents' or 'clones') in locals().keys():
-                        return True
+                            self.__model__.add(game=self.__timedLoad__(
+                                element=element, table=self.__model__.roms))
+                    self.__account__()
+                    for group, found in self.__model__.groups.items():
+                        if len(found) > 0:
+                            _tryLogger_(log=f'{labels[group]}: {len(found)}',
+                                        level='info')
+                    return len(self.__model__) > 0
             return False
         except Exception as e:
             _tryLogger_(log='An error occurred retrieving parents, clones and '
-                        'bioses')
+                        f'bioses: {e}', level='error')
             return False
-    
+
+    def __timedLoad__(self, element: etree._Element, table: RomTable) -> Game:
+        """
+        Classify and convert a game element, adding the time spent in each
+        step to the pending classify and convert totals.
+        """
+        started = time.perf_counter()
+        category = self.__classify__(element=element)
+        classified = time.perf_counter()
+        game = self.__loadGame__(element=element, category=category,
+                                 table=table)
+        self.__timings__[0] += classified - started
+        self.__timings__[1] += time.perf_counter() - classified
+        return game
+
+    def __account__(self) -> None:
+        """
+        Move the classify and convert totals of the model just built to the
+        metrics registry.
+        """
+        games = len(self.__model__) # type: ignore
+        metrics.add(name='classify', seconds=self.__timings__[0], calls=games)
+        metrics.add(name='convert', seconds=self.__timings__[1], calls=games)
+        metrics.count(name='games', value=games)
+        metrics.count(name='roms', value=len(self.__model__.roms)) # type: ignore
+        self.__timings__ = [0.0, 0.0]
+
+    def __detectSchema__(self, docInfo: etree.DocInfo,
+                         header: etree._Element | None) -> str | None:
+        """
+        Detect the descriptor schema from its DOCTYPE and header, storing
+        docInfo and header on the way. Return the nodeTags key to use or None
+        """
+        if not self.__getDocInfo__(data=docInfo): # retrieving xml DOCInfo
+            self.docInfo = {}
+            _tryLogger_(log='No xml DOC info found', level='warning')
+        # retrieving xml Header
+        if not self.__getHeader__(data=header):
+            _tryLogger_(log='No header found', level='error')
+            return None
+        schema = detector.schemaOf(docInfo=self.docInfo, header=self.header)
+        if schema is None:
+            _tryLogger_(log=f'Descriptor is of unknow type', level='error')
+        return schema
+
     def __extractData__(self) -> bool:
         """
-        Data extraction manager.
+        Data extraction manager. The descriptor type is first detected from
+        its prefix (see detector), the full document is parsed only once it
+        is known to be loadable.
         """
-        # Defining game nodeTags, keys are used to scan for some notehead in header and 
-        # values are used to scan for game elements
-        nodeTags = {
-            'no-intro':['game'],
-            'finalburn':['game'],
-            'mame':['game', 'machine']
-        }
-        issuers: tuple[str, ...] = ('logiqx', 'no-intro') # Words to search for in doc info
-        issuer: str | None = None # If found in the doc info
-        hasId: bool = False # If header has ID field
-        noteHead: str | None = None # If found in the header
-        
+        with metrics.timer(name='detect'):
+            info = detector.sniff(descriptor=self.descriptor, logger=thisLogger)
+        self.format = info.format or 'xml'
+        if self.format == 'clrmamepro' and not info.valid:
+            _tryLogger_(log=info.error, level='error')
+            return False
+        if info.valid:
+            self.schema = info.schema
+            self.header = info.header
+            self.docInfo = info.docInfo
+            _tryLogger_(log=f'Descriptor detected as {self.schema}',
+                        level='debug')
+        else: # let the full parse tell what is wrong
+            _tryLogger_(log=f'Prefix detection failed: {info.error}',
+                        level='debug')
+            self.schema = None
+        if self.streaming:
+            return self.schema is not None or self.__extractPrologue__()
+        if self.format == 'clrmamepro':
+            return self.__extractBlocks__()
         parser = etree.XMLParser(remove_blank_text=True) # some parser options here
         try:
-            tree = etree.parse(source=self.descriptor, parser=parser)
-            if self.__getDocInfo__(data=tree.docinfo): # retrieving xml DOCInfo
-                for info in self.docInfo:
-                    if type(self.docInfo[info]) == str:
-                        for i in issuers:
-                            if i in self.docInfo[info]:
-                                issuer = i
-                                _tryLogger_(log=f'DOC Type seems like {issuer}'
-                                            f' - found in "{info}" DOC Info '
-                                            'tag', level='debug')
-                                break
-                    if issuer != None:
-                        break
-                if issuer is None:
-                        _tryLogger_(log='Unknow xml DOC Type', level='debug')
-            else:
-                _tryLogger_(log='No xml DOC info found', level='warning')
-            # retrieving xml Header
-            if not self.__getHeader__(data=tree.find(path='//header')):
-                _tryLogger_(log='No header found', level='error')
+            with metrics.timer(name='parse'):
+                tree = etree.parse(source=self.descriptor, parser=parser)
+            if self.schema is None:
+                self.schema = self.__detectSchema__(
+                    docInfo=tree.docinfo, header=tree.find(path='.//header'))
+            if self.schema is None:
                 return False
-            if 'id' in self.header.keys():
-                hasId = True # Descriptor has ID
-            for element in self.header: # retrieving some "unique" notehead
-                for n in nodeTags.keys():
-                    if n in self.header[element]['text'].lower():
-                        noteHead = n
-                        _tryLogger_(log=f'Header seems like {noteHead} - '
-                                    f'found in "{element}" header tag')
-                        break
-                if noteHead != None:
-                    break 
-            if noteHead is None:
-                _tryLogger_(log=f'Descriptor is of unknow type', level='error')
+            nodeTags = self.nodeTags[self.schema]
+            if not self.__extractElements__(elements=tree.xpath(
+                    ' | '.join(f'//{tag}' for tag in nodeTags))):
+                _tryLogger_(log=f'No game elements found with tags {nodeTags}',
+                            level='error')
                 return False
-            schema = getWeight(issuer, hasId, noteHead):
-                pass
-            # nodeTag = nodeTags.get(schema)
-            # if not self.__extractElements__(elements=tree.xpath(_path='//'+f'{nodeTag}')):
-            #     _tryLogger_(log=f'No game elements found with tag "{nodeTag}"', level='error')
-            #     return False
         except Exception as e:
             if isinstance(e, etree.XMLSyntaxError):
                 return False
             else:
                 raise
         return True
-    
-    def getWeight(self, issuer, hasId, noteHead)
-    
+
+    def __extractBlocks__(self) -> bool:
+        """
+        Data extraction manager of ClrMamePro descriptors, whose blocks are
+        turned into the same elements as their XML counterparts.
+        """
+        try:
+            with metrics.timer(name='parse'):
+                elements = [element for element in self.__iterElements__()
+                            if element.tag != 'header']
+        except SyntaxError as e:
+            _tryLogger_(log=f'ClrMamePro syntax error: {e}', level='error')
+            return False
+        if not self.__extractElements__(elements=elements):
+            _tryLogger_(log='No game blocks found', level='error')
+            return False
+        return True
+
+    def __iterElements__(self) -> Iterator[etree._Element]:
+        """
+        Stream the descriptor with etree.iterparse yielding the header first
+        and then one game element at a time. Every yielded element is cleared
+        (together with its already processed siblings) as soon as the consumer
+        asks for the next one, so memory stays flat whatever the DAT size.
+        ClrMamePro descriptors are streamed block by block by clrmamepro.
+        """
+        source = getattr(self.descriptor, 'buffer', self.descriptor)
+        if self.format == 'clrmamepro':
+            yield from clrmamepro.iterElements(source=source, logger=thisLogger)
+            return
+        source.seek(0)
+        tags = set(tag for tags in self.nodeTags.values() for tag in tags)
+        context = etree.iterparse(source, events=('end',),
+                                  tag=('header', *tags),
+                                  remove_blank_text=True)
+        for _, element in context:
+            yield element
+            element.clear(keep_tail=True)
+            parent = element.getparent()
+            if parent is not None:
+                while element.getprevious() is not None:
+                    del parent[0]
+        del context
+
+    def __extractPrologue__(self) -> bool:
+        """
+        Streaming counterpart of the data extraction manager: parse only up to
+        the header, detect the schema and leave games to iterGames.
+        """
+        elements = self.__iterElements__()
+        try:
+            for element in elements:
+                if element.tag != 'header':
+                    break
+                self.schema = self.__detectSchema__(
+                    docInfo=element.getroottree().docinfo,
+                    header=element)
+                return self.schema is not None
+            _tryLogger_(log='No header found', level='error')
+            return False
+        except etree.XMLSyntaxError:
+            return False
+        finally:
+            elements.close()
+
+    @property
+    def model(self) -> GameSet:
+        """
+        Compact model of the whole set. It is built while parsing in memory
+        mode, while in streaming mode it is loaded from the descriptor cache
+        or streamed from the descriptor on first access, without ever
+        holding the full tree.
+        """
+        if self.__model__ is None and self.streaming and self.__loadCache__():
+            return self.__model__ # type: ignore
+        if self.__model__ is None:
+            model = GameSet()
+            nodeTags = self.nodeTags[self.schema]
+            for element in metrics.timed(name='parse',
+                                         items=self.__iterElements__()):
+                if element.tag in nodeTags:
+                    model.add(game=self.__timedLoad__(element=element,
+                                                      table=model.roms))
+            self.__model__ = model
+            self.__account__()
+        return self.__model__
+
+    @property
+    def games(self) -> GameView:
+        """
+        Lazy mapping of game name to the same dict getGames returns for it,
+        e.g. romset.games['mslug'] or romset.games.select(rSet='clones',
+        year=1996). Games are converted on access only, see model.GameView.
+        """
+        if self.__games__ is None:
+            self.__games__ = GameView(gameSet=self.model)
+        return self.__games__
+
+    @property
+    def index(self) -> RomIndex:
+        """
+        Hash lookup indexes over every ROM of the set, built once on first
+        access, see model.RomIndex.
+        """
+        if self.__index__ is None:
+            model = self.model
+            with metrics.timer(name='index'):
+                self.__index__ = RomIndex(gameSet=model)
+            _tryLogger_(log=f'Hash index built: {len(self.__index__.crcs)} '
+                        f'size+crc, {len(self.__index__.sha1s)} sha1, '
+                        f'{len(self.__index__.md5s)} md5 keys', level='debug')
+            if self.streaming: # model and index are both there now
+                self.__saveCache__()
+        return self.__index__
+
+    @property
+    def relations(self) -> RomGraph:
+        """
+        Parent, clone and BIOS relationships with every merge resolved, built
+        once on first access.
+        """
+        if self.__relations__ is None:
+            model = self.model
+            with metrics.timer(name='relations'):
+                self.__relations__ = RomGraph(gameSet=model,
+                                              logger=thisLogger)
+        return self.__relations__
+
+    def iterGames(self, rSet: Literal['bioses', 'parents', 'clones', 'all']
+                  = 'all') -> Iterator[tuple[str, dict]]:
+        """
+        Stream games from the descriptor, classifying each one as parent, clone
+        or BIOS on the fly and yielding (name, data) pairs with the same data
+        shape returned by getGames. Works in both streaming and in-memory mode,
+        in streaming mode the descriptor is read again on every call.
+
+        Args:
+            rSet (str): The data set to retrieve. Valid values are 'bioses',
+            'parents', 'clones' or 'all'
+
+        Raises:
+            ValueError: If the set parameter has an invalid value.
+        """
+        if rSet not in ('bioses', 'parents', 'clones', 'all'):
+            raise ValueError(f"Invalid set value: {rSet}")
+        if not self.streaming:
+            for game in self.model.select(rSet=rSet):
+                yield game.name, game.toDict()
+            return
+        nodeTags = self.nodeTags[self.schema]
+        for element in self.__iterElements__():
+            if element.tag not in nodeTags:
+                continue
+            category = self.__classify__(element=element)
+            if rSet == 'all' or category == rSet:
+                game = self.__loadGame__(element=element, category=category,
+                                         table=RomTable(), rSet=rSet)
+                yield game.name, game.toDict()
+
+    def getWeight(self, issuer: str | None, hasId: bool,
+                  noteHead: str | None) -> str | None:
+        """
+        Weigh what has been found in DOC info and header to choose the
+        nodeTags key describing the descriptor, see detector.getWeight.
+        """
+        return detector.getWeight(issuer=issuer, hasId=hasId, noteHead=noteHead)
+
     def getGames(self, rSet: Literal['bioses', 'parents', 'clones', 'all']
                 = 'all') -> dict | None:
         """
-        Retrieve specific data elements based on the provided set.
+        Retrieve specific data elements based on the provided set, all
+        converted up front: use games for lazy, per game access.
 
         Args:
             rSet (str): The data set to retrieve. Valid values are 'bioses', 'parents' or
@@ -234,101 +486,87 @@ class Romset():
         """
         if rSet not in ('bioses', 'parents', 'clones', 'all'):
             raise ValueError(f"Invalid set value: {rSet}")
-        if rSet == 'all':
-            if hasattr(self, 'parents'):
-                temp = self.parents
-            if hasattr(self, 'clones'):
-                temp = self.parents + self.clones
-            if hasattr(self, 'bioses'):
-                temp = self.parents + self.clones + self.bioses
+        if self.streaming:
+            reponse = dict(self.iterGames(rSet=rSet))
         else:
-            if hasattr(self, rSet):
-                temp = getattr(self, rSet)
-        if 'temp' in locals().keys():
-            if isinstance(locals()['temp'], tuple) and len(locals()['temp']) > 0:
-                reponse: dict = {}
-                for element in temp: # type: ignore
-                    if element.tag == 'game':
-                        game = element.attrib.get('name')
-                        reponse.update({game: {'attributes': {}, 'subelements': {}}})
-                        for key, value in element.attrib.items():
-                            if value is not None:
-                                if key == 'isbios':
-                                    if value == 'yes':
-                                        reponse[game]['attributes'].update({key: True})
-                                    else:
-                                        reponse[game]['attributes'].update({key: value})
-                                else:
-                                    reponse[game]['attributes'].update({key: value})
-                        for subelement in element:
-                            if subelement.tag == 'comment':
-                                reponse[game]['subelements'].update({subelement.tag: subelement.text})
-                            elif subelement.tag == 'description':
-                                reponse[game]['subelements'].update({subelement.tag: subelement.text})
-                            elif subelement.tag == 'year':
-                                try:
-                                    newValue = int(getattr(subelement, 'text'))
-                                    reponse[game]['subelements'].update({subelement.tag: newValue})
-                                except Exception as e:
-                                        _tryLogger_(log=f'Error converting year into integer for {str(object=game)}: {e}')
-                                        reponse[game]['subelements'].update({subelement.tag: subelement.text})
-                            elif subelement.tag == 'manufacturer':
-                                reponse[game]['subelements'].update({subelement.tag: subelement.text})
-                            elif subelement.tag == 'rom':
-                                rom = subelement.attrib.get('name')
-                                if not subelement.tag in reponse[game]['subelements'].keys():
-                                    reponse[game]['subelements'].update({subelement.tag: {}})
-                                reponse[game]['subelements'][subelement.tag].update({rom: {}})
-                                for key, value in subelement.attrib.items():
-                                    if value is not None:
-                                        if key == 'size':
-                                            try:
-                                                newValue = int(value)
-                                                reponse[game]['subelements'][subelement.tag][rom].update({key: newValue})
-                                            except Exception as e:
-                                                _tryLogger_(log=f'Error converting year into integer for {str(object=game)}: {e}')
-                                                reponse[game]['subelements'][subelement.tag][rom].update({key: value})
-                                        else:
-                                            reponse[game]['subelements'][subelement.tag][rom].update({key: value})
-                            elif subelement.tag == 'video':
-                                reponse[game]['subelements'].update({subelement.tag: {}})
-                                for key, value in subelement.items():
-                                    if value is not None:
-                                        if key in {'width', 'height', 'aspectx', 'aspecty'}:
-                                            try:
-                                                newValue = int(value)
-                                                reponse[game]['subelements'][subelement.tag].update({key: newValue})
-                                            except Exception as e:
-                                                _tryLogger_(log=f'Error converting video data into integer for {str(object=game)}: {e}')
-                                                reponse[game]['subelements'][subelement.tag].update({key: value})
-                                        else:
-                                            reponse[game]['subelements'][subelement.tag].update({key: value})
-                            elif subelement.tag == 'driver':
-                                reponse[game]['subelements'].update({subelement.tag: {}})
-                                for key, value in subelement.items():
-                                    if value is not None:
-                                        if key == 'status':
-                                            if value == 'good':
-                                                reponse[game]['subelements'][subelement.tag].update({key: True})
-                                            elif value == 'bad':
-                                                reponse[game]['subelements'][subelement.tag].update({key: False})
-                                            else:
-                                                reponse[game]['subelements'][subelement.tag].update({key: value})
-                                        else:
-                                            reponse[game]['subelements'][subelement.tag].update({key: value})
-                            else:
-                                reponse[game]['subelements'].update({subelement.tag: subelement.text})
+            reponse = self.model.toDict(rSet=rSet)
+        return reponse if len(reponse) > 0 else None
+
+    def __loadGame__(self, element: etree._Element, category: Literal[
+                     'bioses', 'parents', 'clones'], table: RomTable,
+                     rSet: str = 'all') -> Game:
+        """
+        Convert a single game element into a Game, appending its ROMs to the
+        given table. Where possible datas are converted to int and bool.
+        """
+        if element.tag not in ('game', 'machine'):
+            raise ValueError(f'Non-game element found scanning {rSet}')
+        game = element.attrib.get('name')
+        attributes: dict[str, Any] = {}
+        for key, value in element.attrib.items():
+            if value is not None:
+                if key == 'isbios' and value == 'yes':
+                    attributes[key] = True
+                else:
+                    attributes[key] = value
+        known: dict[str, Any] = {}
+        extra: dict[str, Any] = {}
+        start = len(table)
+        for subelement in element:
+            if subelement.tag == 'rom':
+                table.append(attributes=subelement.attrib)
+            elif subelement.tag in ('description', 'manufacturer'):
+                if subelement.text == game:
+                    known[subelement.tag] = game # share the name string
+                elif subelement.text is not None:
+                    known[subelement.tag] = subelement.text
+                else:
+                    extra[subelement.tag] = None
+            elif subelement.tag == 'year':
+                try:
+                    known[subelement.tag] = int(getattr(subelement, 'text'))
+                except Exception as e:
+                    _tryLogger_(log=f'Error converting year into integer for {str(object=game)}: {e}')
+                    if subelement.text is not None:
+                        known[subelement.tag] = subelement.text
                     else:
-                        raise ValueError(f'Non-game element found scanning {rSet}')
-                return reponse
-            return None
-        return None
+                        extra[subelement.tag] = None
+            elif subelement.tag == 'video':
+                video: dict[str, Any] = {}
+                for key, value in subelement.items():
+                    if value is not None:
+                        if key in {'width', 'height', 'aspectx', 'aspecty'}:
+                            try:
+                                video[key] = int(value)
+                            except Exception as e:
+                                _tryLogger_(log=f'Error converting video data into integer for {str(object=game)}: {e}')
+                                video[key] = value
+                        else:
+                            video[key] = value
+                extra[subelement.tag] = video
+            elif subelement.tag == 'driver':
+                driver: dict[str, Any] = {}
+                for key, value in subelement.items():
+                    if value is not None:
+                        if key == 'status' and value == 'good':
+                            driver[key] = True
+                        elif key == 'status' and value == 'bad':
+                            driver[key] = False
+                        else:
+                            driver[key] = value
+                extra[subelement.tag] = driver
+            else:
+                extra[subelement.tag] = subelement.text
+        return Game(name=game, category=category, attributes=attributes,
+                    table=table, start=start, stop=len(table),
+                    extra=extra or None, **known)
 
 def _tryLogger_(log: Any, level: Literal['debug', 'info', 'warning', 'error',
                 'critical'] = 'debug') -> None:
     if thisLogger is not None:
-        thisLogger.name = __name__
-        log_method = getattr(thisLogger, level)
-        log_method(log)
+        number = LOG_LEVELS[level]
+        if thisLogger.isEnabledFor(number): # nothing else when filtered out
+            thisLogger.name = __name__
+            thisLogger.log(number, log)
     else:
         print(f'Error writing log, continuing with simple print\n{log}')
\ No newline at end of file
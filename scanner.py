@@ -0,0 +1,534 @@
+# This module is the romset/feed folders scanning engine: it walks folders and
+# computes CRC32, MD5 and SHA1 of every candidate file in a single read pass,
+# spreading files over a pool of threads or processes.
+
+import hashlib
+import lzma
+import os
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import (Executor, Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from logging import Logger
+from typing import (IO, TYPE_CHECKING, Any, Container, Iterable, Iterator,
+                    Literal, Optional)
+
+from metrics import LOG_LEVELS, metrics
+
+if TYPE_CHECKING:
+    from hashcache import HashCache
+
+try:
+    import py7zr
+    from py7zr.exceptions import ArchiveError, PasswordRequired
+except ImportError: # 7z archives are then hashed like plain files
+    py7zr = None
+    ArchiveError = PasswordRequired = OSError # type: ignore
+
+try:
+    from py7zr.io import Py7zIO, WriterFactory
+except ImportError: # py7zr before 0.22, 7z members cannot be streamed
+    Py7zIO = WriterFactory = None # type: ignore
+
+thisLogger: Logger | None = None
+
+DEFAULT_CHUNK_SIZE: int = 4 * 1024 * 1024 # 4 MiB reads keep NAS links busy
+DEFAULT_BIG_FILE: int = 256 * 1024 * 1024 # CRC32 alone first from this size
+
+ARCHIVE_EXTENSIONS: tuple[str, ...] = ('.zip', '.7z')
+
+# Errors making a single file, or archive member, unreadable: broken or
+# encrypted archives, unknown compression methods, I/O errors...
+READ_ERRORS: tuple[type[BaseException], ...] = (
+    OSError, EOFError, zipfile.BadZipFile, RuntimeError, NotImplementedError,
+    lzma.LZMAError, zlib.error, ArchiveError, PasswordRequired)
+
+# Valid (size << 32 | crc32) keys and ROM sizes, shared by the hashing workers
+_crcKeys_: Container[int] | None = None
+_sizes_: Container[int] | None = None
+
+class FileHashes():
+    """
+    Result of hashing a single file, digests are binary, crc is an int.
+    Archive members carry the archive path and their name in member, their
+    crc and size come from the archive headers unless they were verified.
+    """
+    __slots__ = ('path', 'size', 'crc', 'md5', 'sha1', 'member')
+
+    def __init__(self, path: str, size: int, crc: int | None = None,
+                 md5: bytes | None = None, sha1: bytes | None = None,
+                 member: str | None = None) -> None:
+        self.path = path
+        self.size = size
+        self.crc = crc
+        self.md5 = md5
+        self.sha1 = sha1
+        self.member = member
+
+    def __repr__(self) -> str:
+        crc = None if self.crc is None else f'{self.crc:08x}'
+        member = '' if self.member is None else f', member={self.member!r}'
+        return (f'FileHashes({self.path!r}{member}, size={self.size}, '
+                f'crc={crc})')
+
+    @property
+    def name(self) -> str:
+        """
+        Printable location, archive/member for archive members.
+        """
+        if self.member is None:
+            return self.path
+        return os.path.join(self.path, self.member)
+
+class ScanStats():
+    """
+    Throughput counters of a scan.
+    """
+    __slots__ = ('files', 'bytes', 'members', 'cached', 'skipped',
+                 'skippedBytes', 'unreadable', 'started', 'finished')
+
+    def __init__(self) -> None:
+        self.files: int = 0
+        self.bytes: int = 0 # bytes actually read and hashed
+        self.members: int = 0 # archive members identified from headers
+        self.cached: int = 0 # files served by the hash cache
+        self.skipped: int = 0 # files never read because of their size
+        self.skippedBytes: int = 0
+        self.unreadable: int = 0 # files that could not be hashed
+        self.started: float = time.perf_counter()
+        self.finished: float | None = None
+
+    @property
+    def elapsed(self) -> float:
+        end = self.finished if self.finished is not None else time.perf_counter()
+        return max(end - self.started, 1e-9)
+
+    def __str__(self) -> str:
+        megabytes = self.bytes / (1024 * 1024)
+        report = (f'{self.files} files, {megabytes:.1f} MB in '
+                  f'{self.elapsed:.2f}s ({self.files / self.elapsed:.1f} '
+                  f'files/s, {megabytes / self.elapsed:.1f} MB/s)')
+        if self.members:
+            report += f', {self.members} archive members read from headers'
+        if self.cached:
+            report += f', {self.cached} files from cache'
+        if self.skipped:
+            report += (f', {self.skipped} files '
+                       f'({self.skippedBytes / (1024 * 1024):.1f} MB) '
+                       'skipped by size')
+        if self.unreadable:
+            report += f', {self.unreadable} unreadable files'
+        return report
+
+if Py7zIO is not None:
+    class _HashWriter_(Py7zIO): # type: ignore
+        """
+        py7zr writer hashing a member as it is decompressed, keeping nothing.
+        """
+        def __init__(self) -> None:
+            self.length = 0
+            self.crc = 0
+            self.md5 = hashlib.md5()
+            self.sha1 = hashlib.sha1()
+
+        def write(self, s: bytes | bytearray) -> int:
+            self.length += len(s)
+            self.crc = zlib.crc32(s, self.crc)
+            self.md5.update(s)
+            self.sha1.update(s)
+            return len(s)
+
+        def read(self, size: int | None = None) -> bytes:
+            return b''
+
+        def seek(self, offset: int, whence: int = 0) -> int:
+            return self.length
+
+        def flush(self) -> None:
+            pass
+
+        def size(self) -> int:
+            return self.length
+
+    class _HashWriters_(WriterFactory): # type: ignore
+        def __init__(self) -> None:
+            self.writers: dict[str, _HashWriter_] = {}
+
+        def create(self, filename: str) -> _HashWriter_:
+            writer = _HashWriter_()
+            self.writers[filename] = writer
+            return writer
+
+def hashStream(stream: IO[bytes], chunkSize: int = DEFAULT_CHUNK_SIZE,
+               algorithms: Iterable[Literal['crc', 'md5', 'sha1']]
+               = ('crc', 'md5', 'sha1')) -> tuple[int, int | None,
+                                               bytes | None, bytes | None]:
+    """
+    Hash a binary stream reading it once, in chunkSize blocks, into a reused
+    buffer. zlib and hashlib release the GIL on big blocks so threads scale
+    too. Return size, crc, md5 and sha1.
+    """
+    algorithms = set(algorithms)
+    crc = 0 if 'crc' in algorithms else None
+    md5 = hashlib.md5() if 'md5' in algorithms else None
+    sha1 = hashlib.sha1() if 'sha1' in algorithms else None
+    buffer = bytearray(chunkSize)
+    view = memoryview(buffer)
+    size = 0
+    while True:
+        read = stream.readinto(buffer) # type: ignore
+        if not read:
+            break
+        size += read
+        block = view[:read]
+        if crc is not None:
+            crc = zlib.crc32(block, crc)
+        if md5 is not None:
+            md5.update(block)
+        if sha1 is not None:
+            sha1.update(block)
+    return (size, crc, None if md5 is None else md5.digest(),
+            None if sha1 is None else sha1.digest())
+
+def hashFile(path: str, chunkSize: int = DEFAULT_CHUNK_SIZE,
+             algorithms: Iterable[Literal['crc', 'md5', 'sha1']]
+             = ('crc', 'md5', 'sha1')) -> FileHashes:
+    """
+    Hash a file reading it once, see hashStream.
+    """
+    with open(file=path, mode='rb', buffering=0) as file:
+        size, crc, md5, sha1 = hashStream(stream=file, chunkSize=chunkSize,
+                                          algorithms=algorithms)
+    return FileHashes(path=path, size=size, crc=crc, md5=md5, sha1=sha1)
+
+def isArchive(path: str) -> bool:
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.7z':
+        return py7zr is not None
+    return extension in ARCHIVE_EXTENSIONS
+
+def _wanted_(size: int, crc: int | None, sizes: Container[int] | None,
+             crcKeys: Container[int] | None) -> bool:
+    """
+    Tell if a file or archive member may match a ROM and so is worth its
+    MD5 and SHA1.
+    """
+    if sizes is not None and size not in sizes:
+        return False
+    if crcKeys is not None and crc is not None:
+        return (size << 32 | crc) in crcKeys
+    return True
+
+def identifyArchive(path: str, chunkSize: int = DEFAULT_CHUNK_SIZE,
+                    verify: bool = False) -> list[FileHashes]:
+    """
+    Identify the members of a zip or 7z archive from its headers only: the
+    central directory already stores every member CRC32 and uncompressed
+    size, so nothing is decompressed nor written to disk. With verify the
+    members that may match a ROM are stream decompressed and hashed to get
+    their real CRC32, MD5 and SHA1.
+    """
+    results: list[FileHashes] = []
+    if os.path.splitext(path)[1].lower() == '.7z':
+        with py7zr.SevenZipFile(path, mode='r') as archive: # type: ignore
+            infos = [info for info in archive.list() if not info.is_directory]
+            for info in infos:
+                results.append(FileHashes(path=path, size=info.uncompressed,
+                                          crc=info.crc32, member=info.filename))
+            if verify and Py7zIO is None:
+                _tryLogger_(log=f'Cannot verify {path} members, py7zr 0.22 '
+                            'or later is needed', level='debug')
+            elif verify:
+                targets = [r.member for r in results
+                           if _wanted_(size=r.size, crc=r.crc, sizes=_sizes_,
+                                      crcKeys=_crcKeys_)]
+                if targets:
+                    archive.reset()
+                    # streamed through hashing writers, nothing is kept
+                    factory = _HashWriters_()
+                    archive.extract(targets=targets, factory=factory)
+                    for result in results:
+                        writer = factory.writers.get(result.member) # type: ignore
+                        if writer is not None:
+                            result.size = writer.length
+                            result.crc = writer.crc
+                            result.md5 = writer.md5.digest()
+                            result.sha1 = writer.sha1.digest()
+        return results
+    with zipfile.ZipFile(file=path, mode='r') as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            result = FileHashes(path=path, size=info.file_size, crc=info.CRC,
+                                member=info.filename)
+            if verify and _wanted_(size=info.file_size, crc=info.CRC,
+                                   sizes=_sizes_, crcKeys=_crcKeys_):
+                try:
+                    with archive.open(name=info, mode='r') as member:
+                        (result.size, result.crc, result.md5,
+                         result.sha1) = hashStream(stream=member,
+                                                   chunkSize=chunkSize)
+                except READ_ERRORS as e:
+                    _tryLogger_(log=f'Bad member {info.filename} in {path}: '
+                                f'{e}', level='warning')
+                    result.crc = None # the header crc cannot be trusted
+            results.append(result)
+    return results
+
+def _initWorker_(crcKeys: Container[int] | None, sizes: Container[int]
+                 | None) -> None:
+    global _crcKeys_, _sizes_
+    _crcKeys_ = crcKeys
+    _sizes_ = sizes
+
+def identifyFile(path: str, chunkSize: int = DEFAULT_CHUNK_SIZE,
+                 bigFile: int | None = DEFAULT_BIG_FILE) -> FileHashes:
+    """
+    Hash a file like hashFile but, when it is at least bigFile bytes and the
+    worker knows the valid size+CRC32 keys, compute the CRC32 alone first and
+    read it again for MD5 and SHA1 only if that CRC32 belongs to some ROM.
+    """
+    if bigFile is None or _crcKeys_ is None or os.path.getsize(path) < bigFile:
+        return hashFile(path=path, chunkSize=chunkSize)
+    result = hashFile(path=path, chunkSize=chunkSize, algorithms=('crc',))
+    if (result.size << 32 | result.crc) not in _crcKeys_: # type: ignore
+        return result
+    digests = hashFile(path=path, chunkSize=chunkSize, algorithms=('md5', 'sha1'))
+    result.md5 = digests.md5
+    result.sha1 = digests.sha1
+    return result
+
+def walkFolders(folders: Iterable[str], recursive: bool = False
+                ) -> Iterator[tuple[str, os.stat_result]]:
+    """
+    Yield (path, stat) of every regular file in folders using os.scandir, so
+    stat data comes from the directory listing without extra calls where the
+    OS allows it.
+    """
+    pending = deque(folders)
+    while pending:
+        folder = pending.popleft()
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file(follow_symlinks=False):
+                            stat = entry.stat(follow_symlinks=False)
+                            if stat.st_ino == 0: # Windows scandir leaves it out
+                                stat = os.stat(entry.path, follow_symlinks=False)
+                            yield entry.path, stat
+                        elif recursive and entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                    except OSError as e:
+                        _tryLogger_(log=f'Cannot stat {entry.path}: {e}',
+                                    level='warning')
+        except OSError as e:
+            _tryLogger_(log=f'Cannot list {folder}: {e}', level='warning')
+
+class Scanner():
+    """
+    Parallel hashing engine for romset and feed folders.
+    """
+    def __init__(self, workers: Optional[int] = None, chunkSize: int
+                 = DEFAULT_CHUNK_SIZE, processes: bool = False,
+                 bigFile: int | None = DEFAULT_BIG_FILE, archives: bool = True,
+                 verify: bool = False, cache: Optional['HashCache'] = None,
+                 logger: Optional['Logger'] = None) -> None:
+        """
+        Constructor of the class.
+
+        Arguments:
+        - workers (int): Number of parallel hashing workers, all cores by
+          default.
+        - chunkSize (int): Size of every read.
+        - processes (bool): Use a process pool instead of a thread pool, only
+          useful when hashing small files where the GIL is not released.
+        - bigFile (int): Files from this size on are CRC32 checked before
+          computing MD5 and SHA1, None to always hash everything at once.
+        - archives (bool): Identify zip/7z members from the archive headers
+          instead of hashing the archive file itself.
+        - verify (bool): Decompress and hash archive members too, needed
+          to get their MD5 and SHA1.
+        - cache (HashCache): Persistent hash cache, files unchanged since
+          the previous scan are not read again.
+        """
+        global thisLogger
+        thisLogger = logger
+        self.workers = workers or os.cpu_count() or 1
+        self.chunkSize = chunkSize
+        self.processes = processes
+        self.bigFile = bigFile
+        self.archives = archives
+        self.verify = verify
+        self.cache = cache
+        self.stats = ScanStats()
+
+    def __executor__(self, crcKeys: Container[int] | None, sizes:
+                     Container[int] | None) -> Executor:
+        if self.processes:
+            # sent once to every worker
+            if crcKeys is not None:
+                crcKeys = frozenset(crcKeys)
+            if sizes is not None:
+                sizes = frozenset(sizes)
+            return ProcessPoolExecutor(max_workers=self.workers,
+                                       initializer=_initWorker_,
+                                       initargs=(crcKeys, sizes))
+        return ThreadPoolExecutor(max_workers=self.workers,
+                                  thread_name_prefix='romix-hash',
+                                  initializer=_initWorker_,
+                                  initargs=(crcKeys, sizes))
+
+    def __complete__(self, path: str, results: list[FileHashes],
+                     crcKeys: Container[int] | None,
+                     sizes: Container[int] | None) -> bool:
+        """
+        Tell if cached results are as complete as hashing the file again
+        would give: digests may be missing only where they would be skipped.
+        """
+        if self.archives and isArchive(path=path):
+            if not self.verify:
+                return True
+        elif self.bigFile is None or results[0].size < self.bigFile:
+            return results[0].sha1 is not None
+        return all(result.sha1 is not None or result.crc is None or
+                   not _wanted_(size=result.size, crc=result.crc, sizes=sizes,
+                                crcKeys=crcKeys) for result in results)
+
+    def hashMany(self, files: Iterable[tuple[str, os.stat_result]], crcKeys:
+                 Container[int] | None = None, sizes: Container[int] | None
+                 = None) -> Iterator[FileHashes]:
+        """
+        Hash (path, stat) pairs in parallel keeping at most a few jobs per
+        worker in flight. With crcKeys big files are CRC32 checked first, see
+        identifyFile; archive members whose size is not in sizes are dropped.
+        Files unchanged since they were stored in the hash cache are not read.
+        """
+        inFlight: deque[tuple[Future, str, os.stat_result]] = deque()
+        limit = self.workers * 4
+        with self.__executor__(crcKeys=crcKeys, sizes=sizes) as executor:
+            for path, stat in files:
+                if self.cache is not None:
+                    cached = self.cache.get(path=path, stat=stat)
+                    if cached and self.__complete__(path=path, results=cached,
+                                                    crcKeys=crcKeys,
+                                                    sizes=sizes):
+                        self.stats.cached += 1
+                        yield from self.__filter__(results=cached, sizes=sizes,
+                                                   read=False)
+                        continue
+                if self.archives and isArchive(path=path):
+                    future = executor.submit(identifyArchive, path,
+                                             self.chunkSize, self.verify)
+                else:
+                    future = executor.submit(identifyFile, path,
+                                             self.chunkSize, self.bigFile)
+                inFlight.append((future, path, stat))
+                if len(inFlight) >= limit:
+                    yield from self.__collect__(*inFlight.popleft(),
+                                                sizes=sizes)
+            while inFlight:
+                yield from self.__collect__(*inFlight.popleft(), sizes=sizes)
+        self.stats.finished = time.perf_counter()
+
+    def __collect__(self, future: Future, path: str, stat: os.stat_result,
+                    sizes: Container[int] | None) -> Iterator[FileHashes]:
+        try:
+            results = future.result()
+        except READ_ERRORS as e:
+            self.__unreadable__(path=path, error=e)
+            return
+        if isinstance(results, FileHashes):
+            results = [results]
+        if self.cache is not None:
+            self.cache.put(path=path, stat=stat, results=results)
+        yield from self.__filter__(results=results, sizes=sizes, read=True)
+
+    def __unreadable__(self, path: str, error: BaseException) -> None:
+        """
+        Skip a file that cannot be hashed, the scan goes on.
+        """
+        self.stats.unreadable += 1
+        _tryLogger_(log=f'Cannot hash file {path}: {error}', level='warning')
+
+    def __filter__(self, results: list[FileHashes], sizes: Container[int]
+                   | None, read: bool) -> Iterator[FileHashes]:
+        for result in results:
+            if result.member is not None:
+                if sizes is not None and result.size not in sizes:
+                    self.stats.skipped += 1
+                    self.stats.skippedBytes += result.size
+                    continue
+                if result.sha1 is None:
+                    self.stats.members += 1
+                    yield result
+                    continue
+            self.stats.files += 1
+            if read:
+                self.stats.bytes += result.size
+            yield result
+
+    def __prefilter__(self, files: Iterable[tuple[str, os.stat_result]],
+                      sizes: Container[int]
+                      ) -> Iterator[tuple[str, os.stat_result]]:
+        for path, stat in files:
+            if stat.st_size in sizes or (self.archives and
+                                         isArchive(path=path)):
+                yield path, stat
+            else:
+                self.stats.skipped += 1
+                self.stats.skippedBytes += stat.st_size
+
+    def scan(self, folders: Iterable[str], recursive: bool = False,
+             sizes: Container[int] | None = None, crcKeys: Container[int]
+             | None = None) -> Iterator[FileHashes]:
+        """
+        Walk folders and hash every file found, see scanFiles.
+        """
+        yield from self.scanFiles(files=metrics.timed(
+            name='walk', items=walkFolders(folders=folders,
+                                           recursive=recursive)),
+            sizes=sizes, crcKeys=crcKeys)
+
+    def scanFiles(self, files: Iterable[tuple[str, os.stat_result]],
+                  sizes: Container[int] | None = None, crcKeys:
+                  Container[int] | None = None) -> Iterator[FileHashes]:
+        """
+        Hash the given (path, stat) pairs.
+
+        Arguments:
+        - sizes (Container[int]): Valid ROM sizes, files and archive members
+          of any other size cannot match and are never read.
+        - crcKeys (Container[int]): Valid (size << 32 | crc32) keys, used to
+          CRC32 check big files before full hashing.
+        """
+        self.stats = ScanStats()
+        if sizes is not None:
+            files = self.__prefilter__(files=files, sizes=sizes)
+        yield from self.hashMany(files=files, crcKeys=crcKeys, sizes=sizes)
+        self.__account__()
+        _tryLogger_(log=f'Scan completed: {self.stats}', level='debug')
+
+    def __account__(self) -> None:
+        """
+        Add the counters of the scan just completed to the metrics registry.
+        """
+        metrics.add(name='hash', seconds=self.stats.elapsed)
+        metrics.count(name='files', value=self.stats.files)
+        metrics.count(name='members', value=self.stats.members)
+        metrics.count(name='bytes read', value=self.stats.bytes)
+        metrics.count(name='cache hits', value=self.stats.cached)
+        metrics.count(name='skipped', value=self.stats.skipped)
+        metrics.count(name='unreadable', value=self.stats.unreadable)
+
+def _tryLogger_(log: Any, level: Literal['debug', 'info', 'warning', 'error',
+                'critical'] = 'debug') -> None:
+    if thisLogger is not None:
+        number = LOG_LEVELS[level]
+        if thisLogger.isEnabledFor(number): # nothing else when filtered out
+            thisLogger.name = __name__
+            thisLogger.log(number, log)
+    else:
+        print(f'Error writing log, continuing with simple print\n{log}')
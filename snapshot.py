@@ -0,0 +1,216 @@
+# This module keeps a snapshot of the directory state seen by the last scan,
+# so the next one only has to process added, changed and removed files.
+# Every directory is listed again and the size and mtime of every entry
+# compared, the stats come with the listing so this stays cheap. With
+# trustDirs, directories whose mtime did not change are not listed at all,
+# their entries come from the snapshot; faster on huge trees, but a directory
+# mtime only changes when entries are added, removed or renamed in it, so
+# files rewritten in place are then missed.
+
+import marshal
+import os
+import threading
+import time
+from collections import deque
+from logging import Logger
+from typing import Any, Callable, Iterable, Literal, Optional
+
+from metrics import LOG_LEVELS
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError: # watch mode is then unavailable
+    FileSystemEventHandler = object # type: ignore
+    Observer = None
+
+thisLogger: Logger | None = None
+
+SNAPSHOT_VERSION: int = 1
+
+# Snapshot entry of a directory: (mtime_ns, {file name: (size, mtime_ns,
+# inode)}, [subdirectory names])
+DirState = tuple[int, dict[str, tuple[int, int, int]], list[str]]
+
+class Changes():
+    """
+    Differences found by Snapshot.update.
+    """
+    __slots__ = ('added', 'changed', 'removed', 'listed', 'pruned')
+
+    def __init__(self) -> None:
+        self.added: list[tuple[str, os.stat_result]] = []
+        self.changed: list[tuple[str, os.stat_result]] = []
+        self.removed: list[str] = []
+        self.listed: int = 0 # directories listed again
+        self.pruned: int = 0 # directories reused from the snapshot
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+    def __str__(self) -> str:
+        return (f'{len(self.added)} added, {len(self.changed)} changed, '
+                f'{len(self.removed)} removed files; {self.listed} folders '
+                f'listed, {self.pruned} unchanged')
+
+    @property
+    def files(self) -> list[tuple[str, os.stat_result]]:
+        """
+        (path, stat) pairs to hash, ready for Scanner.scanFiles.
+        """
+        return self.added + self.changed
+
+class Snapshot():
+    """
+    Persistent directory state of a set of scanned folders.
+    """
+    def __init__(self, path: str, trustDirs: bool = False,
+                 logger: Optional['Logger'] = None) -> None:
+        """
+        Constructor of the class.
+
+        Arguments:
+        - path (str): Snapshot file, a missing one makes every file new.
+        - trustDirs (bool): Reuse the listing of directories whose mtime did
+          not change instead of checking every file, missing files
+          rewritten in place.
+        """
+        global thisLogger
+        thisLogger = logger
+        self.path = path
+        self.trustDirs = trustDirs
+        self.dirs: dict[str, DirState] = {}
+        try:
+            with open(file=path, mode='rb') as file:
+                version, dirs = marshal.load(file)
+            if version == SNAPSHOT_VERSION:
+                self.dirs = dirs
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, EOFError, TypeError) as e:
+            _tryLogger_(log=f'Cannot read snapshot {path}, starting over: {e}',
+                        level='warning')
+
+    def __listDir__(self, folder: str, mtime: int, changes: Changes
+                    ) -> DirState:
+        old = self.dirs.get(folder)
+        oldFiles = old[1] if old is not None else {}
+        files: dict[str, tuple[int, int, int]] = {}
+        subdirs: list[str] = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        if stat.st_ino == 0: # Windows scandir leaves it out
+                            stat = os.stat(entry.path, follow_symlinks=False)
+                        state = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+                        files[entry.name] = state
+                        previous = oldFiles.get(entry.name)
+                        if previous is None:
+                            changes.added.append((entry.path, stat))
+                        elif previous != state:
+                            changes.changed.append((entry.path, stat))
+                except OSError as e:
+                    _tryLogger_(log=f'Cannot stat {entry.path}: {e}',
+                                level='warning')
+        for name in oldFiles.keys() - files.keys():
+            changes.removed.append(os.path.join(folder, name))
+        changes.listed += 1
+        return (mtime, files, subdirs)
+
+    def update(self, folders: Iterable[str], recursive: bool = False
+               ) -> Changes:
+        """
+        Walk folders comparing them with the snapshot, which is updated in
+        memory, call save to persist it.
+        """
+        changes = Changes()
+        dirs: dict[str, DirState] = {}
+        pending = deque(os.path.normpath(folder) for folder in folders)
+        while pending:
+            folder = pending.popleft()
+            if folder in dirs:
+                continue
+            try:
+                mtime = os.stat(folder).st_mtime_ns
+                old = self.dirs.get(folder)
+                if self.trustDirs and old is not None and old[0] == mtime:
+                    dirs[folder] = old
+                    changes.pruned += 1
+                else:
+                    dirs[folder] = self.__listDir__(folder=folder, mtime=mtime,
+                                                    changes=changes)
+            except OSError as e:
+                _tryLogger_(log=f'Cannot list {folder}: {e}', level='warning')
+                continue
+            if recursive:
+                pending.extend(os.path.join(folder, name)
+                               for name in dirs[folder][2])
+        for folder in self.dirs.keys() - dirs.keys(): # gone or out of scope
+            changes.removed.extend(os.path.join(folder, name)
+                                   for name in self.dirs[folder][1])
+        self.dirs = dirs
+        _tryLogger_(log=f'Incremental scan: {changes}', level='debug')
+        return changes
+
+    def save(self) -> None:
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        with open(file=temporary, mode='wb') as file:
+            marshal.dump((SNAPSHOT_VERSION, self.dirs), file)
+        os.replace(temporary, self.path)
+
+class _Trigger_(FileSystemEventHandler): # type: ignore
+    def __init__(self, event: threading.Event) -> None:
+        super().__init__()
+        self.event = event
+
+    def on_any_event(self, event: Any) -> None:
+        # opened/closed events come from our own reads too
+        if event.event_type in ('created', 'deleted', 'modified', 'moved'):
+            self.event.set()
+
+def watch(folders: Iterable[str], recursive: bool, onChange: Callable[[],
+          None], debounce: float = 2.0, stop: Optional[threading.Event] = None
+          ) -> bool:
+    """
+    Call onChange every time something changes under folders, waiting for
+    debounce seconds of quiet first, until stop is set. Needs the optional
+    watchdog package (inotify on Linux, FSEvents on macOS, ReadDirectoryChangesW
+    on Windows); return False when it is not installed.
+    """
+    if Observer is None:
+        _tryLogger_(log='Watch mode needs the watchdog package', level='error')
+        return False
+    stop = stop or threading.Event()
+    event = threading.Event()
+    observer = Observer()
+    for folder in folders:
+        observer.schedule(_Trigger_(event=event), folder, recursive=recursive)
+    observer.start()
+    try:
+        while not stop.is_set():
+            if not event.wait(timeout=1.0):
+                continue
+            while event.is_set(): # let bursts of events settle
+                event.clear()
+                time.sleep(debounce)
+            onChange()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        observer.stop()
+        observer.join()
+    return True
+
+def _tryLogger_(log: Any, level: Literal['debug', 'info', 'warning', 'error',
+                'critical'] = 'debug') -> None:
+    if thisLogger is not None:
+        number = LOG_LEVELS[level]
+        if thisLogger.isEnabledFor(number): # nothing else when filtered out
+            thisLogger.name = __name__
+            thisLogger.log(number, log)
+    else:
+        print(f'Error writing log, continuing with simple print\n{log}')
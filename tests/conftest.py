@@ -0,0 +1,64 @@
+# Shared fixtures of the tests: the modules live at the repository root, and
+# romsets are built from small descriptors written on the fly.
+
+import io
+import logging
+import os
+import sys
+import zlib
+from typing import Callable, Iterable, Optional
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from romset import Romset
+
+DOCTYPE = ('<!DOCTYPE datafile PUBLIC "-//FinalBurn Neo//DTD ROM Management '
+           'Datafile//EN" "http://www.logiqx.com/Dats/datafile.dtd">')
+
+def romXml(name: str, data: Optional[bytes] = None, size: Optional[int] = None,
+           crc: Optional[int] = None, status: Optional[str] = None) -> str:
+    """
+    Return a rom element, size and CRC taken from data unless given.
+    """
+    if data is not None:
+        size = len(data) if size is None else size
+        crc = zlib.crc32(data) if crc is None else crc
+    attributes = f'name="{name}"'
+    if size is not None:
+        attributes += f' size="{size}"'
+    if crc is not None:
+        attributes += f' crc="{crc:08x}"'
+    if status is not None:
+        attributes += f' status="{status}"'
+    return f'<rom {attributes}/>'
+
+def datXml(games: Iterable[tuple], tag: str = 'game') -> bytes:
+    """
+    Return a descriptor of the given (game name, rom elements, attributes...)
+    where attributes are raw XML ones, like 'cloneof="parent"'.
+    """
+    body = ''
+    for name, roms, *attributes in games:
+        extra = ''.join(f' {attribute}' for attribute in attributes)
+        body += (f'<{tag} name="{name}"{extra}><description>{name}'
+                 f'</description>{"".join(roms)}</{tag}>')
+    return ('<?xml version="1.0"?>' + DOCTYPE + '<datafile><header><name>'
+            'Test</name><description>Test</description></header>' + body +
+            '</datafile>').encode()
+
+@pytest.fixture
+def logger() -> logging.Logger:
+    logger = logging.getLogger('romix-tests')
+    logger.setLevel(logging.DEBUG)
+    return logger
+
+@pytest.fixture
+def makeRomset(logger: logging.Logger) -> Callable[..., Romset]:
+    def make(games: Iterable[tuple], tag: str = 'game',
+             streaming: bool = False, cacheDir: Optional[str] = None
+             ) -> Romset:
+        return Romset(descriptor=io.BytesIO(datXml(games=games, tag=tag)),
+                      logger=logger, streaming=streaming, cacheDir=cacheDir)
+    return make
@@ -0,0 +1,97 @@
+# Audit statuses on a small romset, with and without numpy: only files in the
+# romset folder are in their set, dumps found anywhere else are wrong named.
+
+import os
+import zlib
+
+import pytest
+
+import audit
+from audit import BAD, HAVE, MISSING, NODUMP, WRONG_NAME, Auditor
+from conftest import romXml
+from scanner import FileHashes
+
+GOOD = b'good' * 100
+MOVED = b'moved' * 100
+CHANGED = b'changed' * 100
+ABSENT = b'absent' * 100
+SOLO = b'solo' * 100
+BIG = 4 << 30 # beyond 32 bits
+
+@pytest.fixture(params=['numpy', 'python'])
+def joins(request, monkeypatch):
+    if request.param == 'python':
+        monkeypatch.setattr(audit, 'numpy', None)
+    elif audit.numpy is None:
+        pytest.skip('numpy is not installed')
+    return request.param
+
+def _hashes_(path, data, member=None):
+    return FileHashes(path=path, size=len(data), crc=zlib.crc32(data),
+                      member=member)
+
+def _statuses_(report):
+    return {report.entries[entry]: report.statuses[entry]
+            for entry in range(len(report.entries))}
+
+def test_statuses(tmp_path, makeRomset, logger, joins):
+    romset = makeRomset(games=[
+        ('game', [romXml(name='good.bin', data=GOOD),
+                  romXml(name='moved.bin', data=MOVED),
+                  romXml(name='changed.bin', data=CHANGED),
+                  romXml(name='absent.bin', data=ABSENT),
+                  romXml(name='nodump.bin', size=100, status='nodump')]),
+        ('solo', [romXml(name='solo.nes', data=SOLO)]),
+        ('folder', [romXml(name='sub/good.bin', data=GOOD)])])
+    root = os.path.join(tmp_path, 'romset')
+    feed = os.path.join(tmp_path, 'feed')
+    archive = os.path.join(root, 'game.zip')
+    results = [
+        _hashes_(path=archive, data=GOOD, member='good.bin'),
+        _hashes_(path=archive, data=MOVED, member='renamed.bin'),
+        _hashes_(path=archive, data=GOOD, member='changed.bin'),
+        _hashes_(path=os.path.join(feed, 'game.zip'), data=ABSENT,
+                 member='absent.bin'), # right set name, not in the romset
+        _hashes_(path=os.path.join(root, 'solo.nes'), data=SOLO),
+        _hashes_(path=os.path.join(root, 'folder', 'sub', 'good.bin'),
+                 data=GOOD)]
+    report = Auditor(graph=romset.relations, index=romset.index,
+                     romset=root, logger=logger).audit(results=results)
+    assert [game.name for game in report.games] == ['game', 'solo', 'folder']
+    statuses = _statuses_(report=report)
+    assert statuses == {'good.bin': HAVE, 'moved.bin': WRONG_NAME,
+                        'changed.bin': BAD, 'absent.bin': WRONG_NAME,
+                        'nodump.bin': NODUMP, 'solo.nes': HAVE,
+                        'sub/good.bin': HAVE}
+    assert [completeness for _, completeness, _ in report.byGame()] == \
+        ['partial', 'complete', 'complete']
+    details = report.details(position=0)
+    assert details['wrongName'][0] == {'rom': 'moved.bin',
+                                       'file': results[1].name}
+    assert details['bad'] == [{'rom': 'changed.bin', 'file': results[2].name}]
+
+def test_without_romset_folder(tmp_path, makeRomset, logger, joins):
+    romset = makeRomset(games=[('game', [romXml(name='good.bin', data=GOOD),
+                                         romXml(name='absent.bin',
+                                                data=ABSENT)])])
+    results = [_hashes_(path=os.path.join(tmp_path, 'game.zip'), data=GOOD,
+                        member='good.bin')]
+    report = Auditor(graph=romset.relations, index=romset.index,
+                     logger=logger).audit(results=results)
+    assert _statuses_(report=report) == {'good.bin': WRONG_NAME,
+                                         'absent.bin': MISSING}
+
+def test_sizes_beyond_four_gigabytes(tmp_path, makeRomset, logger, joins):
+    crc = 0x12345678
+    romset = makeRomset(games=[('big', [romXml(name='big.bin', size=BIG + 5,
+                                               crc=crc)])])
+    feed = os.path.join(tmp_path, 'feed')
+    results = [FileHashes(path=os.path.join(feed, 'small.bin'), size=5,
+                          crc=crc), # same low 32 bits of size+crc
+               FileHashes(path=os.path.join(feed, 'big.bin'), size=BIG + 5,
+                          crc=crc)]
+    report = Auditor(graph=romset.relations, index=romset.index,
+                     romset=os.path.join(tmp_path, 'romset'),
+                     logger=logger).audit(results=results)
+    assert report.statuses[0] == WRONG_NAME
+    assert report.sources[0] == 1
@@ -0,0 +1,98 @@
+# The ClrMamePro tokenizer must keep quoted strings whole, nest blocks at any
+# depth across chunk boundaries and give the elements Logiqx XML would.
+
+import io
+import os
+
+import pytest
+
+import clrmamepro
+from clrmamepro import blocks, iterElements, readHeader
+from detector import openDescriptor
+from romset import Romset
+
+DESCRIPTOR = '''clrmamepro (
+\tname "Set (Test)"
+\tversion 2021-04-16
+\tforcemerging ( merge full )
+)
+
+game (
+\tname "Game (Europe) \\ Part"
+\tdescription "Quoted ( parentheses ) and  spaces"
+\tyear 1998
+\tcloneof "Parent"
+\trom ( name "a rom.bin" size 1024 crc 89ABCDEF flags baddump )
+\trom (name b.bin size 16 crc 00000001 sha1 ""
+)
+)
+resource ( name bios rom ( name bios.bin size 4 crc 1 ) )
+sample ( name ignored )
+game ( name "" )
+'''
+
+BIOS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'DAT', 'NintendoGameCubeBIOS.dat')
+
+@pytest.mark.parametrize('chunkSize', [1, 7, clrmamepro.CHUNK_SIZE])
+@pytest.mark.parametrize('wrap', [io.StringIO, io.BytesIO])
+def test_blocks(monkeypatch, chunkSize, wrap):
+    monkeypatch.setattr(clrmamepro, 'CHUNK_SIZE', chunkSize)
+    data = DESCRIPTOR if wrap is io.StringIO else DESCRIPTOR.encode()
+    parsed = list(blocks(source=wrap(data)))
+    assert [name for name, _ in parsed] == ['clrmamepro', 'game', 'resource',
+                                            'sample', 'game']
+    assert parsed[0][1] == [('name', 'Set (Test)'), ('version', '2021-04-16'),
+                            ('forcemerging', [('merge', 'full')])]
+    assert parsed[1][1] == [
+        ('name', 'Game (Europe) \\ Part'),
+        ('description', 'Quoted ( parentheses ) and  spaces'),
+        ('year', '1998'), ('cloneof', 'Parent'),
+        ('rom', [('name', 'a rom.bin'), ('size', '1024'),
+                 ('crc', '89ABCDEF'), ('flags', 'baddump')]),
+        ('rom', [('name', 'b.bin'), ('size', '16'), ('crc', '00000001'),
+                 ('sha1', '')])]
+    assert parsed[2][1] == [('name', 'bios'),
+                            ('rom', [('name', 'bios.bin'), ('size', '4'),
+                                     ('crc', '1')])]
+    assert parsed[4][1] == [('name', '')]
+
+@pytest.mark.parametrize('text', ['game ( name x', 'game ( name x ) )',
+                                  'name x', '( name x )', 'game ( name )',
+                                  'game ( name x ) "y"'])
+def test_syntax_errors(text):
+    with pytest.raises(SyntaxError):
+        list(blocks(source=io.StringIO(text)))
+
+def test_elements(logger):
+    header, game, bios, empty = iterElements(source=io.StringIO(DESCRIPTOR),
+                                             logger=logger)
+    assert header.tag == 'header'
+    assert header.findtext('name') == 'Set (Test)'
+    assert header.find('forcemerging').get('merge') == 'full'
+    assert game.tag == 'game'
+    assert game.attrib == {'name': 'Game (Europe) \\ Part',
+                           'cloneof': 'Parent'}
+    assert game.findtext('description') == \
+        'Quoted ( parentheses ) and  spaces'
+    assert game.findtext('year') == '1998'
+    assert [dict(rom.attrib) for rom in game.iterfind('rom')] == [
+        {'name': 'a rom.bin', 'size': '1024', 'crc': '89ABCDEF',
+         'status': 'baddump'},
+        {'name': 'b.bin', 'size': '16', 'crc': '00000001', 'sha1': ''}]
+    assert bios.attrib == {'name': 'bios', 'isbios': 'yes'}
+    assert empty.attrib == {'name': ''}
+    assert readHeader(source=io.StringIO(DESCRIPTOR)).findtext('version') == \
+        '2021-04-16'
+    assert readHeader(source=io.StringIO('game ( name x )')) is None
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_descriptor_in_the_tree(logger, streaming):
+    with openDescriptor(path=BIOS) as file:
+        romset = Romset(descriptor=file, logger=logger, streaming=streaming)
+        games = romset.getGames()
+    assert romset.format == 'clrmamepro'
+    assert games
+    for game in games.values():
+        for rom in game['subelements'].get('rom', {}).values():
+            assert len(rom['crc']) == 8 and len(rom['sha1']) == 40
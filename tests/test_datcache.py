@@ -0,0 +1,73 @@
+# An outdated, truncated or corrupted descriptor cache must be ignored, the
+# descriptor then parsed again and its cache rewritten.
+
+import os
+import struct
+
+import pytest
+
+import datcache
+from conftest import romXml
+
+GAMES = [('bios', [romXml(name='bios.bin', data=b'bios')], 'isbios="yes"'),
+         ('parent', [romXml(name='p.bin', data=b'parent'),
+                     romXml(name='nodump.bin', size=4, status='nodump')]),
+         ('clone', [romXml(name='c.bin', data=b'clone')],
+          'cloneof="parent" romof="parent"')]
+
+@pytest.fixture
+def cached(tmp_path, makeRomset):
+    """
+    Return the cache folder, the file written there and the games.
+    """
+    cacheDir = str(tmp_path / 'cache')
+    os.makedirs(cacheDir)
+    romset = makeRomset(games=GAMES, cacheDir=cacheDir)
+    (name,) = os.listdir(cacheDir)
+    return cacheDir, os.path.join(cacheDir, name), romset.getGames()
+
+def _check_(makeRomset, cacheDir, path, games, logger):
+    assert datcache.load(path=path, logger=logger) is None
+    romset = makeRomset(games=GAMES, cacheDir=cacheDir) # parsed again
+    assert romset.getGames() == games
+    assert len(romset.index.crcs) == 3
+    assert datcache.load(path=path, logger=logger) is not None # rewritten
+
+def test_round_trip(cached, makeRomset, logger):
+    cacheDir, path, games = cached
+    meta, gameSet, index = datcache.load(path=path, logger=logger)
+    assert meta['schema'] is not None
+    assert sorted(game.name for game in gameSet) == ['bios', 'clone', 'parent']
+    romset = makeRomset(games=GAMES, cacheDir=cacheDir)
+    assert romset.getGames() == games
+
+@pytest.mark.parametrize('field, value', [(0, b'XXXX'), (1, 99), (2, 2)])
+def test_outdated_files_are_parsed_again(cached, makeRomset, logger, field,
+                                         value):
+    cacheDir, path, games = cached
+    with open(path, 'r+b') as file:
+        prologue = list(datcache._prologue_.unpack(
+            file.read(datcache._prologue_.size)))
+        prologue[field] = value # magic, format or Python version
+        file.seek(0)
+        file.write(datcache._prologue_.pack(*prologue))
+    _check_(makeRomset=makeRomset, cacheDir=cacheDir, path=path, games=games,
+            logger=logger)
+
+@pytest.mark.parametrize('keep', [0, 3, 12, 40, -1])
+def test_truncated_files_are_parsed_again(cached, makeRomset, logger, keep):
+    cacheDir, path, games = cached
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as file:
+        file.truncate(keep % size) # -1 cuts the last owner
+    _check_(makeRomset=makeRomset, cacheDir=cacheDir, path=path, games=games,
+            logger=logger)
+
+def test_corrupted_blobs_are_parsed_again(cached, makeRomset, logger):
+    cacheDir, path, games = cached
+    with open(path, 'r+b') as file:
+        file.seek(datcache._prologue_.size)
+        (length,) = struct.unpack('<Q', file.read(8))
+        file.write(b'\xff' * length) # meta no longer unmarshals
+    _check_(makeRomset=makeRomset, cacheDir=cacheDir, path=path, games=games,
+            logger=logger)
@@ -0,0 +1,109 @@
+# Linking and storing duplicates must leave alone files changed since they
+# were compared, zip members and the only file copy of a content.
+
+import os
+import zipfile
+
+from dedup import MANIFEST, Deduplicator
+
+FIRST = os.urandom(5000)
+SECOND = os.urandom(6000)
+
+def _find_(folder, logger):
+    deduplicator = Deduplicator(workers=1, logger=logger)
+    return deduplicator.find(folders=[str(folder)])
+
+def _zip_(path, name, data):
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr(name, data)
+
+def test_link_skips_changed_files(tmp_path, logger):
+    for name in ('a.bin', 'b.bin', 'c.bin'):
+        (tmp_path / name).write_bytes(FIRST)
+    groups = _find_(folder=tmp_path, logger=logger)
+    (tmp_path / 'c.bin').write_bytes(SECOND[:len(FIRST)]) # same size
+    os.utime(tmp_path / 'c.bin', ns=(1, 1))
+    assert Deduplicator(logger=logger).link(groups=groups) == len(FIRST)
+    inodes = {name: os.stat(tmp_path / name).st_ino
+              for name in ('a.bin', 'b.bin', 'c.bin')}
+    assert inodes['a.bin'] == inodes['b.bin'] != inodes['c.bin']
+    assert (tmp_path / 'c.bin').read_bytes() == SECOND[:len(FIRST)]
+
+def test_link_leaves_zip_members(tmp_path, logger):
+    (tmp_path / 'a.bin').write_bytes(FIRST)
+    _zip_(path=tmp_path / 'a.zip', name='a.bin', data=FIRST)
+    before = (tmp_path / 'a.zip').read_bytes()
+    groups = _find_(folder=tmp_path, logger=logger)
+    assert len(groups) == 1 and len(groups[0].members) == 1
+    assert Deduplicator(logger=logger).link(groups=groups) == 0
+    assert (tmp_path / 'a.zip').read_bytes() == before
+    assert os.stat(tmp_path / 'a.bin').st_nlink == 1
+
+def test_store_keeps_single_file_copies(tmp_path, logger):
+    feed = tmp_path / 'feed'
+    feed.mkdir()
+    (feed / 'zipped.bin').write_bytes(FIRST) # its twin is a zip member
+    _zip_(path=feed / 'a.zip', name='a.bin', data=FIRST)
+    (feed / 'linked.bin').write_bytes(SECOND) # its twin is a hard link
+    _zip_(path=feed / 'b.zip', name='b.bin', data=SECOND)
+    os.link(feed / 'linked.bin', feed / 'link.bin')
+    groups = _find_(folder=feed, logger=logger)
+    assert len(groups) == 2
+    store = tmp_path / 'store'
+    assert Deduplicator(logger=logger).store(groups=groups,
+                                             folder=str(store)) == 0
+    assert sorted(os.listdir(feed)) == ['a.zip', 'b.zip', 'link.bin',
+                                        'linked.bin', 'zipped.bin']
+    assert os.listdir(store) == [MANIFEST]
+    assert (store / MANIFEST).read_text() == ''
+
+def test_store_moves_duplicates(tmp_path, logger):
+    feed = tmp_path / 'feed'
+    feed.mkdir()
+    for name in ('a.bin', 'b.bin', 'changed.bin'):
+        (feed / name).write_bytes(FIRST)
+    groups = _find_(folder=feed, logger=logger)
+    (feed / 'changed.bin').write_bytes(SECOND[:len(FIRST)])
+    os.utime(feed / 'changed.bin', ns=(1, 1))
+    store = tmp_path / 'store'
+    reclaimed = Deduplicator(logger=logger).store(groups=groups,
+                                                  folder=str(store))
+    assert reclaimed == len(FIRST)
+    assert os.listdir(feed) == ['changed.bin']
+    digest = groups[0].sha1.hex()
+    assert (store / digest[:2] / digest).read_bytes() == FIRST
+    assert len((store / MANIFEST).read_text().splitlines()) == 2
+
+def test_store_replaces_stale_objects(tmp_path, logger):
+    feed = tmp_path / 'feed'
+    feed.mkdir()
+    for name in ('a.bin', 'b.bin'):
+        (feed / name).write_bytes(FIRST)
+    groups = _find_(folder=feed, logger=logger)
+    digest = groups[0].sha1.hex()
+    store = tmp_path / 'store'
+    target = store / digest[:2] / digest
+    target.parent.mkdir(parents=True)
+    target.write_bytes(SECOND[:len(FIRST)]) # same size, another content
+    reclaimed = Deduplicator(logger=logger).store(groups=groups,
+                                                  folder=str(store))
+    assert reclaimed == len(FIRST)
+    assert target.read_bytes() == FIRST
+    assert os.listdir(feed) == []
+    assert len((store / MANIFEST).read_text().splitlines()) == 2
+
+def test_store_trusts_objects_holding_the_content(tmp_path, logger):
+    feed = tmp_path / 'feed'
+    feed.mkdir()
+    for name in ('a.bin', 'b.bin'):
+        (feed / name).write_bytes(FIRST)
+    groups = _find_(folder=feed, logger=logger)
+    digest = groups[0].sha1.hex()
+    store = tmp_path / 'store'
+    target = store / digest[:2] / digest
+    target.parent.mkdir(parents=True)
+    target.write_bytes(FIRST)
+    inode = os.stat(target).st_ino
+    assert Deduplicator(logger=logger).store(
+        groups=groups, folder=str(store)) == 2 * len(FIRST)
+    assert os.stat(target).st_ino == inode and os.listdir(feed) == []
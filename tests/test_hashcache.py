@@ -0,0 +1,79 @@
+# Cached hashes must only be given back for a file unchanged since it was
+# hashed, and the least recently used entries must go first.
+
+import os
+import sqlite3
+
+from hashcache import HashCache
+from scanner import FileHashes
+
+def _hashes_(path, data):
+    return [FileHashes(path=str(path), size=len(data), crc=len(data),
+                       sha1=bytes(20))]
+
+def _put_(cache, path, data):
+    path.write_bytes(data)
+    cache.put(path=str(path), stat=os.stat(path),
+              results=_hashes_(path=path, data=data))
+
+def test_hits_unchanged_files(tmp_path, logger):
+    database = str(tmp_path / 'hashes.db')
+    with HashCache(path=database, logger=logger) as cache:
+        _put_(cache=cache, path=tmp_path / 'a.bin', data=b'abc')
+    with HashCache(path=database, logger=logger) as cache:
+        path = tmp_path / 'a.bin'
+        results = cache.get(path=str(path), stat=os.stat(path))
+        assert [(result.size, result.crc, result.sha1, result.member)
+                for result in results] == [(3, 3, bytes(20), None)]
+    with HashCache(path=database, rehash=True, logger=logger) as cache:
+        assert cache.get(path=str(path), stat=os.stat(path)) is None
+
+def test_misses_changed_files(tmp_path, logger):
+    database = str(tmp_path / 'hashes.db')
+    sized, touched = tmp_path / 'sized.bin', tmp_path / 'touched.bin'
+    with HashCache(path=database, logger=logger) as cache:
+        _put_(cache=cache, path=sized, data=b'abc')
+        _put_(cache=cache, path=touched, data=b'abc')
+    before = os.stat(sized)
+    with open(sized, 'ab') as file: # same inode, another size
+        file.write(b'd')
+    os.utime(sized, ns=(before.st_atime_ns, before.st_mtime_ns))
+    touched.write_bytes(b'xyz') # same inode and size, another mtime
+    os.utime(touched, ns=(1, 1))
+    with HashCache(path=database, logger=logger) as cache:
+        for path in (sized, touched):
+            assert cache.get(path=str(path), stat=os.stat(path)) is None
+        _put_(cache=cache, path=touched, data=b'xyz') # replaces the entry
+        rows = cache.connection.execute(
+            'SELECT COUNT(*) FROM hashes WHERE inode = ?',
+            (os.stat(touched).st_ino,)).fetchone()[0]
+        assert rows == 1
+
+def test_evicts_least_recently_used(tmp_path, logger):
+    database = str(tmp_path / 'hashes.db')
+    paths = {name: tmp_path / f'{name}.bin' for name in ('a', 'b', 'c')}
+    with HashCache(path=database, logger=logger) as cache:
+        _put_(cache=cache, path=paths['a'], data=b'a')
+        _put_(cache=cache, path=paths['b'], data=b'b')
+    with HashCache(path=database, maxEntries=2, logger=logger) as cache:
+        assert cache.get(path=str(paths['a']), stat=os.stat(paths['a']))
+        _put_(cache=cache, path=paths['c'], data=b'c')
+        cache.flush()
+        for name, kept in (('a', True), ('b', False), ('c', True)):
+            path = paths[name]
+            assert (cache.get(path=str(path), stat=os.stat(path))
+                    is not None) == kept
+        assert cache.evict() == 0
+
+def test_other_schema_disables_the_cache(tmp_path, logger):
+    database = str(tmp_path / 'hashes.db')
+    with HashCache(path=database, logger=logger):
+        pass
+    connection = sqlite3.connect(database)
+    connection.execute('PRAGMA user_version=99')
+    connection.close()
+    with HashCache(path=database, logger=logger) as cache:
+        assert not cache.enabled
+        path = tmp_path / 'a.bin'
+        _put_(cache=cache, path=path, data=b'a')
+        assert cache.get(path=str(path), stat=os.stat(path)) is None
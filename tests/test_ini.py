@@ -0,0 +1,62 @@
+# Options asked on the terminal must be set in config.ini without losing its
+# comments, its order or the options already there.
+
+import ini
+
+CONFIG = '''# Romix settings
+[test1]
+brand = io ; inline
+  continued
+; api_key = 0
+
+[empty]
+# only comments here
+
+[pixel]
+Data1 =
+data2 = 89
+'''
+
+def test_ask_keeps_the_file(tmp_path, monkeypatch, logger):
+    monkeypatch.setattr(ini, 'thisLogger', logger)
+    answers = iter(['23', 'tu', 'x', 'y'])
+    monkeypatch.setattr('builtins.input', lambda prompt: next(answers))
+    path = tmp_path / 'config.ini'
+    path.write_text(CONFIG)
+    values = {}
+    ini._ask_(configFile=str(path), values=values, missing=[
+        ('test1', 'api_key'), ('pixel', 'data1'), ('empty', 'x'),
+        ('new', 'y')])
+    assert path.read_text() == '''# Romix settings
+[test1]
+brand = io ; inline
+  continued
+api_key = 23
+; api_key = 0
+
+[empty]
+x = x
+# only comments here
+
+[pixel]
+data1 = tu
+data2 = 89
+
+[new]
+y = y
+'''
+    assert values == {'test1': {'api_key': '23'}, 'pixel': {'data1': 'tu'},
+                      'empty': {'x': 'x'}, 'new': {'y': 'y'}}
+    config = ini._readConfig_(configFile=str(path))
+    assert config.get('test1', 'api_key') == '23'
+    assert config.get('pixel', 'data1') == 'tu'
+    assert config.get('test1', 'brand') == 'io\ncontinued'
+    assert list(tmp_path.iterdir()) == [path]
+
+def test_ask_creates_the_file(tmp_path, monkeypatch, logger):
+    monkeypatch.setattr(ini, 'thisLogger', logger)
+    monkeypatch.setattr('builtins.input', lambda prompt: 'value')
+    path = tmp_path / 'config.ini'
+    ini._ask_(configFile=str(path), values={},
+              missing=[('folders', 'cache')])
+    assert path.read_text() == '[folders]\ncache = value\n'
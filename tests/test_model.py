@@ -0,0 +1,103 @@
+# The compact model must give back the games of a descriptor as getGames
+# always returned them, in tree and streaming mode alike.
+
+import os
+
+import pytest
+from lxml import etree
+
+from conftest import romXml
+from detector import openDescriptor
+from romset import Romset
+
+FBNEO = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'DAT', 'FinalBurnNeoGeo.dat')
+
+def _romDict_(attributes):
+    """
+    Return what toDict gives for a rom element: sizes as int, CRC as
+    lowercase 8 digits, digests in lowercase.
+    """
+    expected = dict(attributes)
+    if 'size' in expected:
+        expected['size'] = int(expected['size'])
+    if 'crc' in expected:
+        expected['crc'] = f'{int(expected["crc"], 16):08x}'
+    for key in ('md5', 'sha1'):
+        if key in expected:
+            expected[key] = expected[key].lower()
+    return expected
+
+@pytest.fixture(scope='module')
+def fbneo():
+    with openDescriptor(path=FBNEO) as file:
+        tree = Romset(descriptor=file)
+        tree.getGames() # while the file is open
+    with openDescriptor(path=FBNEO) as file:
+        streamed = Romset(descriptor=file, streaming=True)
+        games = dict(streamed.iterGames())
+    return tree, games
+
+def test_tree_and_streaming_agree(fbneo):
+    tree, streamed = fbneo
+    games = tree.getGames()
+    assert len(games) == len(tree.model) > 500
+    assert games == streamed
+
+def test_round_trip_against_the_descriptor(fbneo):
+    tree, _ = fbneo
+    elements = etree.parse(FBNEO).getroot().iterfind('game')
+    for element in elements:
+        game = tree.model.get(element.get('name'))
+        data = game.toDict()
+        if element.get('isbios') == 'yes':
+            assert game.category == 'bioses'
+            assert data['attributes']['isbios'] is True
+        elif element.get('cloneof') is not None:
+            assert game.category == 'clones'
+        else:
+            assert game.category == 'parents'
+        expected = {key: value for key, value in element.attrib.items()
+                    if key != 'isbios'}
+        assert {key: value for key, value in data['attributes'].items()
+                if key != 'isbios'} == expected
+        roms = element.findall('rom')
+        assert data['subelements'].get('rom', {}) == {
+            rom.get('name'): _romDict_(rom.attrib) for rom in roms}
+        assert data['subelements']['description'] == \
+            element.findtext('description')
+
+def test_categories(fbneo):
+    tree, _ = fbneo
+    groups = {group: len(tree.getGames(rSet=group) or {})
+              for group in ('bioses', 'parents', 'clones')}
+    assert groups['bioses'] == 1
+    assert sum(groups.values()) == len(tree.model)
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_hashes(makeRomset, streaming):
+    romset = makeRomset(streaming=streaming, games=[('game', [
+        '<rom name="upper" size="16" crc="ABC"/>',
+        romXml(name='nocrc', size=3),
+        '<rom name="nosize" crc="0000ffff"/>',
+        '<rom name="digests" size="1" crc="1" md5="' + 'AB' * 16 +
+        '" sha1="' + 'cd' * 20 + '"/>',
+        '<rom name="badsha1" size="1" crc="zz" sha1="1234"/>',
+        '<rom name="same" merge="same" size="1" crc="2"/>',
+        '<rom name="nodump" size="4" status="nodump"/>'])])
+    roms = romset.getGames()['game']['subelements']['rom']
+    assert roms == {
+        'upper': {'name': 'upper', 'size': 16, 'crc': '00000abc'},
+        'nocrc': {'name': 'nocrc', 'size': 3},
+        'nosize': {'name': 'nosize', 'crc': '0000ffff'},
+        'digests': {'name': 'digests', 'size': 1, 'crc': '00000001',
+                    'md5': 'ab' * 16, 'sha1': 'cd' * 20},
+        'badsha1': {'name': 'badsha1', 'size': 1, 'crc': 'zz',
+                    'sha1': '1234'}, # kept as found
+        'same': {'name': 'same', 'merge': 'same', 'size': 1,
+                 'crc': '00000002'},
+        'nodump': {'name': 'nodump', 'size': 4, 'status': 'nodump'}}
+    game = romset.model.get('game')
+    crcs = {rom.name: rom.crc for rom in game.roms}
+    assert crcs['nocrc'] is None and crcs['upper'] == 0xabc
+    assert {rom.name: rom.size for rom in game.roms}['nosize'] is None
@@ -0,0 +1,40 @@
+# The asyncio pipeline must skip unreadable files and raise, not hang, when a
+# hasher fails unexpectedly with the work queue full.
+
+import threading
+
+import pipeline
+from pipeline import AsyncScanner
+
+def _scan_(folder, logger):
+    """
+    Scan in a thread, return (results, error), None when it hangs.
+    """
+    outcome = []
+    def run():
+        scanner = AsyncScanner(inFlight=1, listers=1, logger=logger)
+        try:
+            outcome.append((list(scanner.scan(folders=[str(folder)])), None))
+        except Exception as e:
+            outcome.append((None, e))
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    return outcome[0] if outcome else None
+
+def test_scan(tmp_path, logger):
+    for number in range(5):
+        (tmp_path / f'{number}.bin').write_bytes(bytes([number]) * 100)
+    results, error = _scan_(folder=tmp_path, logger=logger)
+    assert error is None
+    assert sorted(result.size for result in results) == [100] * 5
+
+def test_hasher_errors_are_raised(tmp_path, logger, monkeypatch):
+    def broken(*args):
+        raise TypeError('broken hasher')
+    monkeypatch.setattr(pipeline, 'identifyFile', broken)
+    for number in range(10): # more than the queue holds
+        (tmp_path / f'{number}.bin').write_bytes(bytes([number]) * 100)
+    outcome = _scan_(folder=tmp_path, logger=logger)
+    assert outcome is not None, 'the scan hangs'
+    assert isinstance(outcome[1], TypeError)
@@ -0,0 +1,95 @@
+# Rebuilt archives must be valid zips whether members are copied raw from
+# source zips or deflated, and DAT names must never leave the output folder.
+
+import os
+import zipfile
+
+import rebuilder
+from conftest import romXml
+from rebuilder import Rebuilder, entryParts, safeName
+from scanner import Scanner
+
+STORED = os.urandom(3000)
+DEFLATED = bytes(range(256)) * 40 # compressible
+LOOSE = os.urandom(2000)
+
+def _rebuild_(romset, sources, output, logger, folders=False):
+    scanner = Scanner(workers=1, logger=logger)
+    rebuilder = Rebuilder(graph=romset.relations, index=romset.index,
+                          output=str(output), folders=folders, logger=logger)
+    rebuilder.add(results=list(scanner.scan(folders=[str(sources)])))
+    return rebuilder.rebuild()
+
+def test_raw_copy_gives_valid_archives(tmp_path, makeRomset, logger):
+    sources = tmp_path / 'feed'
+    sources.mkdir()
+    with zipfile.ZipFile(sources / 'mixed.zip', 'w') as archive:
+        archive.writestr('x.bin', STORED, compress_type=zipfile.ZIP_STORED)
+        archive.writestr('y.bin', DEFLATED, compress_type=zipfile.ZIP_DEFLATED)
+    (sources / 'loose.bin').write_bytes(LOOSE)
+    romset = makeRomset(games=[('game', [
+        romXml(name='stored.bin', data=STORED),
+        romXml(name='sub/deflated.bin', data=DEFLATED),
+        romXml(name='loose.bin', data=LOOSE)])])
+    stats = _rebuild_(romset=romset, sources=sources,
+                      output=tmp_path / 'out', logger=logger)
+    assert stats.rawBytes > 0 and stats.missing == 0
+    with zipfile.ZipFile(tmp_path / 'out' / 'game.zip') as archive:
+        assert archive.testzip() is None
+        assert sorted(archive.namelist()) == ['loose.bin', 'stored.bin',
+                                              'sub/deflated.bin']
+        assert archive.read('stored.bin') == STORED
+        assert archive.read('sub/deflated.bin') == DEFLATED
+        assert archive.read('loose.bin') == LOOSE
+        methods = {info.filename: info.compress_type
+                   for info in archive.infolist()}
+    assert methods['stored.bin'] == zipfile.ZIP_STORED # copied as it was
+    assert methods['sub/deflated.bin'] == zipfile.ZIP_DEFLATED
+
+def test_zip64_beyond_the_limits(tmp_path, makeRomset, logger, monkeypatch):
+    monkeypatch.setattr(rebuilder, 'ZIP_LIMIT', 2500)
+    monkeypatch.setattr(rebuilder, 'ZIP_ENTRIES', 3)
+    sources = tmp_path / 'feed'
+    sources.mkdir()
+    with zipfile.ZipFile(sources / 'mixed.zip', 'w') as archive:
+        archive.writestr('x.bin', STORED, compress_type=zipfile.ZIP_STORED)
+        archive.writestr('y.bin', DEFLATED, compress_type=zipfile.ZIP_DEFLATED)
+    (sources / 'loose.bin').write_bytes(LOOSE)
+    romset = makeRomset(games=[('game', [
+        romXml(name='stored.bin', data=STORED), # zip64 sizes
+        romXml(name='deflated.bin', data=DEFLATED), # zip64 offset
+        romXml(name='loose.bin', data=LOOSE),
+        romXml(name='empty.bin', size=0, crc=0)])])
+    stats = _rebuild_(romset=romset, sources=sources,
+                      output=tmp_path / 'out', logger=logger)
+    assert stats.complete == 1
+    with zipfile.ZipFile(tmp_path / 'out' / 'game.zip') as archive:
+        assert archive.testzip() is None
+        assert archive.read('stored.bin') == STORED
+        assert archive.read('deflated.bin') == DEFLATED
+        assert archive.read('loose.bin') == LOOSE
+        assert archive.read('empty.bin') == b''
+        assert archive.getinfo('stored.bin').extract_version == 45
+
+def test_entries_outside_the_set_are_refused(tmp_path, makeRomset, logger):
+    sources = tmp_path / 'feed'
+    sources.mkdir()
+    (sources / 'a.bin').write_bytes(STORED)
+    (sources / 'b.bin').write_bytes(LOOSE)
+    romset = makeRomset(games=[('../up', [
+        romXml(name='../../evil.bin', data=STORED),
+        romXml(name='b.bin', data=LOOSE)])])
+    output = tmp_path / 'out'
+    stats = _rebuild_(romset=romset, sources=sources, output=output,
+                      logger=logger, folders=True)
+    assert stats.missing == 1
+    assert sorted(os.listdir(output)) == ['.._up']
+    assert os.listdir(output / '.._up') == ['b.bin']
+    assert not (tmp_path / 'evil.bin').exists()
+
+def test_names():
+    assert safeName(name='a/b\\c') == 'a_b_c'
+    assert safeName(name='..') == '_'
+    assert entryParts(entry='sub/rom.bin') == ['sub', 'rom.bin']
+    for entry in ('../rom.bin', '/rom.bin', 'a//b', 'C:', 'a\\..\\b', '.'):
+        assert entryParts(entry=entry) is None
@@ -0,0 +1,38 @@
+# Merged sets must hold a dump shared by a parent and its clones once, and
+# clone dumps clashing with a parent ROM of the same name under clone/rom.
+
+from conftest import romXml
+
+GAMES = [('parent', [romXml(name='same.bin', data=b'same'),
+                     romXml(name='other.bin', data=b'parent')]),
+         ('clone', [romXml(name='same.bin', data=b'same'), # no merge
+                    romXml(name='other.bin', data=b'clone'),
+                    romXml(name='own.bin', data=b'own')],
+          'cloneof="parent" romof="parent"'),
+         ('nodump', [romXml(name='same.bin', size=4)],
+          'cloneof="parent" romof="parent"')]
+
+def _entries_(graph, name, setType):
+    return sorted(entry for entry, _ in graph.contents(name=name,
+                                                        setType=setType))
+
+def test_merged_sets(makeRomset):
+    graph = makeRomset(games=GAMES).relations
+    assert _entries_(graph=graph, name='parent', setType='merged') == [
+        'clone/other.bin', 'nodump/same.bin', 'other.bin', 'own.bin',
+        'same.bin']
+    assert _entries_(graph=graph, name='clone', setType='merged') == []
+    assert _entries_(graph=graph, name='clone', setType='split') == [
+        'other.bin', 'own.bin', 'same.bin']
+
+def test_same_dump(makeRomset):
+    table = makeRomset(games=[('game', [
+        romXml(name='a', data=b'abcd'),
+        romXml(name='b', data=b'abcd'),
+        romXml(name='c', data=b'abcd', size=5),
+        '<rom name="d" size="4" sha1="' + '00' * 20 + '"/>',
+        romXml(name='e', size=4)])]).model.roms
+    assert table.sameDump(first=0, second=1)
+    assert not table.sameDump(first=0, second=2) # another size
+    assert not table.sameDump(first=0, second=3) # no common hash
+    assert not table.sameDump(first=4, second=4) # nothing to compare
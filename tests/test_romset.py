@@ -0,0 +1,45 @@
+# Streaming mode must give the same games as tree mode without building the
+# model, nor the descriptor cache, until something needs them.
+
+import os
+
+import pytest
+
+from conftest import romXml
+
+GAMES = [('bios', [romXml(name='bios.bin', data=b'bios')], 'isbios="yes"'),
+         ('parent', [romXml(name='p.bin', data=b'parent')], 'romof="bios"'),
+         ('clone', [romXml(name='c.bin', data=b'clone')],
+          'cloneof="parent" romof="parent"')]
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_machine_elements(makeRomset, streaming):
+    romset = makeRomset(games=GAMES, tag='machine', streaming=streaming)
+    games = romset.getGames()
+    assert sorted(games) == ['bios', 'clone', 'parent']
+    assert [name for name, _ in romset.iterGames(rSet='clones')] == ['clone']
+    assert sorted(game.name for game in romset.model) == \
+        ['bios', 'clone', 'parent']
+
+def test_streaming_builds_nothing_up_front(tmp_path, makeRomset):
+    cacheDir = str(tmp_path / 'cache')
+    os.makedirs(cacheDir)
+    romset = makeRomset(games=GAMES, streaming=True, cacheDir=cacheDir)
+    assert dict(romset.iterGames()).keys() == {'bios', 'parent', 'clone'}
+    assert romset.getGames(rSet='bioses').keys() == {'bios'}
+    assert romset.__model__ is None and romset.__index__ is None
+    assert os.listdir(cacheDir) == []
+    assert len(romset.index.crcs) == 3 # builds and caches the model
+    assert len(os.listdir(cacheDir)) == 1
+    again = makeRomset(games=GAMES, streaming=True, cacheDir=cacheDir)
+    assert again.__model__ is None
+    assert sorted(game.name for game in again.model) == \
+        ['bios', 'clone', 'parent']
+    assert again.__index__ is not None # loaded along with the model
+
+def test_tree_mode_uses_the_cache(tmp_path, makeRomset):
+    cacheDir = str(tmp_path / 'cache')
+    os.makedirs(cacheDir)
+    romset = makeRomset(games=GAMES, cacheDir=cacheDir)
+    assert romset.__model__ is not None
+    assert len(os.listdir(cacheDir)) == 1